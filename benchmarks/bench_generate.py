@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Per-stage and end-to-end timings of the generate pipeline on synthetic
+# hosts-format sources.
+#
+#   $ python3 benchmarks/bench_generate.py --domains 10000 --domains 1000000
+#   $ python3 benchmarks/bench_generate.py --domains 5000000 --stage rules --block-at-psl
+#   $ python3 benchmarks/bench_generate.py --output results.jsonl
+#
+# Every (size, stage) pair runs in its own interpreter: the inputs of a
+# stage are prepared first and are not measured, then the stage runs once.
+# Each run prints one JSON object per line with:
+#
+#   stage, domains, duplicate_ratio, idn_ratio, max_depth, block_at_psl,
+#   seconds, cpu_seconds, rss_before_kib, max_rss_kib, output_items,
+#   output_bytes, python, dnsgate, urltool
+#
+# max_rss_kib is the process peak, rss_before_kib what the prepared inputs
+# already used. Build state and output files go to a temporary directory,
+# end_to_end fetches the sources from a local HTTP server with the cache
+# disabled, so nothing under /etc or /var is touched.
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import click
+
+from synthetic import synthetic_hosts_sources
+
+STAGES = ['parse', 'validate', 'combine', 'rules', 'state', 'incremental', 'sort', 'write', 'end_to_end']
+# unmeasured steps that produce the inputs of each stage
+STAGE_INPUTS = {'parse': [],
+                'validate': ['parse'],
+                'combine': ['parse', 'validate'],
+                'rules': ['parse', 'validate', 'combine'],
+                'state': ['parse', 'validate', 'combine', 'rules'],
+                'incremental': ['parse', 'validate', 'combine', 'rules', 'state', 'prepare_incremental'],
+                'sort': ['parse', 'validate', 'combine', 'rules'],
+                'write': ['parse', 'validate', 'combine', 'rules', 'sort'],
+                'end_to_end': ['prepare_end_to_end']}
+DEFAULT_SIZES = [10000, 100000, 1000000]
+INCREMENTAL_CHURN = 0.01  # share of remote domains replaced for the incremental stage
+
+
+def current_rss_kib() -> int:
+    with open('/proc/self/statm', 'r') as fh:
+        return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def max_rss_kib() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def package_version(name: str):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:   # not installed as a distribution
+        return None
+
+
+def directory_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in Path(path).iterdir() if entry.is_file())
+
+
+class Pipeline():
+    # runs the generate stages up to the one being measured, keeping what
+    # each one produced for the next
+    def __init__(self, *, options: dict, workdir: Path):
+        from dnsgate.config import DnsgateConfig
+        import dnsgate.incremental
+        self.options = options
+        self.workdir = workdir
+        dnsgate.incremental.BUILD_STATE_DIRECTORY = workdir / 'state'
+        self.config = DnsgateConfig(mode='dnsmasq',
+                                    block_at_psl=options['block_at_psl'],
+                                    sources=[],
+                                    output=(workdir / 'generated_blacklist').as_posix(),)
+        self.hosts = synthetic_hosts_sources(domains=options['domains'],
+                                             duplicate_ratio=options['duplicate_ratio'],
+                                             idn_ratio=options['idn_ratio'],
+                                             max_depth=options['max_depth'],
+                                             seed=options['seed'],)
+
+    def parse(self):
+        # the streaming parser validates as it goes, the validate stage
+        # below only finds already validated sets now
+        from dnsgate.global_vars import FETCH_CHUNK_SIZE
+        from dnsgate.hosts import parse_hosts_chunks
+        self.raw = [parse_hosts_chunks(source[start:start + FETCH_CHUNK_SIZE]
+                                       for start in range(0, len(source), FETCH_CHUNK_SIZE))
+                    for source in self.hosts]
+        return sum(len(domains) for domains in self.raw), None
+
+    def validate(self):
+        from dnsgate.validate import validated_domains
+        self.validated = [validated_domains(domains) for domains in self.raw]
+        return sum(len(domains) for domains in self.validated), None
+
+    def combine(self):
+        from dnsgate.validate import ValidatedDomains
+        self.remote = ValidatedDomains()
+        for domains in self.validated:
+            self.remote |= domains
+        return len(self.remote), None
+
+    def whitelist_and_blacklist(self):
+        from dnsgate.validate import ValidatedDomains
+        whitelist = ValidatedDomains(sorted(self.remote)[:100])
+        blacklist = ValidatedDomains([b'doubleclick.net', b'example.com'])
+        return whitelist, blacklist
+
+    def rules(self):
+        from dnsgate.dnsgate import build_rule_set
+        self.whitelist, self.blacklist = self.whitelist_and_blacklist()
+        self.remote_rules, self.final = build_rule_set(config=self.config,
+                                                       domains_combined_orig=self.remote,
+                                                       domains_whitelist=self.whitelist,
+                                                       domains_blacklist=self.blacklist,)
+        return len(self.final), None
+
+    def state(self):
+        from dnsgate.incremental import make_build_state
+        from dnsgate.incremental import save_build_state
+        self.build_state = make_build_state(mode=self.config.mode,
+                                            block_at_psl=self.config.block_at_psl,
+                                            remote=self.remote,
+                                            whitelist=self.whitelist,
+                                            blacklist=self.blacklist,
+                                            remote_rules=self.remote_rules,
+                                            final=set(self.final),)
+        save_build_state(self.build_state)
+        return len(self.build_state.rules), directory_size(self.workdir / 'state')
+
+    def prepare_incremental(self):
+        from dnsgate.validate import ValidatedDomains
+        churn = int(len(self.remote) * INCREMENTAL_CHURN)
+        kept = sorted(self.remote)[churn:]
+        added = [b'churn%d.example.net' % index for index in range(churn)]
+        self.next_remote = ValidatedDomains(kept + added)
+
+    def incremental(self):
+        from dnsgate.incremental import update_build_state
+        final = update_build_state(self.build_state,
+                                   remote=self.next_remote,
+                                   whitelist=self.whitelist,
+                                   blacklist=self.blacklist,)
+        return len(final), None
+
+    def sort(self):
+        from urltool import group_by_tld
+        self.sorted = group_by_tld(self.final)
+        return len(self.sorted), None
+
+    def write(self):
+        from dnsgate.dnsgate import write_output_file
+        write_output_file(config=self.config, domains_combined=self.sorted, verbose=False, debug=False,)
+        return len(self.sorted), os.stat(self.config.output).st_size
+
+    def prepare_end_to_end(self):
+        sources = self.workdir / 'sources'
+        sources.mkdir()
+        for index, source in enumerate(self.hosts):
+            (sources / str(index)).write_bytes(source)
+        handler = partial(QuietHandler, directory=sources.as_posix())
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        port = self.server.server_address[1]
+        self.urls = ['http://127.0.0.1:%d/%d' % (port, index) for index in range(len(self.hosts))]
+        del self.hosts
+
+    def end_to_end(self):
+        from dnsgate.cache import iter_domains_from_urls
+        from dnsgate.dnsgate import build_rule_set
+        from dnsgate.dnsgate import write_output_file
+        from dnsgate.validate import ValidatedDomains
+        from urltool import group_by_tld
+        self.remote = ValidatedDomains()
+        for _, domains in iter_domains_from_urls(urls=self.urls, no_cache=True):
+            self.remote |= domains
+        whitelist, blacklist = self.whitelist_and_blacklist()
+        _, final = build_rule_set(config=self.config,
+                                  domains_combined_orig=self.remote,
+                                  domains_whitelist=whitelist,
+                                  domains_blacklist=blacklist,)
+        final = group_by_tld(final)
+        write_output_file(config=self.config, domains_combined=final, verbose=False, debug=False,)
+        self.server.shutdown()
+        return len(final), os.stat(self.config.output).st_size
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def run_stage(*, stage: str, options: dict) -> dict:
+    with tempfile.TemporaryDirectory(prefix='dnsgate-bench-') as workdir:
+        pipeline = Pipeline(options=options, workdir=Path(workdir))
+        for step in STAGE_INPUTS[stage]:
+            getattr(pipeline, step)()
+        rss_before = current_rss_kib()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        output_items, output_bytes = getattr(pipeline, stage)()
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+
+    result = {'stage': stage}
+    result.update(options)
+    result.update({'seconds': round(seconds, 4),
+                   'cpu_seconds': round(cpu_seconds, 4),
+                   'rss_before_kib': rss_before,
+                   'max_rss_kib': max_rss_kib(),
+                   'output_items': output_items,
+                   'output_bytes': output_bytes,
+                   'python': platform.python_version(),
+                   'dnsgate': package_version('dnsgate'),
+                   'urltool': package_version('urltool')})
+    return result
+
+
+@click.command()
+@click.option('--domains', 'sizes', type=int, multiple=True,
+              help='unique domains across all sources, may be repeated (default: 10k, 100k, 1M)')
+@click.option('--stage', 'stages', type=click.Choice(STAGES), multiple=True,
+              help='stage to run, may be repeated (default: all)')
+@click.option('--duplicate-ratio', type=float, default=0.3)
+@click.option('--idn-ratio', type=float, default=0.01)
+@click.option('--max-depth', type=int, default=3)
+@click.option('--block-at-psl', is_flag=True)
+@click.option('--seed', type=int, default=1)
+@click.option('--output', type=click.File('a'), default='-',
+              help='append JSON lines here instead of stdout')
+@click.option('--in-process', is_flag=True,
+              help='run a single stage in this interpreter')
+def cli(sizes,
+        stages,
+        duplicate_ratio: float,
+        idn_ratio: float,
+        max_depth: int,
+        block_at_psl: bool,
+        seed: int,
+        output,
+        in_process: bool,
+        ):
+    sizes = sizes or DEFAULT_SIZES
+    stages = stages or STAGES
+    if in_process:
+        options = {'domains': sizes[0],
+                   'duplicate_ratio': duplicate_ratio,
+                   'idn_ratio': idn_ratio,
+                   'max_depth': max_depth,
+                   'block_at_psl': block_at_psl,
+                   'seed': seed}
+        output.write(json.dumps(run_stage(stage=stages[0], options=options)) + '\n')
+        return
+
+    for size in sizes:
+        for stage in stages:
+            command = [sys.executable, __file__, '--in-process',
+                       '--domains', str(size),
+                       '--stage', stage,
+                       '--duplicate-ratio', str(duplicate_ratio),
+                       '--idn-ratio', str(idn_ratio),
+                       '--max-depth', str(max_depth),
+                       '--seed', str(seed),]
+            if block_at_psl:
+                command.append('--block-at-psl')
+            result = subprocess.run(command, check=True, stdout=subprocess.PIPE,)
+            output.write(result.stdout.decode('utf8'))
+            output.flush()
+
+
+if __name__ == '__main__':
+    # pylint: disable=no-value-for-parameter
+    cli()
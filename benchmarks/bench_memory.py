@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Peak RSS and wall time of the rule set pipeline on a synthetic input,
+# before and after validating once at ingestion and dropping the copies.
+#
+#   $ python3 benchmarks/bench_memory.py --domains 1000000
+#
+# Each variant runs in its own interpreter so ru_maxrss is not shared.
+# "legacy" replays the old generate stages: a fresh set per source union,
+# validate_domain_list() on the combined and final sets, a deepcopy of the
+# remote set, prune_redundant_rules() and group_by_tld(). "current" runs
+# the in-place union of already validated sources and build_rule_set().
+# "compact" is generate --compact: every source is merged into a
+# PackedDomains and dropped, then build_packed_state().
+
+import copy
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import click
+
+SOURCE_COUNT = 4
+
+
+def synthetic_sources(*, domains: int, seed: int, set_type=set) -> list:
+    # four overlapping sources, as hosts lists usually are
+    rng = random.Random(seed)
+    labels = [b'ads', b'www', b'cdn', b'track', b'img', b'api', b'm', b'static']
+    tlds = [b'com', b'net', b'org', b'io', b'co.uk', b'de', b'info']
+    sources = [set_type() for _ in range(SOURCE_COUNT)]
+    for index in range(domains):
+        depth = rng.randint(0, 3)
+        name_labels = [rng.choice(labels) for _ in range(depth)]
+        name_labels += [b'site%d' % (index % (domains // 3 + 1)), rng.choice(tlds)]
+        name = b'.'.join(name_labels)
+        for source in rng.sample(sources, rng.randint(1, 2)):
+            source.add(name)
+    return sources
+
+
+def max_rss_kib() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_legacy(sources: list, whitelist: set, blacklist: set) -> int:
+    from urltool import group_by_tld
+    from urltool import prune_redundant_rules
+    from urltool import validate_domain_list
+    whitelist = validate_domain_list(whitelist)
+    combined_orig = set()
+    for domains in sources:
+        combined_orig = combined_orig | domains
+    combined_orig = validate_domain_list(combined_orig)
+    combined = copy.deepcopy(combined_orig)
+    combined = combined - whitelist
+    combined = combined | blacklist
+    combined = validate_domain_list(combined)
+    prune_redundant_rules(combined)
+    return len(group_by_tld(combined))
+
+
+def run_current(sources: list, whitelist: set, blacklist: set) -> int:
+    from urltool import group_by_tld
+    from dnsgate.config import DnsgateConfig
+    from dnsgate.dnsgate import build_rule_set
+    from dnsgate.validate import ValidatedDomains
+    from dnsgate.validate import validated_domains
+    whitelist = validated_domains(whitelist)
+    blacklist = validated_domains(blacklist)
+    combined_orig = ValidatedDomains()
+    for domains in sources:
+        combined_orig |= domains
+    sources.clear()
+    _, final = build_rule_set(config=DnsgateConfig(mode='dnsmasq'),
+                              domains_combined_orig=combined_orig,
+                              domains_whitelist=whitelist,
+                              domains_blacklist=blacklist,)
+    return len(group_by_tld(final))
+
+
+def run_compact(sources: list, whitelist: set, blacklist: set) -> int:
+    from dnsgate.incremental import build_packed_state
+    from dnsgate.packed import PackedDomains
+    from dnsgate.validate import validated_domains
+    whitelist = validated_domains(whitelist)
+    blacklist = validated_domains(blacklist)
+    combined_orig = PackedDomains()
+    while sources:
+        combined_orig |= sources.pop()
+    state = build_packed_state(mode='dnsmasq',
+                               block_at_psl=False,
+                               remote=combined_orig,
+                               whitelist=whitelist,
+                               blacklist=blacklist,)
+    return len(state.final)
+
+
+VARIANTS = {'legacy': run_legacy, 'current': run_current, 'compact': run_compact}
+
+
+def run_variant(*, variant: str, domains: int, seed: int) -> dict:
+    set_type = set
+    if variant in ('current', 'compact'):
+        # the current pipeline receives sources already validated by the parse cache
+        from dnsgate.validate import ValidatedDomains
+        set_type = ValidatedDomains
+    sources = synthetic_sources(domains=domains, seed=seed, set_type=set_type)
+    whitelist = set(sorted(sources[0])[:100])
+    blacklist = {b'example.com', b'doubleclick.net'}
+    rss_inputs = max_rss_kib()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    rules = VARIANTS[variant](sources, whitelist, blacklist)
+    return {'variant': variant,
+            'domains': domains,
+            'rules': rules,
+            'wall_seconds': round(time.perf_counter() - start, 3),
+            'cpu_seconds': round(time.process_time() - cpu_start, 3),
+            'max_rss_inputs_kib': rss_inputs,
+            'max_rss_kib': max_rss_kib()}
+
+
+@click.command()
+@click.option('--domains', type=int, default=1000000)
+@click.option('--seed', type=int, default=1)
+@click.option('--variant', type=click.Choice(sorted(VARIANTS)), default=None,
+              help='run a single variant in this process')
+def cli(domains: int, seed: int, variant):
+    if variant:
+        print(json.dumps(run_variant(variant=variant, domains=domains, seed=seed)))
+        return
+    for name in ('legacy', 'current', 'compact'):
+        result = subprocess.run([sys.executable, __file__,
+                                 '--domains', str(domains),
+                                 '--seed', str(seed),
+                                 '--variant', name],
+                                check=True, stdout=subprocess.PIPE,)
+        sys.stdout.write(result.stdout.decode('utf8'))
+
+
+if __name__ == '__main__':
+    # pylint: disable=no-value-for-parameter
+    cli()
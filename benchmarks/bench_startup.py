@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Wall time from exec to exit of the dnsgate CLI, per subcommand.
+#
+#   $ python3 benchmarks/bench_startup.py
+#   $ python3 benchmarks/bench_startup.py --runs 50 --command 'enable --help'
+#
+# Each command runs --runs times in a fresh interpreter. "--help" of a
+# subcommand still runs the group callback (reading /etc/dnsgate/config),
+# so it measures imports plus the config parsing without touching dnsmasq.
+# Prints one JSON object per command with the min and median milliseconds
+# and which of HEAVY_MODULES the command ended up importing.
+
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+COMMANDS = ['--help',
+            'enable --help',
+            'disable --help',
+            'whitelist --help',
+            'blacklist --help',
+            'install-help',
+            'generate --help',
+            'serve --help',]
+HEAVY_MODULES = ['asyncio', 'multiprocessing', 'requests', 'tldextract', 'urltool']
+
+# runs the CLI like "python3 -m dnsgate.dnsgate", then lists what it imported
+PROBE = '''
+import json, runpy, sys
+modules_file, heavy, args = sys.argv[1], sys.argv[2].split(','), sys.argv[3:]
+sys.argv = ['dnsgate'] + args
+try:
+    runpy.run_module('dnsgate.dnsgate', run_name='__main__')
+except SystemExit:
+    pass
+with open(modules_file, 'w') as fh:
+    json.dump([name for name in heavy if name in sys.modules], fh)
+'''
+
+
+def time_interpreter(args: list, *, runs: int) -> list:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def imported_heavy_modules(args: list) -> list:
+    with tempfile.NamedTemporaryFile('r', suffix='.json') as fh:
+        subprocess.run([sys.executable, '-c', PROBE, fh.name, ','.join(HEAVY_MODULES)] + args,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        return json.load(fh)
+
+
+@click.command()
+@click.option('--runs', type=int, default=20)
+@click.option('--command', 'commands', multiple=True,
+              help='arguments after "dnsgate", repeatable (defaults to COMMANDS)')
+def cli(runs: int, commands):
+    # the interpreter alone, the floor every command starts from
+    times = time_interpreter(['-c', 'pass'], runs=runs)
+    print(json.dumps({'command': 'python3 -c pass',
+                      'min_ms': round(min(times), 1),
+                      'median_ms': round(statistics.median(times), 1)}))
+    for command in commands or COMMANDS:
+        args = command.split()
+        times = time_interpreter(['-m', 'dnsgate.dnsgate'] + args, runs=runs)
+        print(json.dumps({'command': 'dnsgate ' + command,
+                          'min_ms': round(min(times), 1),
+                          'median_ms': round(statistics.median(times), 1),
+                          'heavy_modules': imported_heavy_modules(args),
+                          'python': sys.version.split()[0]}))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Deterministic synthetic hosts-format sources for the benchmarks.
+#
+# Names look like blocklist entries: mostly unrelated registrable domains,
+# some with a few (up to max_depth) subdomain labels, a share of IDNs
+# (punycode and raw UTF-8, as real lists carry both), comments and blank
+# lines, and duplicate_ratio of the lines repeating a name that is already
+# in this or another source.
+
+import random
+
+LABELS = [b'ads', b'www', b'cdn', b'track', b'img', b'api', b'm', b'static', b'pixel', b'metrics']
+TLDS = [b'com', b'net', b'org', b'io', b'co.uk', b'de', b'info', b'ru', b'com.br', b'xyz']
+IDN_LABELS = ['bücher', 'müller', 'café', 'пример', '例子', 'ölçü']
+HOSTS_HEADER = b'# synthetic dnsgate benchmark source\n#\n127.0.0.1 localhost\n::1 localhost\n\n'
+
+
+def synthetic_domain(rng: random.Random, index: int, *,
+                     idn_ratio: float,
+                     max_depth: int,
+                     ) -> bytes:
+    if rng.random() < idn_ratio:
+        label = IDN_LABELS[index % len(IDN_LABELS)] + str(index)
+        if index % 2:
+            name = label.encode('idna')
+        else:
+            name = label.encode('utf8')
+    else:
+        name = b'site%d' % index
+    depth = rng.randint(0, max_depth)
+    return b'.'.join([rng.choice(LABELS) for _ in range(depth)] + [name, rng.choice(TLDS)])
+
+
+def synthetic_hosts_sources(*,
+                            domains: int,
+                            sources: int = 4,
+                            duplicate_ratio: float = 0.3,
+                            idn_ratio: float = 0.01,
+                            max_depth: int = 3,
+                            seed: int = 1,
+                            ) -> list:
+    # returns one hosts-format bytes object per source, `domains` is the
+    # number of unique names across all of them
+    rng = random.Random(seed)
+    lines = [[HOSTS_HEADER] for _ in range(sources)]
+    emitted = []
+    duplicates = int(domains * duplicate_ratio / max(1e-9, 1 - duplicate_ratio))
+    for index in range(domains):
+        name = synthetic_domain(rng, index, idn_ratio=idn_ratio, max_depth=max_depth)
+        emitted.append(name)
+        lines[index % sources].append(b'0.0.0.0 ' + name + b'\n')
+        if index % 1000 == 0:
+            lines[index % sources].append(b'# section %d\n\n' % index)
+    for _ in range(duplicates):
+        lines[rng.randrange(sources)].append(b'0.0.0.0 ' + rng.choice(emitted) + b'\n')
+    return [b''.join(source) for source in lines]
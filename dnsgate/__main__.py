@@ -2,5 +2,5 @@
 
 """bootstrap.__main__: executed when bootstrap directory is called as script."""
 
-from .dnsgate import main
-main()
+from .dnsgate import dnsgate
+dnsgate()
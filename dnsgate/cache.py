@@ -23,64 +23,440 @@
 # pylint: disable=C0413  # TEMP isort issue [wrong-import-position] Import "from pathlib import Path" should be placed at the top of the module [C0413]
 
 
-import glob
+import hashlib
 import os
+import subprocess
+import sys
 import time
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from typing import NamedTuple
+from typing import Optional
+
+import requests
 from logtool import leprint
 from logtool import LOG
-from hashtool import hash_str
-from pathtool import read_file_bytes
-from urltool import extract_domain_set_from_hosts_format_bytes
-from urltool import extract_domain_set_from_hosts_format_url
+from .cache_index import CACHE_INDEX
+from .cache_index import cache_entry_files
+from .cache_index import cache_key
+from .domain_file import DomainFileError
+from .domain_file import read_domain_file
+from .domain_file import read_domain_file_tag
+from .domain_file import write_domain_file
+from .hosts import HostsParseError
+from .hosts import HostsParser
+from .hosts import ParsePool
+from .hosts import parse_hosts_chunks
+from .hosts import read_file_chunks
+from .sources import is_local_source
+from .sources import local_file_tag
+from .sources import local_source_path
+from .validate import ValidatedDomains
 from .global_vars import CACHE_EXPIRE, CACHE_DIRECTORY
+from .global_vars import FETCH_JOBS, FETCH_TIMEOUT
+from .global_vars import FETCH_CHUNK_SIZE
+from .global_vars import STALE_DEADLINE
+from .stats import STATS
+
+# what get_domains_from_url does with a cached copy when its source is
+# slow or down:
+#
+#   never       the source is fetched, a failure skips it
+#   fallback    the source is fetched, a failure uses the cached copy
+#               no matter how old it is
+#   revalidate  an expired cached copy is used at once (or once the
+#               source missed STALE_DEADLINE) and the url is added to
+#               REFRESH_URLS, refresh_in_background() then downloads it
+#               for the next run
+REFRESH_URLS = []   # appended to from the fetch threads
 
 
-class CachedCopyNotFoundError(FileNotFoundError):
+class FetchTimeoutError(requests.exceptions.Timeout):
     pass
 
 
+class Download(NamedTuple):
+    size: int
+    content_hash: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    not_modified: bool
+
+
 def get_domains_from_url(*,
                          url: str,
                          no_cache: bool = False,
                          cache_expire: int = CACHE_EXPIRE,
-                         ) -> set:
+                         timeout: int = FETCH_TIMEOUT,
+                         parse_pool: Optional[ParsePool] = None,
+                         stale: str = 'never',
+                         stale_deadline: int = STALE_DEADLINE,
+                         ) -> ValidatedDomains:
+    if is_local_source(url):
+        return get_domains_from_local_file(url=url, no_cache=no_cache, parse_pool=parse_pool)
 
-    unexpired_copy = get_cached_url_copy(url=url, cache_expire=cache_expire)
-    if unexpired_copy:
-        leprint("Using cached copy: %s", unexpired_copy, level=LOG['INFO'])
-        unexpired_copy_bytes = read_file_bytes(unexpired_copy)
-        assert isinstance(unexpired_copy_bytes, bytes)
-        return extract_domain_set_from_hosts_format_bytes(unexpired_copy_bytes)
+    cached_copy = None
+    if not no_cache and stale != 'never':
+        cached_copy = get_matching_cached_file(url)
+    if not cached_copy:
+        return fetch_domains_from_url(url=url,
+                                      no_cache=no_cache,
+                                      cache_expire=cache_expire,
+                                      timeout=timeout,
+                                      parse_pool=parse_pool,)
 
-    return extract_domain_set_from_hosts_format_url(url, no_cache)
+    refresh = stale == 'revalidate' and cached_copy_is_expired(cached_copy, cache_expire=cache_expire)
+    if refresh:
+        if not stale_deadline:
+            return get_domains_from_stale_copy(url=url,
+                                               cached_copy=cached_copy,
+                                               parse_pool=parse_pool,
+                                               refresh=True,
+                                               reason='expired, it is downloaded in the background',)
+        timeout = min(timeout, stale_deadline)
+    try:
+        return fetch_domains_from_url(url=url,
+                                      cache_expire=cache_expire,
+                                      timeout=timeout,
+                                      parse_pool=parse_pool,)
+    except (requests.exceptions.RequestException, OSError) as e:
+        return get_domains_from_stale_copy(url=url,
+                                           cached_copy=cached_copy,
+                                           parse_pool=parse_pool,
+                                           refresh=refresh,
+                                           reason='fetching it failed: %s' % e,)
 
 
-def generate_cache_file_name(url):
-    url_hash = hash_str(url)
-    file_name = CACHE_DIRECTORY / Path(url_hash + '_hosts')
-    return file_name
+def get_domains_from_local_file(*,
+                                url: str,
+                                no_cache: bool = False,
+                                parse_pool: Optional[ParsePool] = None,
+                                ) -> ValidatedDomains:
+    # the parsed copy is tagged with the inode, size and mtime of the file
+    # instead of a hash of its bytes, so an unchanged file is not even read.
+    # The stat is taken before the read: a file replaced in between is
+    # parsed under the old tag and parsed again on the next run
+    source_stats = STATS.source(url)
+    start = time.perf_counter()
+    path = local_source_path(url)
+    tag = local_file_tag(os.stat(path))
+    parsed_copy = generate_parsed_cache_file_name(url)
+    source_stats.update(cache='disabled' if no_cache else 'local')
+    if not no_cache:
+        try:
+            if read_domain_file_tag(parsed_copy) == tag:
+                _, domains = read_domain_file(parsed_copy, set_type=ValidatedDomains)
+                leprint("Using parsed copy of unchanged %s: %s", path, parsed_copy, level=LOG['DEBUG'])
+                CACHE_INDEX.touch(url)
+                source_stats.update(parsed_cache='hit', domains=len(domains), seconds=round(time.perf_counter() - start, 6))
+                return domains
+        except (FileNotFoundError, DomainFileError):
+            pass
+
+    leprint("Reading: %s", path, level=LOG['INFO'])
+    new_parser = parse_pool.parser if parse_pool else HostsParser
+    domains = parse_hosts_chunks(read_file_chunks(path), parser=new_parser())
+    if not no_cache:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        write_domain_file(path=parsed_copy, domains=domains, tag=tag)
+        CACHE_INDEX.touch(url)
+        source_stats.update(parsed_cache='miss')
+    source_stats.update(domains=len(domains), seconds=round(time.perf_counter() - start, 6))
+    return domains
+
+
+def get_domains_from_stale_copy(*,
+                                url: str,
+                                cached_copy,
+                                parse_pool: Optional[ParsePool],
+                                refresh: bool,
+                                reason: str,
+                                ) -> ValidatedDomains:
+    start = time.perf_counter()
+    age = time.time() - os.stat(cached_copy).st_mtime
+    leprint("WARNING: Using the cached copy of %s from %s ago, %s.", url, format_age(age), reason, level=LOG['WARNING'])
+    STATS.source(url).update(cache='stale', stale_seconds=round(age))
+    new_parser = parse_pool.parser if parse_pool else HostsParser
+    domains = get_domains_from_cached_copy(url=url, cached_copy=cached_copy, start=start, parser=new_parser())
+    if refresh:
+        REFRESH_URLS.append(url)
+    return domains
+
+
+def format_age(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return '%dd %dh' % (days, hours)
+    if hours:
+        return '%dh %dm' % (hours, minutes)
+    return '%dm %ds' % (minutes, seconds)
+
+
+def refresh_in_background(urls, *,
+                          cache_expire: int = CACHE_EXPIRE,
+                          timeout: int = FETCH_TIMEOUT,
+                          jobs: int = FETCH_JOBS,
+                          ) -> None:
+    # a detached "dnsgate cache warm" downloads the urls after this process
+    # is gone, the next generate finds them fresh
+    command = [sys.executable, '-m', 'dnsgate', 'cache', 'warm',
+               '--cache-expire', str(cache_expire),
+               '--fetch-timeout', str(timeout),
+               '--fetch-jobs', str(jobs),]
+    for url in urls:
+        command += ['--source', url]
+    leprint("Refreshing %d stale sources in the background.", len(urls), level=LOG['INFO'])
+    subprocess.Popen(command,
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     start_new_session=True,)
+
+
+def fetch_domains_from_url(*,
+                           url: str,
+                           no_cache: bool = False,
+                           cache_expire: int = CACHE_EXPIRE,
+                           timeout: int = FETCH_TIMEOUT,
+                           parse_pool: Optional[ParsePool] = None,
+                           ) -> ValidatedDomains:
+    # the list is parsed chunk by chunk while it downloads or is read
+    # back from the cache, it is never held in memory as a whole
+    source_stats = STATS.source(url)
+    start = time.perf_counter()
+    new_parser = parse_pool.parser if parse_pool else HostsParser
+    if no_cache:
+        parser = new_parser()
+        download = download_url(url=url, timeout=timeout, consume=parser.feed)
+        domains = parser.close()
+        source_stats.update(cache='disabled',
+                            bytes_downloaded=download.size,
+                            domains=len(domains),
+                            seconds=round(time.perf_counter() - start, 6),)
+        return domains
+
+    cached_copy = get_matching_cached_file(url)
+    validators = {}
+    if cached_copy:
+        if not cached_copy_is_expired(cached_copy, cache_expire=cache_expire):
+            leprint("Using cached copy: %s", cached_copy, level=LOG['INFO'])
+            source_stats.update(cache='fresh')
+            return get_domains_from_cached_copy(url=url, cached_copy=cached_copy, start=start, parser=new_parser())
+        validators = CACHE_INDEX.validators(url)
+
+    parser = new_parser()
+    download = download_url_to_cache(url=url, timeout=timeout, consume=parser.feed, **validators)
+    if download.not_modified:
+        # the server confirmed the expired copy is current, so only
+        # its timestamp moves forward
+        leprint("Not modified, refreshing cached copy: %s", cached_copy, level=LOG['INFO'])
+        os.utime(cached_copy)
+        source_stats.update(cache='not_modified')
+        parser.close()  # nothing was fed, only collects a pooled parser
+        return get_domains_from_cached_copy(url=url, cached_copy=cached_copy, start=start, parser=new_parser())
+
+    domains = parser.close()
+    write_domain_file(path=generate_parsed_cache_file_name(url), domains=domains, tag=download.content_hash)
+    CACHE_INDEX.record_download(url, etag=download.etag, last_modified=download.last_modified)
+    source_stats.update(cache='downloaded',
+                        bytes_downloaded=download.size,
+                        parsed_cache='miss',
+                        domains=len(domains),
+                        seconds=round(time.perf_counter() - start, 6),)
+    return domains
+
 
+def get_domains_from_cached_copy(*,
+                                 url: str,
+                                 cached_copy,
+                                 start: float,
+                                 parser,
+                                 ) -> ValidatedDomains:
+    # the parsed set is only reused if it was extracted from exactly these bytes
+    source_stats = STATS.source(url)
+    content_hash = hash_file_chunks(cached_copy)
+    parsed_copy = generate_parsed_cache_file_name(url)
+    try:
+        parsed_copy_hash = read_domain_file_tag(parsed_copy)
+        if parsed_copy_hash == content_hash:
+            _, domains = read_domain_file(parsed_copy, set_type=ValidatedDomains)
+            leprint("Using parsed cached copy: %s", parsed_copy, level=LOG['DEBUG'])
+            CACHE_INDEX.touch(url)
+            source_stats.update(parsed_cache='hit', domains=len(domains), seconds=round(time.perf_counter() - start, 6))
+            return domains
+    except (FileNotFoundError, DomainFileError):
+        pass
+
+    domains = parse_hosts_chunks(read_file_chunks(cached_copy), parser=parser)
+    write_domain_file(path=parsed_copy, domains=domains, tag=content_hash)
+    CACHE_INDEX.touch(url)
+    source_stats.update(parsed_cache='miss', domains=len(domains), seconds=round(time.perf_counter() - start, 6))
+    return domains
+
+
+def hash_file_chunks(path) -> str:
+    content_hash = hashlib.sha1()
+    for chunk in read_file_chunks(path):
+        content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def iter_domains_from_urls(*,
+                           urls,
+                           no_cache: bool = False,
+                           cache_expire: int = CACHE_EXPIRE,
+                           jobs: int = FETCH_JOBS,
+                           timeout: int = FETCH_TIMEOUT,
+                           parse_pool: Optional[ParsePool] = None,
+                           stale: str = 'never',
+                           stale_deadline: int = STALE_DEADLINE,
+                           ):
+    # yields (url, domains or None) as they complete. A url is only
+    # submitted once a previous result was taken, so at most `jobs` parsed
+    # sources exist at a time if the caller drops each one after using it
+    jobs = max(1, jobs)
+    urls = iter(urls)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+
+        def submit(url):
+            future = executor.submit(get_domains_from_url,
+                                     url=url,
+                                     no_cache=no_cache,
+                                     cache_expire=cache_expire,
+                                     timeout=timeout,
+                                     parse_pool=parse_pool,
+                                     stale=stale,
+                                     stale_deadline=stale_deadline,)
+            futures[future] = url
+
+        for url in islice(urls, jobs):
+            submit(url)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = futures.pop(future)
+                try:
+                    domains = future.result()
+                except (requests.exceptions.RequestException, OSError) as e:
+                    leprint("Fetching %s failed: %s", url, e, level=LOG['DEBUG'])
+                    STATS.source(url).update(cache='failed')
+                    domains = None
+                except (HostsParseError, BrokenProcessPool) as e:
+                    leprint("WARNING: Parsing %s failed, skipping it: %r", url, e, level=LOG['WARNING'])
+                    STATS.source(url).update(cache='failed')
+                    domains = None
+                for next_url in islice(urls, 1):
+                    submit(next_url)
+                yield url, domains
+                del domains
+
+
+def download_url(*,
+                 url: str,
+                 consume,
+                 timeout: int = FETCH_TIMEOUT,
+                 etag: Optional[str] = None,
+                 last_modified: Optional[str] = None,
+                 ) -> Download:
+    # the body is handed to consume() chunk by chunk as it arrives.
+    # timeout applies to the whole transfer, not just to each socket read,
+    # so a mirror that trickles bytes can not hold up the fetch stage
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    if headers:
+        leprint("Revalidating: %s", url, level=LOG['INFO'])
+    else:
+        leprint("Downloading: %s", url, level=LOG['INFO'])
+
+    deadline = time.monotonic() + timeout
+    size = 0
+    content_hash = hashlib.sha1()
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return Download(size=0,
+                            content_hash=None,
+                            etag=etag,
+                            last_modified=last_modified,
+                            not_modified=True,)
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+            size += len(chunk)
+            content_hash.update(chunk)
+            consume(chunk)
+            if time.monotonic() > deadline:
+                raise FetchTimeoutError(url)
+        return Download(size=size,
+                        content_hash=content_hash.hexdigest(),
+                        etag=response.headers.get('ETag'),
+                        last_modified=response.headers.get('Last-Modified'),
+                        not_modified=False,)
+
+
+def download_url_to_cache(*,
+                          url: str,
+                          consume,
+                          timeout: int = FETCH_TIMEOUT,
+                          etag: Optional[str] = None,
+                          last_modified: Optional[str] = None,
+                          ) -> Download:
+    # the cached copy is written as the body arrives and only renamed into
+    # place once the transfer completed, a 304 leaves the old copy alone
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    file_name = generate_cache_file_name(url)
+    # per process, a background refresh may be downloading the same url
+    tmp_file_name = file_name.with_name(file_name.name + '.%d.tmp' % os.getpid())
+
+    def write_and_consume(chunk):
+        fh.write(chunk)
+        consume(chunk)
+
+    try:
+        with open(tmp_file_name, 'wb') as fh:
+            download = download_url(url=url,
+                                    consume=write_and_consume,
+                                    timeout=timeout,
+                                    etag=etag,
+                                    last_modified=last_modified,)
+        if download.not_modified:
+            os.remove(tmp_file_name)
+            return download
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        try:
+            os.remove(tmp_file_name)
+        except FileNotFoundError:
+            pass
+        raise
+    return download
+
+
+def generate_cache_file_name(url):
+    return cache_entry_files(cache_key(url))[0]
 
-def get_cached_url_copy(url: str, *,
-                        cache_expire: int = CACHE_EXPIRE,
-                        ) -> str:
 
-    newest_copy = get_matching_cached_file(url)
-    if newest_copy:
-        newest_copy_timestamp = os.stat(newest_copy).st_mtime
-        expiration_timestamp = int(newest_copy_timestamp) + int(cache_expire)
-        if expiration_timestamp > time.time():
-            return newest_copy
+def generate_parsed_cache_file_name(url):
+    return cache_entry_files(cache_key(url))[1]
 
-        os.rename(newest_copy, newest_copy + '.expired')
 
-    raise CachedCopyNotFoundError(url)
+def cached_copy_is_expired(cached_copy, *,
+                           cache_expire: int = CACHE_EXPIRE,
+                           ) -> bool:
+    cached_copy_timestamp = os.stat(cached_copy).st_mtime
+    expiration_timestamp = int(cached_copy_timestamp) + int(cache_expire)
+    return expiration_timestamp <= time.time()
 
 
 def get_matching_cached_file(url):
     name = generate_cache_file_name(url)
-    matching_cached_file = glob.glob(name)
-    if matching_cached_file:
-        return matching_cached_file[0]
+    if os.path.exists(name):
+        return name
     return False
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# On-disk index of the remote source cache.
+#
+# Every cached url has two files in CACHE_DIRECTORY, named after the hash
+# of the url: <key>_hosts (the list as downloaded) and <key>_domains (its
+# parsed copy). CACHE_INDEX_FILE is a JSON object with one entry per key:
+#
+#   url            the source
+#   size           bytes of both files
+#   fetched        time of the last download
+#   used           time it was last read by generate or "dnsgate cache warm"
+#   etag           validators for the next conditional download
+#   last_modified
+#
+# It replaces the per-url .meta files, which are read once and removed when
+# an older cache is first used. With it generate keeps CACHE_DIRECTORY under
+# cache_max_bytes: the least recently used entries are deleted after the
+# fetch stage until the rest fits. Files no entry owns (.meta and .expired
+# leftovers of older versions, .tmp files of downloads that died) are only
+# removed by "dnsgate cache prune".
+#
+# generate and a "dnsgate cache warm" run from cron can save the index at
+# the same time. A save takes a flock on <index>.lock, reads the index
+# again and replaces only the entries this process changed or removed
+# since its last save, so neither drops the other's downloads. The .tmp
+# file it writes is per pid.
+
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from hashtool import hash_str
+
+from .global_vars import CACHE_DIRECTORY
+from .global_vars import CACHE_INDEX_FILE
+from .global_vars import CACHE_STALE_TMP_AGE
+
+CACHE_ENTRY_SUFFIXES = ['_hosts', '_domains']
+CACHE_ENTRY_FILE = re.compile(r'^([0-9a-f]+)_(hosts|domains)')
+
+
+def cache_key(url: str) -> str:
+    return hash_str(url)
+
+
+def cache_entry_files(key: str) -> list:
+    return [CACHE_DIRECTORY / Path(key + suffix) for suffix in CACHE_ENTRY_SUFFIXES]
+
+
+def file_size(path: Path) -> int:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+class CacheIndex():
+    def __init__(self, path: Path = CACHE_INDEX_FILE):
+        self.path = Path(path)
+        self.entries = None     # loaded on first use
+        self.changed = set()    # keys set since the last save
+        self.removed = set()    # keys deleted since the last save
+        self.lock = threading.Lock()    # fetch threads update it concurrently
+
+    def read(self) -> dict:
+        try:
+            with open(self.path, 'r') as fh:
+                entries = json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            return {}   # rebuilt as sources are used
+        return entries if isinstance(entries, dict) else {}
+
+    def load(self) -> dict:
+        if self.entries is None:
+            self.entries = self.read()
+        return self.entries
+
+    def set(self, key: str, entry: dict) -> None:
+        self.entries[key] = entry
+        self.changed.add(key)
+        self.removed.discard(key)
+
+    def save(self) -> None:
+        # the caller holds the lock
+        os.makedirs(self.path.parent, exist_ok=True)
+        with open(self.path.with_name(self.path.name + '.lock'), 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            entries = self.read()
+            for key in self.removed:
+                entries.pop(key, None)
+            for key in self.changed:
+                entries[key] = self.entries[key]
+            tmp_path = self.path.with_name('%s.%d.tmp' % (self.path.name, os.getpid()))
+            with open(tmp_path, 'w') as fh:
+                json.dump(entries, fh, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        self.entries = entries
+        self.changed = set()
+        self.removed = set()
+
+    def items(self) -> list:
+        with self.lock:
+            return sorted(self.load().items(), key=lambda item: item[1]['used'], reverse=True)
+
+    def total_size(self) -> int:
+        with self.lock:
+            return sum(entry['size'] for entry in self.load().values())
+
+    def validators(self, url: str) -> dict:
+        with self.lock:
+            entry = self.load().get(cache_key(url))
+            if entry is None:
+                entry = self.adopt(url)
+                self.save()
+        if entry.get('url') != url:
+            return {}
+        return {'etag': entry.get('etag'), 'last_modified': entry.get('last_modified')}
+
+    def adopt(self, url: str) -> dict:
+        # a copy cached before the index existed, its validators are in the .meta file
+        key = cache_key(url)
+        hosts_file = cache_entry_files(key)[0]
+        meta_file = hosts_file.with_name(hosts_file.name + '.meta')
+        entry = {'url': url, 'etag': None, 'last_modified': None, 'used': time.time()}
+        try:
+            entry['fetched'] = os.stat(hosts_file).st_mtime
+            with open(meta_file, 'r') as fh:
+                meta = json.load(fh)
+            if meta.get('url') == url:
+                entry['etag'] = meta.get('etag')
+                entry['last_modified'] = meta.get('last_modified')
+        except (FileNotFoundError, ValueError):
+            pass
+        entry.setdefault('fetched', entry['used'])
+        entry['size'] = sum(file_size(path) for path in cache_entry_files(key))
+        self.set(key, entry)
+        try:
+            os.remove(meta_file)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def record_download(self, url: str, *,
+                        etag: Optional[str],
+                        last_modified: Optional[str],
+                        ) -> None:
+        key = cache_key(url)
+        now = time.time()
+        with self.lock:
+            self.load()
+            self.set(key, {'url': url,
+                           'size': sum(file_size(path) for path in cache_entry_files(key)),
+                           'fetched': now,
+                           'used': now,
+                           'etag': etag,
+                           'last_modified': last_modified,
+                           })
+            self.save()
+
+    def touch(self, url: str) -> None:
+        # the copy was read, its parsed copy may have been rewritten
+        key = cache_key(url)
+        with self.lock:
+            entry = self.load().get(key)
+            if entry is None:
+                entry = self.adopt(url)
+            entry['used'] = time.time()
+            entry['size'] = sum(file_size(path) for path in cache_entry_files(key))
+            self.set(key, entry)
+            self.save()
+
+    def remove(self, key: str) -> int:
+        # returns the bytes freed, the caller holds the lock
+        freed = 0
+        for path in cache_entry_files(key):
+            freed += file_size(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        del self.entries[key]
+        self.changed.discard(key)
+        self.removed.add(key)
+        return freed
+
+    def evict(self, max_bytes: int) -> tuple:
+        # least recently used first until the rest fits, max_bytes 0 is no cap,
+        # returns (entries removed, bytes freed)
+        if not max_bytes:
+            return 0, 0
+        removed = 0
+        freed = 0
+        with self.lock:
+            entries = self.load()
+            total = sum(entry['size'] for entry in entries.values())
+            for key, entry in sorted(entries.items(), key=lambda item: item[1]['used']):
+                if total <= max_bytes:
+                    break
+                total -= entry['size']
+                freed += self.remove(key)
+                removed += 1
+            if removed:
+                self.save()
+        return removed, freed
+
+    def clear(self) -> tuple:
+        with self.lock:
+            entries = self.load()
+            removed = len(entries)
+            freed = sum(self.remove(key) for key in list(entries))
+            self.save()
+        return removed, freed
+
+    def orphan_files(self) -> list:
+        # cache files no entry owns, .tmp files only once no download can
+        # still be writing them
+        with self.lock:
+            owned = {path.name for key in self.load() for path in cache_entry_files(key)}
+        orphans = []
+        try:
+            names = os.listdir(CACHE_DIRECTORY)
+        except FileNotFoundError:
+            return orphans
+        for name in names:
+            if not CACHE_ENTRY_FILE.match(name) or name in owned:
+                continue
+            path = CACHE_DIRECTORY / Path(name)
+            if name.endswith('.tmp'):
+                try:
+                    if os.stat(path).st_mtime > time.time() - CACHE_STALE_TMP_AGE:
+                        continue
+                except FileNotFoundError:
+                    continue
+            orphans.append(path)
+        return orphans
+
+
+CACHE_INDEX = CacheIndex()
@@ -4,6 +4,7 @@
 
 from typing import Optional
 
+from .global_vars import CACHE_MAX_BYTES
 from .global_vars import DNSMASQ_CONFIG_INCLUDE_DIRECTORY
 
 
@@ -11,6 +12,10 @@ class DnsgateConfig():
     def __init__(self, *,
                  mode: Optional[str] = None,
                  dnsmasq_config_file: Optional[str] = None,
+                 dnsmasq_reload: str = 'restart',
+                 output_format: Optional[str] = None,
+                 output_shards: int = 0,
+                 cache_max_bytes: int = CACHE_MAX_BYTES,
                  backup: bool = False,
                  no_restart_dnsmasq: bool = False,
                  block_at_psl: bool = False,
@@ -22,6 +27,10 @@ class DnsgateConfig():
         self.no_restart_dnsmasq = no_restart_dnsmasq
         self.backup = backup
         self.dnsmasq_config_file = dnsmasq_config_file
+        self.dnsmasq_reload = dnsmasq_reload
+        self.output_format = output_format
+        self.output_shards = output_shards
+        self.cache_max_bytes = cache_max_bytes
         self.block_at_psl = block_at_psl
         self.dest_ip = dest_ip
         self.sources = sources
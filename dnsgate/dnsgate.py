@@ -36,11 +36,11 @@ __version__ = "0.0.1"
 
 import ast
 import configparser
-import copy
 import os
 import shutil
 import sys
 import time
+from functools import partial
 from pathlib import Path
 from typing import Optional
 
@@ -57,21 +57,22 @@ from pathtool import is_unbroken_symlink
 from pathtool import uncomment_line_in_file
 from pathtool import write_line_to_file
 from stringtool import contains_whitespace
-from urltool import extract_domain_set_from_dnsgate_format_file
-from urltool import extract_psl_domain
-from urltool import group_by_tld
-from urltool import prune_redundant_rules
-from urltool import strip_to_psl
-from urltool import validate_domain_list
-
-from .cache import get_domains_from_url
+
 from .config import DnsgateConfig
 from .config import dnsmasq_config_file_line
+from .dnsmasq import DNSMASQ_LAYOUT_FORMATS
+from .dnsmasq import DNSMASQ_RELOAD_MODES
+from .dnsmasq import apply_dnsmasq_changes
+from .dnsmasq import dnsmasq_include_is_stale
+from .dnsmasq import dnsmasq_layout
+from .dnsmasq import point_active_symlink
+from .dnsmasq import write_dnsmasq_include
 from .file_headers import make_custom_blacklist_header
 from .file_headers import make_custom_whitelist_header
 from .file_headers import make_output_file_header
 from .global_vars import CACHE_DIRECTORY
 from .global_vars import CACHE_EXPIRE
+from .global_vars import CACHE_MAX_BYTES
 from .global_vars import CONFIG_DIRECTORY
 from .global_vars import CONFIG_FILE
 from .global_vars import CUSTOM_BLACKLIST
@@ -80,49 +81,279 @@ from .global_vars import DEFAULT_REMOTE_BLACKLISTS
 from .global_vars import DNSMASQ_CONFIG_FILE
 from .global_vars import DNSMASQ_CONFIG_INCLUDE_DIRECTORY
 from .global_vars import DNSMASQ_CONFIG_SYMLINK
+from .global_vars import DNSMASQ_EMPTY_FILE
+from .global_vars import DNSMASQ_RELOAD_INCLUDE
+from .global_vars import FETCH_JOBS
+from .global_vars import FETCH_TIMEOUT
 from .global_vars import OUTPUT_FILE_PATH
+from .global_vars import PARSE_JOBS
+from .global_vars import RULE_INDEX_FILE
+from .global_vars import SERVE_CACHE_SIZE
+from .global_vars import SERVE_LISTEN_ADDRESS
+from .global_vars import SERVE_PORT
+from .global_vars import SERVE_UPSTREAM_PORT
+from .global_vars import STALE_DEADLINE
+from .global_vars import STALE_POLICIES
+from .global_vars import STALE_POLICY
 from .help import BACKUP_HELP
 from .help import BLACKLIST_HELP
 from .help import BLOCK_AT_PSL_HELP
 from .help import BLOCKALL_HELP
 from .help import CACHE_EXPIRE_HELP
+from .help import CACHE_HELP
+from .help import CACHE_LIST_HELP
+from .help import CACHE_MAX_BYTES_HELP
+from .help import CACHE_PRUNE_ALL_HELP
+from .help import CACHE_PRUNE_HELP
+from .help import CACHE_WARM_HELP
+from .help import CACHE_WARM_SOURCE_HELP
+from .help import COMPACT_HELP
 from .help import CONFIGURE_HELP
 from .help import DEST_IP_HELP
 from .help import DISABLE_HELP
 from .help import DNSMASQ_CONFIG_HELP
+from .help import DNSMASQ_RELOAD_HELP
+from .help import DOMAINS_FILE_HELP
 from .help import ENABLE_HELP
+from .help import FETCH_JOBS_HELP
+from .help import FETCH_TIMEOUT_HELP
+from .help import FORCE_WRITE_HELP
+from .help import FULL_HELP
 from .help import GENERATE_HELP
 from .help import INSTALL_HELP_HELP
+from .help import LOCAL_ONLY_HELP
 from .help import NO_CACHE_HELP
+from .help import NO_GENERATE_HELP
+from .help import NO_PSL_CACHE_HELP
 from .help import NO_RESTART_DNSMASQ_HELP
 from .help import OUTPUT_FILE_HELP
+from .help import OUTPUT_FORMAT_HELP
+from .help import OUTPUT_SHARDS_HELP
+from .help import PARSE_JOBS_HELP
+from .help import REENABLE_HELP
+from .help import REENABLE_WAIT_HELP
+from .help import SERVE_CACHE_SIZE_HELP
+from .help import SERVE_HELP
+from .help import SERVE_LISTEN_HELP
+from .help import SERVE_PORT_HELP
+from .help import SERVE_UPSTREAM_HELP
+from .help import SERVE_UPSTREAM_PORT_HELP
+from .help import STALE_DEADLINE_HELP
+from .help import STALE_HELP
+from .help import STATS_JSON_HELP
+from .help import STATS_PROMETHEUS_HELP
 from .help import VERBOSE_HELP
 from .help import WHITELIST_HELP
 from .help import dnsmasq_install_help
 from .help import hosts_install_help
-
-
-#  todo, check return code, run disable() and try again if the service fails
-def restart_dnsmasq_service():
-    if os.path.lexists('/etc/init.d/dnsmasq'):
-        os.system('/etc/init.d/dnsmasq restart 1>&2')
-    else:
-        os.system('systemctl restart dnsmasq 1>&2')  # untested
-    return True
+from .output import OUTPUT_FORMATS
+from .output import ROOT_DOMAIN
+from .output import OutputFormatError
+from .output import comment_header
+from .output import config_output_format
+from .output import output_fingerprint
+from .output import read_output_fingerprint
+from .output import shard_directory
+from .output import write_output
+from .output import write_output_shards
+from .reenable import cancel_reenable
+from .reenable import reenable_is_due
+from .reenable import reenable_lock
+from .reenable import schedule_reenable
+from .reenable import wait_for_reenable_deadline
+
+# urltool (tldextract), requests, multiprocessing and asyncio are most of
+# the startup time, they are imported by the commands that use them
+# (generate, serve) so enable, disable and the rule file edits start fast.
+# So are the modules only generate, serve and dnsgate cache use (the cache
+# index, the rule index, stats, packed sets, the trie). output stays, its
+# OUTPUT_FORMATS are the choices of configure --output-format.
+
+
+def apply_dnsmasq_changes_or_exit(config, *,
+                                  restart: bool = False,
+                                  ) -> None:
+    if not apply_dnsmasq_changes(config, restart=restart):
+        leprint("ERROR: dnsmasq did not come back, check its log. Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
 
 
 def append_to_local_rule_file(*,
                               path: Path,
-                              idn: str,
+                              idns,
                               verbose: bool,
                               debug: bool,
                               ) -> None:
 
-    leprint("attempting to append %s to %s", idn, path, level=LOG['INFO'])
-    hostname = idn.encode('idna').decode('ascii')
-    leprint("appending hostname: %s to %s", hostname, path, level=LOG['DEBUG'])
-    line = hostname + '\n'
-    write_line_to_file(line=line, path=path, verbose=verbose, debug=debug)
+    # one open() and write() for the whole batch
+    lines = []
+    for idn in idns:
+        leprint("attempting to append %s to %s", idn, path, level=LOG['INFO'])
+        hostname = idn.encode('idna')
+        leprint("appending hostname: %s to %s", hostname.decode('ascii'), path, level=LOG['DEBUG'])
+        lines.append(hostname + b'\n')
+    if lines:
+        with open(path, 'ab+') as fh:
+            # the headers configure writes end without a newline, the first
+            # hostname would be appended to the last comment line
+            if fh.seek(0, os.SEEK_END):
+                fh.seek(-1, os.SEEK_END)
+                if fh.read(1) != b'\n':
+                    lines.insert(0, b'\n')
+            fh.write(b''.join(lines))
+
+
+def read_domains_argument(*,
+                          domains: Optional[tuple],
+                          domains_file,
+                          ) -> list:
+    idns = list(domains) if domains else []
+    if domains_file:
+        for line in domains_file:
+            line = line.split('#')[0].strip()
+            if line:
+                idns.append(line)
+    return idns
+
+
+def load_dnsmasq_settings(config) -> tuple:
+    # (dnsmasq_config_file, dnsmasq_reload) of mode = dnsmasq, the config
+    # file is a lazy click file, nothing is opened until it is written
+    try:
+        dnsmasq_config_file = \
+            click.open_file(config['DEFAULT']['dnsmasq_config_file'],
+            'w', atomic=True, lazy=True)
+    except KeyError:
+        leprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " + CONFIG_FILE.as_posix() + " but dnsmasq_config_file is not set. run 'dnsgate configure --help' to fix. Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+
+    dnsmasq_reload = config['DEFAULT'].get('dnsmasq_reload', 'restart')
+    if dnsmasq_reload not in DNSMASQ_RELOAD_MODES:
+        leprint("ERROR: dnsmasq_reload in " + CONFIG_FILE.as_posix() + " must be one of: " + ', '.join(DNSMASQ_RELOAD_MODES) + ". Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+    return dnsmasq_config_file, dnsmasq_reload
+
+
+def load_config(*,
+                no_restart_dnsmasq: bool,
+                backup: bool,
+                light: bool = False,
+                ) -> DnsgateConfig:
+    # light only reads the mode, dest_ip, output and the dnsmasq settings,
+    # for the commands that need no more (see LIGHT_COMMANDS): the sources
+    # are not parsed and the output format is not checked
+    config = configparser.ConfigParser()
+    try:
+        with open(CONFIG_FILE, 'r') as cf:
+            config.read_file(cf)
+    except FileNotFoundError:
+        leprint("No configuration file found, run " + "\"dnsgate configure --help\". Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+
+    mode = config['DEFAULT']['mode']
+
+    try:
+        output_path = config['DEFAULT']['output']
+    except KeyError:
+        leprint('ERROR: ' + CONFIG_FILE.as_posix() + ' has no "output" defined. ' + "run 'dnsgate configure --help' to fix. Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+    assert isinstance(output_path, str)
+    if not os.path.exists(os.path.dirname(output_path)):
+        leprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " + CONFIG_FILE.as_posix() + " but dnsmasq_config_file is not set. " + "run 'dnsgate configure --help' to fix. Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+
+    block_at_psl = config['DEFAULT'].getboolean('block_at_psl')
+    dest_ip = config['DEFAULT']['dest_ip']  #  todo validate ip or False/None
+    if dest_ip in ('False', 'None', ''):
+        dest_ip = None
+    if light:
+        if mode == 'dnsmasq':
+            dnsmasq_config_file, dnsmasq_reload = load_dnsmasq_settings(config)
+            return DnsgateConfig(mode=mode,
+                                 block_at_psl=block_at_psl,
+                                 dest_ip=dest_ip,
+                                 no_restart_dnsmasq=no_restart_dnsmasq,
+                                 dnsmasq_config_file=dnsmasq_config_file,
+                                 dnsmasq_reload=dnsmasq_reload,
+                                 backup=backup,
+                                 output=output_path,)
+        if not dest_ip:
+            dest_ip = '0.0.0.0'
+        return DnsgateConfig(mode=mode,
+                             block_at_psl=block_at_psl,
+                             dest_ip=dest_ip,
+                             no_restart_dnsmasq=no_restart_dnsmasq,
+                             backup=backup,
+                             output=output_path,)
+    sources = ast.literal_eval(config['DEFAULT']['sources'])  # configparser has no .getlist()?
+    output_format = config['DEFAULT'].get('output_format')
+    if output_format in ('False', 'None', ''):
+        output_format = None
+    try:
+        output_shards = config['DEFAULT'].getint('output_shards', 0)
+    except ValueError:
+        output_shards = -1
+    if output_shards < 0:
+        leprint("ERROR: output_shards in " + CONFIG_FILE.as_posix() + " must be a number >= 0. Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+    try:
+        cache_max_bytes = config['DEFAULT'].getint('cache_max_bytes', CACHE_MAX_BYTES)
+    except ValueError:
+        cache_max_bytes = -1
+    if cache_max_bytes < 0:
+        leprint("ERROR: cache_max_bytes in " + CONFIG_FILE.as_posix() + " must be a number >= 0. Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+    if mode == 'dnsmasq':
+        dnsmasq_config_file, dnsmasq_reload = load_dnsmasq_settings(config)
+        dnsmasq_config_file.close()  # it exists and is writeable
+
+        dnsgate_config = DnsgateConfig(mode=mode,
+                                       block_at_psl=block_at_psl,
+                                       dest_ip=dest_ip,
+                                       no_restart_dnsmasq=no_restart_dnsmasq,
+                                       dnsmasq_config_file=dnsmasq_config_file,
+                                       dnsmasq_reload=dnsmasq_reload,
+                                       output_format=output_format,
+                                       output_shards=output_shards,
+                                       cache_max_bytes=cache_max_bytes,
+                                       backup=backup,
+                                       sources=sources,
+                                       output=output_path,)
+        # enable links the output where dnsmasq reads it, in any other
+        # format dnsmasq would not start again
+        layout_format = DNSMASQ_LAYOUT_FORMATS[dnsmasq_layout(dnsgate_config)]
+        if output_format not in (None, layout_format):
+            leprint("ERROR: mode = dnsmasq with dnsmasq_reload = " + dnsmasq_reload + " needs output_format " + layout_format + " (or none) in " + CONFIG_FILE.as_posix() + ", use mode = hosts to write " + output_format + ". Exiting.", level=LOG['ERROR'])
+            sys.exit(1)
+        if dnsmasq_reload == 'sighup' and dest_ip:
+            # addn-hosts would only block the exact names, not what is under them
+            leprint("ERROR: dnsmasq_reload = sighup writes a servers-file, which can only return NXDOMAIN. Unset dest_ip or use dnsmasq_reload = restart in " + CONFIG_FILE.as_posix() + ". Exiting.", level=LOG['ERROR'])
+            sys.exit(1)
+    else:
+        if not dest_ip:
+            dest_ip = '0.0.0.0'
+        dnsgate_config = DnsgateConfig(mode=mode,
+                                       block_at_psl=block_at_psl,
+                                       dest_ip=dest_ip,
+                                       no_restart_dnsmasq=no_restart_dnsmasq,
+                                       output_format=output_format,
+                                       output_shards=output_shards,
+                                       cache_max_bytes=cache_max_bytes,
+                                       backup=backup,
+                                       sources=sources,
+                                       output=output_path,)
+
+    try:
+        output = config_output_format(dnsgate_config)
+    except OutputFormatError as e:
+        leprint("ERROR: " + str(e) + " (" + CONFIG_FILE.as_posix() + "). Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+    if output_shards and (not output.include_line or dnsmasq_layout(dnsgate_config) != 'conf-dir'):
+        leprint("ERROR: output_shards needs output_format dnsmasq or unbound and dnsmasq_reload = restart in " + CONFIG_FILE.as_posix() + ". Exiting.", level=LOG['ERROR'])
+        sys.exit(1)
+
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    return dnsgate_config
 
 
 # https://github.com/mitsuhiko/click/issues/441
@@ -130,6 +361,16 @@ CONTEXT_SETTINGS = \
     dict(help_option_names=['--help'],
          terminal_width=shutil.get_terminal_size((80, 20)).columns)
 
+# commands that run on load_config(light=True), whitelist and blacklist
+# load the rest before they run generate. enable, disable and reenable
+# only link or unlink the output and restart or signal dnsmasq
+LIGHT_COMMANDS = ('enable', 'disable', 'reenable', 'whitelist', 'blacklist', 'install-help', 'serve')
+
+# commands that first catch up on a timed disable whose helper did not
+# survive. enable and disable replace the timed disable themselves, every
+# other command leaves it to dnsgate reenable
+REENABLE_CATCH_UP_COMMANDS = ('generate',)
+
 
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.option('--no-restart-dnsmasq',
@@ -150,93 +391,57 @@ def dnsgate(ctx, no_restart_dnsmasq, backup):
     remote DNS blacklists. Use \"dnsgate (command) --help\"
     for more information.
     """
-    config = configparser.ConfigParser()
-    if 'dnsgate configure' not in ' '.join(sys.argv):
-        if 'dnsgate.py configure' not in ' '.join(sys.argv):
-            try:
-                with open(CONFIG_FILE, 'r') as cf:
-                    config.read_file(cf)
-            except FileNotFoundError:
-                leprint("No configuration file found, run " + "\"dnsgate configure --help\". Exiting.", level=LOG['ERROR'])
-                sys.exit(1)
-
-            mode = config['DEFAULT']['mode']
-
-            try:
-                output_path = config['DEFAULT']['output']
-            except KeyError:
-                leprint('ERROR: ' + CONFIG_FILE.as_posix() + ' has no "output" defined. ' + "run 'dnsgate configure --help' to fix. Exiting.", level=LOG['ERROR'])
-                sys.exit(1)
-            assert isinstance(output_path, str)
-            if not os.path.exists(os.path.dirname(output_path)):
-                leprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " + CONFIG_FILE.as_posix() + " but dnsmasq_config_file is not set. " + "run 'dnsgate configure --help' to fix. Exiting.", level=LOG['ERROR'])
-                sys.exit(1)
-
-            block_at_psl = config['DEFAULT'].getboolean('block_at_psl')
-            dest_ip = config['DEFAULT']['dest_ip']  #  todo validate ip or False/None
-            if dest_ip == 'False':
-                dest_ip = None
-            sources = ast.literal_eval(config['DEFAULT']['sources'])  # configparser has no .getlist()?
-            if mode == 'dnsmasq':
-                try:
-                    dnsmasq_config_file = \
-                        click.open_file(config['DEFAULT']['dnsmasq_config_file'],
-                        'w', atomic=True, lazy=True)
-                    dnsmasq_config_file.close()  # it exists and is writeable
-                except KeyError:
-                    leprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " + CONFIG_FILE.as_posix() + " but dnsmasq_config_file is not set. run 'dnsgate configure --help' to fix. Exiting.", level=LOG['ERROR'])
-                    sys.exit(1)
-
-                ctx.obj = DnsgateConfig(mode=mode,
-                                        block_at_psl=block_at_psl,
-                                        dest_ip=dest_ip,
-                                        no_restart_dnsmasq=no_restart_dnsmasq,
-                                        dnsmasq_config_file=dnsmasq_config_file,
-                                        backup=backup,
-                                        sources=sources,
-                                        output=output_path,)
-            else:
-                if not dest_ip:
-                    dest_ip = '0.0.0.0'
-                ctx.obj = DnsgateConfig(mode=mode,
-                                        block_at_psl=block_at_psl,
-                                        dest_ip=dest_ip,
-                                        no_restart_dnsmasq=no_restart_dnsmasq,
-                                        backup=backup,
-                                        sources=sources,
-                                        output=output_path,)
-
-            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    if ctx.invoked_subcommand == 'configure':
+        return
+    light = ctx.invoked_subcommand in LIGHT_COMMANDS
+    ctx.obj = load_config(no_restart_dnsmasq=no_restart_dnsmasq, backup=backup, light=light)
+
+    # a timed disable whose helper did not survive (killed, reboot)
+    if ctx.invoked_subcommand in REENABLE_CATCH_UP_COMMANDS and reenable_is_due():
+        leprint("The timed disable ran out, re-enabling.", level=LOG['INFO'])
+        ctx.invoke(enable)
 
 
 @dnsgate.command(help=WHITELIST_HELP)
-@click.argument('domains', required=True, nargs=-1)
+@click.argument('domains', required=False, nargs=-1)
+@click.option('--file', 'domains_file', type=click.File('r'), help=DOMAINS_FILE_HELP)
+@click.option('--no-generate', is_flag=True, help=NO_GENERATE_HELP)
 @click.option('--verbose', is_flag=True)
 @click.option('--debug', is_flag=True)
 def whitelist(domains: Optional[tuple],
+              domains_file,
+              no_generate: bool,
               verbose: bool,
               debug: bool,
               ) -> None:
-    if domains:
-        for domain in domains:
-            append_to_local_rule_file(path=CUSTOM_WHITELIST, idn=domain, verbose=verbose, debug=debug,)
-        context = click.get_current_context()
-        context.invoke(generate)
+    idns = read_domains_argument(domains=domains, domains_file=domains_file)
+    if idns:
+        append_to_local_rule_file(path=CUSTOM_WHITELIST, idns=idns, verbose=verbose, debug=debug,)
+        if not no_generate:
+            context = click.get_current_context()
+            context.obj = load_config(no_restart_dnsmasq=context.obj.no_restart_dnsmasq, backup=context.obj.backup)
+            context.invoke(generate, local_only=True)
 
 
 @dnsgate.command(help=BLACKLIST_HELP)
-@click.argument('domains', required=True, nargs=-1)
+@click.argument('domains', required=False, nargs=-1)
+@click.option('--file', 'domains_file', type=click.File('r'), help=DOMAINS_FILE_HELP)
+@click.option('--no-generate', is_flag=True, help=NO_GENERATE_HELP)
 @click.option('--verbose', is_flag=True)
 @click.option('--debug', is_flag=True)
 def blacklist(domains: Optional[tuple],
+              domains_file,
+              no_generate: bool,
               verbose: bool,
               debug: bool,
               ) -> None:
-    if domains:
-        for domain in domains:
-            append_to_local_rule_file(path=CUSTOM_BLACKLIST, idn=domain, verbose=verbose, debug=debug,)
-        context = click.get_current_context()
-        context.invoke(generate)
+    idns = read_domains_argument(domains=domains, domains_file=domains_file)
+    if idns:
+        append_to_local_rule_file(path=CUSTOM_BLACKLIST, idns=idns, verbose=verbose, debug=debug,)
+        if not no_generate:
+            context = click.get_current_context()
+            context.obj = load_config(no_restart_dnsmasq=context.obj.no_restart_dnsmasq, backup=context.obj.backup)
+            context.invoke(generate, local_only=True)
 
 
 @dnsgate.command(help=INSTALL_HELP_HELP)
@@ -262,6 +467,7 @@ def enable(config,
            debug: bool,
            ) -> None:
     if config.mode == 'dnsmasq':
+        cancel_reenable()   # a pending timed re-enable has nothing left to do
         if not file_exists_nonzero(OUTPUT_FILE_PATH):
             leprint('ERROR: %s does not exist, run "dnsgate generate" to fix. Exiting.', OUTPUT_FILE_PATH, level=LOG['ERROR'])
             sys.exit(1)
@@ -272,12 +478,28 @@ def enable(config,
             if 'mode: dnsmasq' not in file_content:
                 leprint('ERROR: %s was not generated in dnsmasq mode, run "dnsgate generate --help" to fix. Exiting.', OUTPUT_FILE_PATH, level=LOG['ERROR'])
                 sys.exit(1)
+            # the light config does not check output_format, the file is checked instead
+            layout_format = DNSMASQ_LAYOUT_FORMATS[dnsmasq_layout(config)]
+            if 'output_format: ' + layout_format + '\n' not in file_content:
+                leprint('ERROR: %s is not in the %s format dnsmasq_reload = %s needs, run "dnsgate generate" to fix. Exiting.', OUTPUT_FILE_PATH, layout_format, config.dnsmasq_reload, level=LOG['ERROR'])
+                sys.exit(1)
 
         dnsmasq_config_line = dnsmasq_config_file_line()
         if not uncomment_line_in_file(path=config.dnsmasq_config_file, line=dnsmasq_config_line, verbose=verbose, debug=debug,):
             write_line_to_file(line=dnsmasq_config_line, path=config.dnsmasq_config_file.name, unique=True, verbose=verbose, debug=debug,)
 
         config.dnsmasq_config_file.close()
+        if dnsmasq_layout(config) != 'conf-dir':
+            # the include is written once, after that enable/disable only swap
+            # the file it points at and signal dnsmasq
+            point_active_symlink(OUTPUT_FILE_PATH)
+            restart = write_dnsmasq_include(config)
+            if os.path.islink(DNSMASQ_CONFIG_SYMLINK):
+                os.remove(DNSMASQ_CONFIG_SYMLINK)   # left from dnsmasq_reload = restart
+                restart = True
+            apply_dnsmasq_changes_or_exit(config, restart=restart)
+            return
+
         symlink = DNSMASQ_CONFIG_SYMLINK
         if not os.path.islink(symlink): # not a symlink
             if os.path.exists(symlink): # but exists
@@ -292,7 +514,9 @@ def enable(config,
             except FileNotFoundError:
                 pass    # that's ok
             create_relative_symlink(target=OUTPUT_FILE_PATH, link_name=symlink, verbose=verbose, debug=debug,)
-        restart_dnsmasq_service()
+        if os.path.exists(DNSMASQ_RELOAD_INCLUDE):
+            os.remove(DNSMASQ_RELOAD_INCLUDE)   # left from dnsmasq_reload = sighup
+        apply_dnsmasq_changes_or_exit(config, restart=True)
     else:
         leprint("ERROR: enable is only available with --mode dnsmasq. Exiting.", level=LOG['ERROR'])
         sys.exit(1)
@@ -312,7 +536,10 @@ def disable(ctx,
     '''TIMEOUT: re-enable after n seconds'''
 
     config = ctx.obj
-    if config.mode == 'dnsmasq':
+    if config.mode == 'dnsmasq' and dnsmasq_layout(config) != 'conf-dir':
+        point_active_symlink(DNSMASQ_EMPTY_FILE)
+        apply_dnsmasq_changes_or_exit(config)
+    elif config.mode == 'dnsmasq':
         comment_out_line_in_file(path=config.dnsmasq_config_file, line=dnsmasq_config_file_line(), verbose=verbose, debug=debug,)
         config.dnsmasq_config_file.close()
         symlink = DNSMASQ_CONFIG_SYMLINK
@@ -322,15 +549,41 @@ def disable(ctx,
             if os.path.exists(symlink): # but exists
                 leprint("ERROR: " + symlink.as_posix() + " exists and is not a symlink. You need to manually delete it. Exiting.", level=LOG['ERROR'])
                 sys.exit(1)
-        restart_dnsmasq_service()
-        leprint("Sleepin %ss:", timeout)
-        time.sleep(timeout)
-        ctx.invoke(enable)
+        apply_dnsmasq_changes_or_exit(config)
     else:
         leprint("ERROR: disable is only available with --mode dnsmasq. Exiting.",
                level=LOG['ERROR'])
         sys.exit(1)
 
+    if timeout:
+        deadline = schedule_reenable(timeout)
+        leprint("Re-enabling at %s.", time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deadline)), level=LOG['INFO'])
+    else:
+        cancel_reenable()   # disabled until "dnsgate enable"
+
+
+@dnsgate.command(help=REENABLE_HELP)
+@click.option('--wait', is_flag=True, help=REENABLE_WAIT_HELP)
+@click.option('--verbose', is_flag=True)
+@click.option('--debug', is_flag=True)
+@click.pass_context
+def reenable(ctx,
+             wait: bool,
+             verbose: bool,
+             debug: bool,
+             ) -> None:
+    if wait:
+        with reenable_lock() as locked:
+            if not locked:
+                leprint("Another dnsgate reenable --wait is waiting already.", level=LOG['DEBUG'])
+                return
+            if not wait_for_reenable_deadline():
+                leprint("The timed disable was cancelled.", level=LOG['DEBUG'])
+                return
+    elif not reenable_is_due():
+        return
+    ctx.invoke(enable)
+
 
 @dnsgate.command(help=BLOCKALL_HELP)
 @click.option('--verbose', is_flag=True)
@@ -341,40 +594,52 @@ def blockall(config,
              debug: bool,
              ) -> None:
 
-    if config.mode == 'dnsmasq':
-        domains_combined = set(['.'])
-        write_output_file(config=config, domains_combined=domains_combined, verbose=verbose, debug=debug,)
-    else:
+    if config.mode != 'dnsmasq':
         leprint("ERROR: blockall is only available with --mode dnsmasq. Exiting.",
                level=LOG['ERROR'])
         sys.exit(1)
+    output = config_output_format(config)
+    if output.root_records is None:
+        leprint("ERROR: blockall can not be written in the %s output format. Exiting.",
+               output.name, level=LOG['ERROR'])
+        sys.exit(1)
+    write_output_file(config=config, domains_combined=[ROOT_DOMAIN], verbose=verbose, debug=debug,)
 
 
-@click.pass_obj
 def write_output_file(*,
                       config,
-                      domains_combined: set,
+                      domains_combined,
                       verbose: bool,
                       debug: bool,
+                      fingerprint: Optional[str] = None,
                       ):
     config_dict = make_config_dict(config)
-
-    leprint("Writing output file: %s in %s format", config.output, config.mode, level=LOG['INFO'])
+    if fingerprint is None:
+        fingerprint = output_fingerprint(config_dict=config_dict, domains=domains_combined)
+    output = config_output_format(config)
+
+    if config.output_shards:
+        directory = shard_directory(config.output)
+        leprint("Writing %d output shards: %s in %s format", config.output_shards, directory, output.name, level=LOG['INFO'])
+        count, rewritten = write_output_shards(directory, domains_combined,
+                                               output=output,
+                                               shards=config.output_shards,
+                                               config_dict=config_dict,
+                                               make_header=partial(make_output_file_header, config_dict),)
+        leprint("Rewrote %d of %d shards", rewritten, config.output_shards, level=LOG['INFO'])
+        # the file enable/disable link to, it only includes the shards
+        with click.open_file(config.output, 'wb', atomic=True, lazy=True) as fh:
+            fh.write(comment_header(make_output_file_header(config_dict, fingerprint), output.comment))
+            fh.write(output.include_line(directory.as_posix().encode('utf8')))
+        leprint("Wrote %d lines to %s", count, directory, level=LOG['DEBUG'])
+        return
+
+    leprint("Writing output file: %s in %s format", config.output, output.name, level=LOG['INFO'])
     with click.open_file(config.output, 'wb', atomic=True, lazy=True) as fh:
-        fh.write(make_output_file_header(config_dict))
-        for domain in domains_combined:
-            if config.mode == 'dnsmasq':
-                if config.dest_ip:
-                    dnsmasq_line = 'address=/.' + domain.decode('utf8') + '/' + config.dest_ip + '\n'
-                else:
-                    dnsmasq_line = 'server=/.' + domain.decode('utf8') + '/' '\n'  # return NXDOMAIN
-                fh.write(dnsmasq_line.encode('utf8'))
-            elif config.mode == 'hosts':
-                if config.dest_ip:
-                    hosts_line = config.dest_ip + ' ' + domain.decode('utf8') + '\n'
-                else:
-                    hosts_line = '127.0.0.1' + ' ' + domain.decode('utf8') + '\n'
-                fh.write(hosts_line.encode('utf8'))
+        count = write_output(fh, domains_combined,
+                             output=output,
+                             header=make_output_file_header(config_dict, fingerprint),)
+    leprint("Wrote %d lines to %s", count, config.output, level=LOG['DEBUG'])
 
 
 @dnsgate.command(help=CONFIGURE_HELP, short_help='write /etc/dnsgate/config')
@@ -394,6 +659,26 @@ def write_output_file(*,
               help=DNSMASQ_CONFIG_HELP,
               type=click.File(mode='w', atomic=True, lazy=True),
               default=DNSMASQ_CONFIG_FILE,)
+@click.option('--dnsmasq-reload',
+              is_flag=False,
+              help=DNSMASQ_RELOAD_HELP,
+              type=click.Choice(DNSMASQ_RELOAD_MODES),
+              default='restart',)
+@click.option('--output-format',
+              is_flag=False,
+              help=OUTPUT_FORMAT_HELP,
+              type=click.Choice(sorted(OUTPUT_FORMATS)),
+              default=None,)
+@click.option('--output-shards',
+              is_flag=False,
+              help=OUTPUT_SHARDS_HELP,
+              type=click.IntRange(min=0),
+              default=0,)
+@click.option('--cache-max-bytes',
+              is_flag=False,
+              help=CACHE_MAX_BYTES_HELP,
+              type=click.IntRange(min=0),
+              default=CACHE_MAX_BYTES,)
 @click.option('--output',
               is_flag=False,
               help=OUTPUT_FILE_HELP,
@@ -403,6 +688,10 @@ def configure(sources: Optional[tuple[str]],
               block_at_psl: bool,
               dest_ip: str,
               dnsmasq_config_file: Path,
+              dnsmasq_reload: str,
+              output_format: Optional[str],
+              output_shards: int,
+              cache_max_bytes: int,
               output: Path,
               ):
     if contains_whitespace(dnsmasq_config_file.name):
@@ -423,10 +712,17 @@ def configure(sources: Optional[tuple[str]],
             'sources': sources,
             'output': output
         }
+    if output_format:
+        config['DEFAULT']['output_format'] = output_format
+    if output_shards:
+        config['DEFAULT']['output_shards'] = str(output_shards)
+    if cache_max_bytes != CACHE_MAX_BYTES:
+        config['DEFAULT']['cache_max_bytes'] = str(cache_max_bytes)
 
     if mode == 'dnsmasq':
         os.makedirs(DNSMASQ_CONFIG_INCLUDE_DIRECTORY, exist_ok=True)
         config['DEFAULT']['dnsmasq_config_file'] = dnsmasq_config_file.name
+        config['DEFAULT']['dnsmasq_reload'] = dnsmasq_reload
 
     with open(CONFIG_FILE, 'w') as cf:
         config.write(cf)
@@ -439,17 +735,94 @@ def configure(sources: Optional[tuple[str]],
         with open(CUSTOM_WHITELIST, 'w') as fh: # not 'wb', utf8 is ok
             fh.write(make_custom_whitelist_header(CUSTOM_WHITELIST))
 
-@click.pass_obj
 def make_config_dict(config): #todo, just cat the config file
     config_dict = {
         'mode': config.mode,
         'sources': config.sources,
         'block_at_psl': config.block_at_psl,
         'dest_ip': config.dest_ip,
+        'dnsmasq_reload': config.dnsmasq_reload,
+        'output_format': config_output_format(config).name,
+        'output_shards': config.output_shards,
         'output': config.output
         }
     return config_dict
 
+
+def evict_cache(max_bytes: int) -> None:
+    from .cache_index import CACHE_INDEX
+    removed, freed = CACHE_INDEX.evict(max_bytes)
+    if removed:
+        leprint("Removed %d least recently used cached sources (%d bytes) to stay under cache_max_bytes = %d.",
+               removed, freed, max_bytes, level=LOG['INFO'])
+
+
+def read_custom_blacklist() -> set:
+    from urltool import extract_domain_set_from_dnsgate_format_file
+
+    from .validate import ValidatedDomains
+    from .validate import validated_domains
+    blacklist_file = os.path.abspath(CUSTOM_BLACKLIST)
+    try:
+        domains_blacklist = extract_domain_set_from_dnsgate_format_file(blacklist_file)
+    except FileNotFoundError:
+        domains_blacklist = ValidatedDomains()
+        leprint('WARNING: %s is missing, only the default remote sources ' +
+               'will be used. Run "dnsgate configure --help" to fix.',
+               CUSTOM_BLACKLIST, level=LOG['WARNING'])
+    else:
+        if domains_blacklist:
+            leprint("Got %s domains from the CUSTOM_BLACKLIST: %s",
+                   len(domains_blacklist), blacklist_file, level=LOG['DEBUG'])
+    return validated_domains(domains_blacklist)
+
+
+def build_rule_set(*,
+                   config,
+                   domains_combined_orig: set,
+                   domains_whitelist: set,
+                   domains_blacklist: set,
+                   ) -> tuple:
+    # the full pipeline, returns the remote rules (for the build state) and the final rules
+    #
+    # PSL stripping, whitelist carve-outs, re-adding subdomains and
+    # redundant-rule pruning all happen in a single pass over the remote
+    # domains: every domain maps to exactly one rule (its psl domain, itself,
+    # or nothing if whitelisted) and the trie drops rules a parent covers.
+    from .psl import remote_rules_at_psl
+    from .trie import DomainTrie
+    rule_trie = DomainTrie()
+    if config.block_at_psl:
+        leprint('Stripping %d blacklisted domains to PSL domains, keeping subdomains of whitelisted PSL domains.',
+               len(domains_combined_orig), level=LOG['INFO'])
+        domains_remote_rules = remote_rules_at_psl(domains_combined_orig, domains_whitelist)
+        leprint('%d blacklisted domains after stripping to PSL domains and re-adding non-whitelisted subdomains.',
+               len(domains_remote_rules), level=LOG['INFO'])
+    else:
+        # apply whitelist before applying local blacklist, exact whitelist
+        # matches are skipped on the way into the trie rather than copied out
+        # into a second set, the build state derives them again from R
+        domains_remote_rules = None
+        leprint("Subtracting the %d whitelisted domains from %d blacklisted domains",
+               len(domains_whitelist), len(domains_combined_orig), level=LOG['INFO'])
+    if domains_remote_rules is None:
+        rule_trie.update(domain for domain in domains_combined_orig if domain not in domains_whitelist)
+    else:
+        rule_trie.update(domains_remote_rules)
+
+    # must happen after subdomain stripping and after whitelist subtraction
+    if domains_blacklist: # ignore empty blacklist
+        leprint("Re-adding %d domains in the local blacklist %s to override the whitelist.",
+               len(domains_blacklist), CUSTOM_BLACKLIST, level=LOG['INFO'])
+        rule_trie.update(domains_blacklist)
+
+    domains_combined = set(rule_trie)
+    leprint('%d blacklisted domains after removing redundant rules.', len(domains_combined),
+           level=LOG['INFO'])
+
+    return domains_remote_rules, domains_combined
+
+
 @dnsgate.command(help=GENERATE_HELP)
 @click.option('--no-cache', is_flag=True, help=NO_CACHE_HELP)
 @click.option('--cache-expire',
@@ -457,163 +830,473 @@ def make_config_dict(config): #todo, just cat the config file
               help=CACHE_EXPIRE_HELP,
               type=int,
               default=CACHE_EXPIRE,)
+@click.option('--fetch-jobs',
+              is_flag=False,
+              help=FETCH_JOBS_HELP,
+              type=int,
+              default=FETCH_JOBS,)
+@click.option('--jobs',
+              is_flag=False,
+              help=PARSE_JOBS_HELP,
+              type=click.IntRange(min=1),
+              default=PARSE_JOBS,)
+@click.option('--fetch-timeout',
+              is_flag=False,
+              help=FETCH_TIMEOUT_HELP,
+              type=int,
+              default=FETCH_TIMEOUT,)
+@click.option('--stale',
+              is_flag=False,
+              help=STALE_HELP,
+              type=click.Choice(STALE_POLICIES),
+              default=STALE_POLICY,)
+@click.option('--stale-deadline',
+              is_flag=False,
+              help=STALE_DEADLINE_HELP,
+              type=click.IntRange(min=0),
+              default=STALE_DEADLINE,)
+@click.option('--full', is_flag=True, help=FULL_HELP)
+@click.option('--local-only', is_flag=True, help=LOCAL_ONLY_HELP)
+@click.option('--no-psl-cache', is_flag=True, help=NO_PSL_CACHE_HELP)
+@click.option('--force-write', is_flag=True, help=FORCE_WRITE_HELP)
+@click.option('--compact', is_flag=True, help=COMPACT_HELP)
+@click.option('--stats-json',
+              is_flag=False,
+              help=STATS_JSON_HELP,
+              type=click.Path(dir_okay=False, writable=True),
+              default=None,)
+@click.option('--stats-prometheus',
+              is_flag=False,
+              help=STATS_PROMETHEUS_HELP,
+              type=click.Path(dir_okay=False, writable=True),
+              default=None,)
 @click.option('--verbose', is_flag=True)
 @click.option('--debug', is_flag=True)
 @click.pass_obj
 def generate(config,
              no_cache: bool,
              cache_expire: int,
+             fetch_jobs: int,
+             jobs: int,
+             fetch_timeout: int,
+             stale: str,
+             stale_deadline: int,
+             full: bool,
+             local_only: bool,
+             no_psl_cache: bool,
+             force_write: bool,
+             compact: bool,
+             stats_json: Optional[str],
+             stats_prometheus: Optional[str],
              verbose: bool,
              debug: bool,
              ):
+    from urltool import extract_domain_set_from_dnsgate_format_file
+    from urltool import group_by_tld
+
+    from .cache import REFRESH_URLS
+    from .cache import iter_domains_from_urls
+    from .cache import refresh_in_background
+    from .hosts import ParsePool
+    from .incremental import build_packed_state
+    from .incremental import load_build_state
+    from .incremental import make_build_state
+    from .incremental import save_build_state
+    from .incremental import update_build_state
+    from .packed import PackedDomains
+    from .packed import reversed_labels
+    from .psl import PSL_CACHE
+    from .psl import psl_domain
+    from .rule_index import write_build_state_index
+    from .sources import expand_sources
+    from .sources import is_source
+    from .stats import STATS
+    from .validate import ValidatedDomains
+    from .validate import validated_domains
+
+    STATS.reset()
+    REFRESH_URLS.clear()
+    if stats_json or stats_prometheus:
+        # written when the command's context closes, so an early exit
+        # still leaves stats behind (with success 0)
+        click.get_current_context().call_on_close(partial(STATS.write,
+                                                          json_path=stats_json,
+                                                          prometheus_path=stats_prometheus,))
 
     leprint('Using output file: %s', config.output, level=LOG['INFO'])
-    whitelist_file = os.path.abspath(CUSTOM_WHITELIST)
-    try:
-        domains_whitelist = extract_domain_set_from_dnsgate_format_file(whitelist_file)
-    except FileNotFoundError:
-        domains_whitelist = set()
-        leprint('WARNING: %s is missing, only the default remote sources will be used.' +
-               'Run "dnsgate configure --help" to fix.', CUSTOM_WHITELIST, level=LOG['WARNING'])
-    else:
-        if domains_whitelist:
-            leprint("%d domains from %s", len(domains_whitelist),
-                   CUSTOM_WHITELIST, level=LOG['DEBUG'])
-            domains_whitelist = validate_domain_list(domains_whitelist)
-            leprint('%d validated whitelist domains.', len(domains_whitelist),
-                   level=LOG['INFO'])
+    # --compact rebuilds everything, the memo would only cost memory
+    use_psl_cache = not no_psl_cache and not compact
+    if use_psl_cache:
+        PSL_CACHE.load()
+
+    with STATS.stage('whitelist') as stage:
+        whitelist_file = os.path.abspath(CUSTOM_WHITELIST)
+        try:
+            domains_whitelist = extract_domain_set_from_dnsgate_format_file(whitelist_file)
+        except FileNotFoundError:
+            domains_whitelist = ValidatedDomains()
+            leprint('WARNING: %s is missing, only the default remote sources will be used.' +
+                   'Run "dnsgate configure --help" to fix.', CUSTOM_WHITELIST, level=LOG['WARNING'])
+        else:
+            stage['domains_in'] = len(domains_whitelist)
+            if domains_whitelist:
+                leprint("%d domains from %s", len(domains_whitelist),
+                       CUSTOM_WHITELIST, level=LOG['DEBUG'])
+                domains_whitelist = validated_domains(domains_whitelist)
+                leprint('%d validated whitelist domains.', len(domains_whitelist),
+                       level=LOG['INFO'])
+        stage['domains_out'] = len(domains_whitelist)
 
     if not domains_whitelist:
         if config.block_at_psl:
             leprint('WARNING: block_at_psl is enabled in ' + CONFIG_FILE.as_posix() + ' and 0 domains were obtained from %s. If you get "Domain Not Found" errors, use "dnsgate whitelist --help"', CUSTOM_WHITELIST, level=LOG['WARNING'])
 
-    domains_combined_orig = set()   # domains from all sources, combined
-    leprint("Reading remote blacklist(s):\n%s", str(config.sources), level=LOG['INFO'])
-    for item in config.sources:
-        if item.startswith('http'):
-            leprint("Trying http:// blacklist location: %s", item, level=LOG['DEBUG'])
-            domains = get_domains_from_url(url=item, no_cache=no_cache, cache_expire=cache_expire)
-            if domains:
-                domains_combined_orig = domains_combined_orig | domains # union
-                leprint("len(domains_combined_orig): %s",
-                       len(domains_combined_orig), level=LOG['DEBUG'])
-            else:
-                leprint('ERROR: Failed to get ' + item + ', skipping.', level=LOG['ERROR'])
-                continue
-        else:
-            leprint('ERROR: ' + item +
-                   ' must start with http:// or https://, skipping.', level=LOG['ERROR'])
-
-    leprint("%d domains from remote blacklist(s).",
-           len(domains_combined_orig), level=LOG['INFO'])
-
-    if len(domains_combined_orig) == 0:
-        leprint("WARNING: 0 domains were retrieved from " +
-               "remote sources, only the local " + CUSTOM_BLACKLIST +
-               " will be used.", level=LOG['WARNING'])
-
-    domains_combined_orig = validate_domain_list(domains_combined_orig)
-    leprint('%d validated remote blacklisted domains.',
-           len(domains_combined_orig), level=LOG['INFO'])
-
-    domains_combined = copy.deepcopy(domains_combined_orig) # need to iterate through _orig later
-
-    if config.block_at_psl and config.mode != 'hosts':
-        domains_combined = strip_to_psl(domains_combined)
-        leprint("%d blacklisted domains left after stripping to PSL domains.",
-               len(domains_combined), level=LOG['INFO'])
-
-        if domains_whitelist:
-            leprint("Subtracting %d whitelisted domains.",
-                   len(domains_whitelist), level=LOG['INFO'])
-            domains_combined = domains_combined - domains_whitelist
-            leprint("%d blacklisted domains left after subtracting the whitelist.",
-                   len(domains_combined), level=LOG['INFO'])
-            leprint('Iterating through the original %d whitelisted domains and ' +
-                   'making sure none are blocked by * rules.',
-                   len(domains_whitelist), level=LOG['INFO'])
-            for domain in domains_whitelist:
-                domain_psl = extract_psl_domain(domain)
-                if domain_psl in domains_combined:
-                    domains_combined.remove(domain_psl)
-                    print("TODO: removed domain_psl:", domain_psl)
-
-        # this needs to happen even if len(whitelisted_domains) == 0
-        leprint('Iterating through original %d blacklisted domains to re-add subdomains' +
-               ' that are not whitelisted', len(domains_combined_orig), level=LOG['INFO'])
-        # re-add subdomains that are not explicitly whitelisted or already blocked
-        for orig_domain in domains_combined_orig: # check every original full hostname
-            if orig_domain not in domains_whitelist: # if it's not in the whitelist
-                if orig_domain not in domains_combined: # and it's not in the current blacklist
-                                                        # (almost none will be if --block-at-psl)
-                    # get it's psl to see if it's already blocked
-                    orig_domain_psl = extract_psl_domain(orig_domain)
-
-                    if orig_domain_psl not in domains_combined: # if the psl is not already blocked
-                        leprint("Re-adding: %s", orig_domain, level=LOG['DEBUG'])
-                        domains_combined.add(orig_domain) # add the full hostname to the blacklist
-
-        leprint('%d blacklisted domains after re-adding non-explicitly blacklisted subdomains',
-               len(domains_combined), level=LOG['INFO'])
-
-    elif config.block_at_psl and config.mode == 'hosts':
+    if config.block_at_psl and config.mode == 'hosts':
         leprint("ERROR: --block-at-psl is not possible in hosts mode. Exiting.",
-               level=-LOG['ERROR'])
+               level=LOG['ERROR'])
         sys.exit(1)
 
-    # apply whitelist before applying local blacklist
-    domains_combined = domains_combined - domains_whitelist  # remove exact whitelist matches
-    leprint("%d blacklisted domains after subtracting the %d whitelisted domains",
-           len(domains_combined), len(domains_whitelist), level=LOG['INFO'])
-
-    # must happen after subdomain stripping and after whitelist subtraction
-    blacklist_file = os.path.abspath(CUSTOM_BLACKLIST)
-    try:
-        domains_blacklist = extract_domain_set_from_dnsgate_format_file(blacklist_file)
-    except FileNotFoundError:
-        domains_blacklist = set()
-        leprint('WARNING: %s is missing, only the default remote sources ' +
-               'will be used. Run "dnsgate configure --help" to fix.',
-               CUSTOM_BLACKLIST, level=LOG['WARNING'])
-    else:
-        if domains_blacklist: # ignore empty blacklist
-            leprint("Got %s domains from the CUSTOM_BLACKLIST: %s",
-                   len(domains_blacklist), blacklist_file, level=LOG['DEBUG'])
-            leprint("Re-adding %d domains in the local blacklist %s to override the whitelist.",
-                   len(domains_blacklist), CUSTOM_BLACKLIST, level=LOG['INFO'])
-            domains_combined = domains_combined | domains_blacklist # union
-            leprint("%d blacklisted domains after re-adding the custom blacklist.",
-                   len(domains_combined), level=LOG['INFO'])
-
-    leprint("Validating final domain blacklist.", level=LOG['DEBUG'])
-    domains_combined = validate_domain_list(domains_combined)
-    leprint('%d validated blacklisted domains.', len(domains_combined), level=LOG['DEBUG'])
-
-    prune_redundant_rules(domains_combined)
-    leprint('%d blacklisted domains after removing redundant rules.', len(domains_combined),
-           level=LOG['INFO'])
-
-    domains_combined = group_by_tld(domains_combined) # do last, returns sorted list
+    build_state = None
+    if not full and (local_only or not compact):   # --compact always rebuilds
+        with STATS.stage('load_state') as stage:
+            build_state = load_build_state(mode=config.mode, block_at_psl=config.block_at_psl)
+            if build_state:
+                stage['domains_out'] = len(build_state.remote)
+        if not build_state:
+            leprint("No usable state from a previous generate, rebuilding everything.", level=LOG['INFO'])
+
+    with STATS.stage('fetch') as stage:
+        if local_only and build_state:
+            leprint("Reusing the %d remote domains from the last generate.", len(build_state.remote_set), level=LOG['INFO'])
+            domains_combined_orig = build_state.remote_set
+            if compact:
+                # the saved remote list is already in packed key order
+                domains_combined_orig = PackedDomains.from_sorted_keys(reversed_labels(domain) for domain in build_state.remote)
+                build_state = None
+        else:
+            # domains from all sources, combined
+            domains_combined_orig = PackedDomains() if compact else ValidatedDomains()
+            leprint("Reading remote blacklist(s):\n%s", str(config.sources), level=LOG['INFO'])
+            for item in config.sources:
+                if not is_source(item):
+                    leprint('ERROR: ' + item +
+                           ' must start with http://, https:// or file:///, skipping.', level=LOG['ERROR'])
+            urls = expand_sources(config.sources)
+            domains_fetched = 0
+            # each source is merged and dropped as it arrives, at most
+            # --fetch-jobs parsed sources are held at once
+            with ParsePool(jobs) as parse_pool:
+                for url, domains in iter_domains_from_urls(urls=urls,
+                                                           no_cache=no_cache,
+                                                           cache_expire=cache_expire,
+                                                           jobs=fetch_jobs,
+                                                           timeout=fetch_timeout,
+                                                           parse_pool=parse_pool,
+                                                           stale=stale,
+                                                           stale_deadline=stale_deadline,):
+                    if domains:
+                        domains_fetched += len(domains)
+                        domains_combined_orig |= domains # in-place union, sources are validated as they are parsed
+                        leprint("len(domains_combined_orig): %s",
+                               len(domains_combined_orig), level=LOG['DEBUG'])
+                    else:
+                        leprint('ERROR: Failed to get ' + url + ', skipping.', level=LOG['ERROR'])
+                    domains = None
+            stage['domains_in'] = domains_fetched
+
+            leprint("%d domains from remote blacklist(s).",
+                   len(domains_combined_orig), level=LOG['INFO'])
+            stale_urls = [url for url in urls if STATS.source(url)['stale_seconds'] is not None]
+            if stale_urls:
+                leprint("WARNING: %d of %d remote sources are cached copies, not fetched this run.",
+                       len(stale_urls), len(urls), level=LOG['WARNING'])
+            stage['stale_sources'] = len(stale_urls)
+            if not no_cache:
+                evict_cache(config.cache_max_bytes)
+            if REFRESH_URLS:
+                # once this generate is done, so the refresh does not compete
+                # with the rest of it and the cache index is no longer written
+                click.get_current_context().call_on_close(partial(refresh_in_background,
+                                                                  list(REFRESH_URLS),
+                                                                  cache_expire=cache_expire,
+                                                                  timeout=fetch_timeout,
+                                                                  jobs=fetch_jobs,))
+
+            if len(domains_combined_orig) == 0:
+                leprint("WARNING: 0 domains were retrieved from " +
+                       "remote sources, only the local " + CUSTOM_BLACKLIST.as_posix() +
+                       " will be used.", level=LOG['WARNING'])
+        stage['domains_out'] = len(domains_combined_orig)
+
+    with STATS.stage('blacklist') as stage:
+        domains_blacklist = read_custom_blacklist()
+        stage['domains_out'] = len(domains_blacklist)
+
+    with STATS.stage('rules', domains_in=len(domains_combined_orig)) as stage:
+        stage['incremental'] = bool(build_state)
+        if compact:
+            build_state = build_packed_state(mode=config.mode,
+                                             block_at_psl=config.block_at_psl,
+                                             remote=domains_combined_orig,
+                                             whitelist=domains_whitelist,
+                                             blacklist=domains_blacklist,)
+            domains_combined = build_state.final
+        elif build_state:
+            domains_combined = update_build_state(build_state,
+                                                  remote=domains_combined_orig,
+                                                  whitelist=domains_whitelist,
+                                                  blacklist=domains_blacklist,)
+        else:
+            domains_remote_rules, domains_combined = \
+                build_rule_set(config=config,
+                               domains_combined_orig=domains_combined_orig,
+                               domains_whitelist=domains_whitelist,
+                               domains_blacklist=domains_blacklist,)
+            build_state = make_build_state(mode=config.mode,
+                                           block_at_psl=config.block_at_psl,
+                                           remote=domains_combined_orig,
+                                           whitelist=domains_whitelist,
+                                           blacklist=domains_blacklist,
+                                           remote_rules=domains_remote_rules,
+                                           final=domains_combined,)
+        stage['domains_out'] = len(domains_combined)
+
+    with STATS.stage('index', domains_in=len(build_state.remote)) as stage:
+        # for dnsgate serve, the subtree rules before pruning
+        stage['domains_out'] = write_build_state_index(RULE_INDEX_FILE, build_state)
+
+    with STATS.stage('save_state'):
+        save_build_state(build_state)
+        if use_psl_cache:
+            PSL_CACHE.save()
+    STATS.count('psl_cache_hits', PSL_CACHE.hits)
+    STATS.count('psl_cache_misses', PSL_CACHE.misses)
+
+    with STATS.stage('sort', domains_in=len(domains_combined)) as stage:
+        if not compact:     # packed sets iterate in reversed label order, already grouped by TLD
+            domains_combined = group_by_tld(domains_combined) # do last, returns sorted list
+        stage['domains_out'] = len(domains_combined)
     leprint('Final blacklisted domain count: %d', len(domains_combined), level=LOG['INFO'])
 
-    if config.backup: # todo: unit test
-        backup_file_if_exists(config.output)
-
     if not domains_combined:
         leprint("The list of domains to block is empty, nothing to do, exiting.",
                level=LOG['INFO'])
         sys.exit(1)
 
+    output = config_output_format(config)
+    fingerprint = output_fingerprint(config_dict=make_config_dict(config), domains=domains_combined)
+    if not force_write and read_output_fingerprint(config.output, comment=output.comment) == fingerprint:
+        leprint("%s is unchanged, skipping the write and the dnsmasq reload.", config.output, level=LOG['INFO'])
+        STATS.count('output_unchanged', 1)
+        STATS.finish()
+        return
+    STATS.count('output_unchanged', 0)
+
+    if config.backup: # todo: unit test
+        backup_file_if_exists(config.output)
+
+    domains_final = domains_combined if compact else set(domains_combined)
     for domain in domains_whitelist:
-        domain_tld = extract_psl_domain(domain)
-        if domain_tld in domains_combined:
+        domain_tld = psl_domain(domain)
+        if domain_tld in domains_final:
             leprint('WARNING: %s is listed in both %s and %s, the local blacklist always takes precedence.', domain.decode('UTF8'), CUSTOM_BLACKLIST, CUSTOM_WHITELIST, level=LOG['WARNING'])
 
-    write_output_file(config=config, domains_combined=domains_combined, verbose=verbose, debug=debug,)
+    with STATS.stage('write', domains_in=len(domains_combined)) as stage:
+        write_output_file(config=config,
+                          domains_combined=domains_combined,
+                          verbose=verbose,
+                          debug=debug,
+                          fingerprint=fingerprint,)
+        stage['domains_out'] = len(domains_combined)
+    STATS.count('output_bytes', os.stat(config.output).st_size)
 
     if not config.no_restart_dnsmasq:
-        if config.mode != 'hosts':
-            restart_dnsmasq_service()
+        if config.mode != 'hosts' and output.reloads_dnsmasq:
+            with STATS.stage('restart'):
+                # a changed include (dest_ip set or unset since enable) needs a restart
+                restart = dnsmasq_include_is_stale(config)
+                if restart:
+                    write_dnsmasq_include(config)
+                apply_dnsmasq_changes_or_exit(config, restart=restart)
+    STATS.finish()
+
+
+@dnsgate.group(name='cache', help=CACHE_HELP)
+def cache_group():
+    pass
+
+
+@cache_group.command(name='list', help=CACHE_LIST_HELP)
+@click.option('--cache-expire',
+              is_flag=False,
+              help=CACHE_EXPIRE_HELP,
+              type=int,
+              default=CACHE_EXPIRE,)
+@click.pass_obj
+def cache_list(config,
+               cache_expire: int,
+               ) -> None:
+    # most recently used first: size, last download, last use, state, url
+    from .cache_index import CACHE_INDEX
+    from .cache_index import cache_entry_files
+    from .sources import expand_sources
+    from .sources import is_local_source
+
+    configured = set(expand_sources(config.sources))
+    now = time.time()
+    for key, entry in CACHE_INDEX.items():
+        hosts_file = cache_entry_files(key)[0]
+        try:
+            state = 'expired' if os.stat(hosts_file).st_mtime + cache_expire <= now else 'fresh'
+        except FileNotFoundError:
+            state = 'missing'
+        if is_local_source(entry['url']):
+            state = 'local'     # only the parsed copy is cached
+        if entry['url'] not in configured:
+            state += ',unconfigured'
+        click.echo('\t'.join([str(entry['size']),
+                              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['fetched'])),
+                              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['used'])),
+                              state,
+                              entry['url'],]))
+    leprint("%d bytes of %d (cache_max_bytes) used.", CACHE_INDEX.total_size(), config.cache_max_bytes, level=LOG['INFO'])
+
+
+@cache_group.command(name='prune', help=CACHE_PRUNE_HELP)
+@click.option('--all', 'prune_all', is_flag=True, help=CACHE_PRUNE_ALL_HELP)
+@click.pass_obj
+def cache_prune(config,
+                prune_all: bool,
+                ) -> None:
+    from .cache_index import CACHE_INDEX
+
+    if prune_all:
+        removed, freed = CACHE_INDEX.clear()
+    else:
+        removed, freed = CACHE_INDEX.evict(config.cache_max_bytes)
+    orphans = CACHE_INDEX.orphan_files()
+    for path in orphans:
+        leprint("Removing %s", path, level=LOG['DEBUG'])
+        try:
+            freed += os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    leprint("Removed %d cached sources and %d unindexed files, %d bytes freed.",
+           removed, len(orphans), freed, level=LOG['INFO'])
+
+
+@cache_group.command(name='warm', help=CACHE_WARM_HELP)
+@click.option('--cache-expire',
+              is_flag=False,
+              help=CACHE_EXPIRE_HELP,
+              type=int,
+              default=CACHE_EXPIRE,)
+@click.option('--fetch-jobs',
+              is_flag=False,
+              help=FETCH_JOBS_HELP,
+              type=int,
+              default=FETCH_JOBS,)
+@click.option('--jobs',
+              is_flag=False,
+              help=PARSE_JOBS_HELP,
+              type=click.IntRange(min=1),
+              default=PARSE_JOBS,)
+@click.option('--fetch-timeout',
+              is_flag=False,
+              help=FETCH_TIMEOUT_HELP,
+              type=int,
+              default=FETCH_TIMEOUT,)
+@click.option('--source', 'sources', multiple=True, help=CACHE_WARM_SOURCE_HELP)
+@click.pass_obj
+def cache_warm(config,
+               cache_expire: int,
+               fetch_jobs: int,
+               jobs: int,
+               fetch_timeout: int,
+               sources: tuple,
+               ) -> None:
+    # downloads and parses what a generate would, without building rules,
+    # generate --stale revalidate runs it with --source in the background
+    from .cache import iter_domains_from_urls
+    from .hosts import ParsePool
+    from .sources import expand_sources
+
+    urls = expand_sources(sources or config.sources)
+    failed = 0
+    with ParsePool(jobs) as parse_pool:
+        for url, domains in iter_domains_from_urls(urls=urls,
+                                                   cache_expire=cache_expire,
+                                                   jobs=fetch_jobs,
+                                                   timeout=fetch_timeout,
+                                                   parse_pool=parse_pool,):
+            if domains is None:
+                leprint('ERROR: Failed to get ' + url + '.', level=LOG['ERROR'])
+                failed += 1
+            else:
+                leprint("%d domains cached from %s", len(domains), url, level=LOG['INFO'])
+            domains = None
+    evict_cache(config.cache_max_bytes)
+    if failed:
+        sys.exit(1)
+
+
+@dnsgate.command(help=SERVE_HELP)
+@click.option('--listen',
+              is_flag=False,
+              help=SERVE_LISTEN_HELP,
+              default=SERVE_LISTEN_ADDRESS,)
+@click.option('--port',
+              is_flag=False,
+              help=SERVE_PORT_HELP,
+              type=click.IntRange(min=1, max=65535),
+              default=SERVE_PORT,)
+@click.option('--upstream',
+              is_flag=False,
+              help=SERVE_UPSTREAM_HELP,
+              required=True,)
+@click.option('--upstream-port',
+              is_flag=False,
+              help=SERVE_UPSTREAM_PORT_HELP,
+              type=click.IntRange(min=1, max=65535),
+              default=SERVE_UPSTREAM_PORT,)
+@click.option('--cache-size',
+              is_flag=False,
+              help=SERVE_CACHE_SIZE_HELP,
+              type=click.IntRange(min=0),
+              default=SERVE_CACHE_SIZE,)
+@click.option('--verbose', is_flag=True)
+@click.option('--debug', is_flag=True)
+@click.pass_obj
+def serve(config,
+          listen: str,
+          port: int,
+          upstream: str,
+          upstream_port: int,
+          cache_size: int,
+          verbose: bool,
+          debug: bool,
+          ):
+    import asyncio
+
+    from .serve import DnsProxy
+    from .serve import load_rule_index
+
+    rules = load_rule_index()
+    if rules is None:
+        leprint('ERROR: no rule index in %s, run "dnsgate generate" first. Exiting.', RULE_INDEX_FILE, level=LOG['ERROR'])
+        sys.exit(1)
+    proxy = DnsProxy(config=config,
+                     rules=rules,
+                     upstream=(upstream, upstream_port),
+                     cache_size=cache_size,)
+    try:
+        asyncio.run(proxy.serve(listen=listen, port=port))
+    except OSError as e:
+        leprint("ERROR: can not serve on %s port %d: %s. Exiting.", listen, port, e, level=LOG['ERROR'])
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
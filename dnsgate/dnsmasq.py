@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Getting a new blacklist into a running dnsmasq.
+#
+# With dnsmasq_reload = restart (the default) the output file is a dnsmasq
+# config file symlinked into DNSMASQ_CONFIG_INCLUDE_DIRECTORY, so every
+# change needs a full restart, which also drops dnsmasq's cache.
+#
+# With dnsmasq_reload = sighup the output file is a servers-file, which
+# dnsmasq re-reads on SIGHUP without restarting: server=/.example.com/
+# lines, NXDOMAIN for the domain and everything under it. A servers-file
+# can only hold server= lines, so dest_ip needs dnsmasq_reload = restart.
+# addn-hosts, the other file SIGHUP re-reads, only matches the exact names
+# listed: the subdomains a rule stands in for (and with block_at_psl
+# every name under a PSL domain) would no longer be blocked.
+#
+# DNSMASQ_RELOAD_INCLUDE holds the one servers-file= line, pointing at
+# DNSMASQ_ACTIVE_SYMLINK. enable/disable point that symlink at
+# the output file or at an empty file and send SIGHUP, only adding or
+# changing the include itself needs a restart.
+
+import os
+import signal
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from logtool import LOG
+from logtool import leprint
+
+from .global_vars import DNSMASQ_ACTIVE_SYMLINK
+from .global_vars import DNSMASQ_EMPTY_FILE
+from .global_vars import DNSMASQ_INIT_SCRIPT
+from .global_vars import DNSMASQ_PID_FILES
+from .global_vars import DNSMASQ_RELOAD_INCLUDE
+from .global_vars import DNSMASQ_RELOAD_SETTLE
+from .global_vars import DNSMASQ_START_TIMEOUT
+
+DNSMASQ_RELOAD_MODES = ['restart', 'sighup']
+DNSMASQ_PROCESS_NAME = 'dnsmasq'
+# the one output format dnsmasq can read in each layout
+DNSMASQ_LAYOUT_FORMATS = {'conf-dir': 'dnsmasq',
+                          'servers-file': 'servers-file'}
+
+
+def dnsmasq_layout(config) -> str:
+    if config.dnsmasq_reload != 'sighup':
+        return 'conf-dir'
+    return 'servers-file'
+
+
+def process_name(pid: int):
+    # None if pid is gone or a zombie, which keeps its name until reaped
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as fh:
+            stat = fh.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    name_end = stat.rindex(')')
+    if stat[name_end + 2:name_end + 3] == 'Z':
+        return None
+    return stat[stat.index('(') + 1:name_end]
+
+
+def dnsmasq_pids() -> list:
+    # the pid files first, a scan of /proc if none of them is current
+    pids = set()
+    for pid_file in DNSMASQ_PID_FILES:
+        try:
+            with open(pid_file, 'r') as fh:
+                pid = int(fh.read().strip())
+        except (FileNotFoundError, ValueError):
+            continue
+        if process_name(pid) == DNSMASQ_PROCESS_NAME:
+            pids.add(pid)
+    if not pids:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit() and process_name(int(entry)) == DNSMASQ_PROCESS_NAME:
+                pids.add(int(entry))
+    return sorted(pids)
+
+
+def wait_for_dnsmasq(*,
+                     timeout: float = DNSMASQ_START_TIMEOUT,
+                     ) -> list:
+    deadline = time.monotonic() + timeout
+    while True:
+        pids = dnsmasq_pids()
+        if pids or time.monotonic() > deadline:
+            return pids
+        time.sleep(0.1)
+
+
+def restart_dnsmasq_service(*,
+                            timeout: float = DNSMASQ_START_TIMEOUT,
+                            ) -> bool:
+    if os.path.lexists(DNSMASQ_INIT_SCRIPT):
+        command = [DNSMASQ_INIT_SCRIPT.as_posix(), 'restart']
+    else:
+        command = ['systemctl', 'restart', 'dnsmasq']  # untested
+    leprint("Restarting dnsmasq: %s", ' '.join(command), level=LOG['INFO'])
+    # the output goes to a file and is logged, sys.stderr may have no file
+    # descriptor (click's CliRunner, some daemons). Not a pipe: a daemon the
+    # script starts can hold it open long after the script exited
+    with tempfile.TemporaryFile() as output:
+        try:
+            result = subprocess.run(command,
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=output,
+                                    stderr=subprocess.STDOUT,
+                                    check=False,)
+        except OSError as e:
+            leprint("ERROR: could not run %s: %s", command[0], e, level=LOG['ERROR'])
+            return False
+        output.seek(0)
+        for line in output.read().decode('utf8', 'replace').splitlines():
+            leprint("%s", line, level=LOG['INFO'])
+    if result.returncode != 0:
+        leprint("ERROR: %s exited with %d.", ' '.join(command), result.returncode, level=LOG['ERROR'])
+        return False
+    if not wait_for_dnsmasq(timeout=timeout):
+        leprint("ERROR: dnsmasq is not running %ds after the restart.", timeout, level=LOG['ERROR'])
+        return False
+    return True
+
+
+def reload_dnsmasq_service(*,
+                           timeout: float = DNSMASQ_START_TIMEOUT,
+                           ) -> bool:
+    pids = dnsmasq_pids()
+    if not pids:
+        leprint("dnsmasq is not running, starting it instead of reloading.", level=LOG['WARNING'])
+        return restart_dnsmasq_service(timeout=timeout)
+    for pid in pids:
+        leprint("Sending SIGHUP to dnsmasq (pid %d)", pid, level=LOG['INFO'])
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except ProcessLookupError:
+            pass    # checked below
+        except PermissionError as e:
+            leprint("ERROR: can not signal dnsmasq (pid %d): %s", pid, e, level=LOG['ERROR'])
+            return False
+    # SIGHUP re-reads the files in place, the same processes must still be there
+    time.sleep(DNSMASQ_RELOAD_SETTLE)
+    gone = [pid for pid in pids if process_name(pid) != DNSMASQ_PROCESS_NAME]
+    if gone:
+        leprint("ERROR: dnsmasq (pid %s) exited after SIGHUP.", ', '.join(map(str, gone)), level=LOG['ERROR'])
+        return False
+    return True
+
+
+def apply_dnsmasq_changes(config, *,
+                          restart: bool = False,
+                          ) -> bool:
+    if restart or config.dnsmasq_reload != 'sighup':
+        return restart_dnsmasq_service()
+    return reload_dnsmasq_service()
+
+
+def dnsmasq_include_line(config) -> str:
+    return dnsmasq_layout(config) + '=' + DNSMASQ_ACTIVE_SYMLINK.as_posix()
+
+
+def write_dnsmasq_include(config) -> bool:
+    # returns True if the include changed, dnsmasq only picks that up on a restart
+    line = dnsmasq_include_line(config) + '\n'
+    try:
+        with open(DNSMASQ_RELOAD_INCLUDE, 'r') as fh:
+            if fh.read() == line:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp_path = DNSMASQ_RELOAD_INCLUDE.with_name(DNSMASQ_RELOAD_INCLUDE.name + '.tmp')
+    with open(tmp_path, 'w') as fh:
+        fh.write(line)
+    os.replace(tmp_path, DNSMASQ_RELOAD_INCLUDE)
+    return True
+
+
+def dnsmasq_include_is_stale(config) -> bool:
+    # the include exists (dnsgate is enabled) but is for another layout
+    try:
+        with open(DNSMASQ_RELOAD_INCLUDE, 'r') as fh:
+            return fh.read() != dnsmasq_include_line(config) + '\n'
+    except FileNotFoundError:
+        return False
+
+
+def point_active_symlink(target: Path) -> None:
+    # replaced in one rename, dnsmasq never sees a missing file
+    if not os.path.exists(DNSMASQ_EMPTY_FILE):
+        with open(DNSMASQ_EMPTY_FILE, 'w') as fh:
+            fh.write('# dnsgate is disabled\n')
+    tmp_link = DNSMASQ_ACTIVE_SYMLINK.with_name(DNSMASQ_ACTIVE_SYMLINK.name + '.tmp')
+    try:
+        os.remove(tmp_link)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.path.relpath(target, DNSMASQ_ACTIVE_SYMLINK.parent), tmp_link)
+    os.replace(tmp_link, DNSMASQ_ACTIVE_SYMLINK)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Compact on-disk format for a set of already parsed and validated domains:
+#
+#   dnsgate-domains 1 <tag> <count>\n
+#   <domain>\n
+#   ...
+#
+# Domains are sorted (or written in the caller's presorted order) so the
+# file is stable for identical sets and can be loaded with a single read()
+# and split().
+
+import os
+from itertools import islice
+from pathlib import Path
+
+from .global_vars import OUTPUT_CHUNK_LINES
+
+DOMAIN_FILE_MAGIC = b'dnsgate-domains'
+DOMAIN_FILE_VERSION = b'1'
+
+
+class DomainFileError(ValueError):
+    pass
+
+
+def write_domain_file(*,
+                      path: Path,
+                      domains,
+                      tag: str = '-',
+                      presorted: bool = False,
+                      ) -> None:
+    if not presorted:
+        domains = sorted(domains)
+    header = b' '.join([DOMAIN_FILE_MAGIC,
+                        DOMAIN_FILE_VERSION,
+                        tag.encode('ascii'),
+                        str(len(domains)).encode('ascii'),])
+    tmp_path = Path(path).with_name(Path(path).name + '.%d.tmp' % os.getpid())
+    with open(tmp_path, 'wb') as fh:
+        fh.write(header + b'\n')
+        # in chunks, a join over a whole packed set would unpack all of it
+        domains = iter(domains)
+        while True:
+            chunk = list(islice(domains, OUTPUT_CHUNK_LINES))
+            if not chunk:
+                break
+            fh.write(b'\n'.join(chunk) + b'\n')
+    os.replace(tmp_path, path)
+
+
+def read_domain_file_tag(path: Path) -> str:
+    with open(path, 'rb') as fh:
+        header = fh.readline()
+    return parse_domain_file_header(header, path=path)[0]
+
+
+def read_domain_file(path: Path, *, set_type=set) -> tuple:
+    tag, domains = read_domain_list(path)
+    return tag, set_type(domains)
+
+
+def read_domain_list(path: Path) -> tuple:
+    # domains are returned in file order
+    with open(path, 'rb') as fh:
+        file_bytes = fh.read()
+    header, _, body = file_bytes.partition(b'\n')
+    tag, count = parse_domain_file_header(header, path=path)
+    if count == 0:
+        return tag, []
+    domains = body.split(b'\n')
+    if domains[-1] == b'':
+        del domains[-1]
+    if len(domains) != count:
+        raise DomainFileError(path)
+    return tag, domains
+
+
+def parse_domain_file_header(header: bytes, *, path) -> tuple:
+    fields = header.split()
+    if len(fields) != 4 or fields[0] != DOMAIN_FILE_MAGIC or fields[1] != DOMAIN_FILE_VERSION:
+        raise DomainFileError(path)
+    try:
+        return fields[2].decode('ascii'), int(fields[3])
+    except ValueError as e:
+        raise DomainFileError(path) from e
@@ -6,13 +6,14 @@ from .global_vars import CUSTOM_BLACKLIST
 from .global_vars import CUSTOM_WHITELIST
 from .global_vars import CONFIG_FILE
 from pathlib import Path
+from typing import Optional
 
 
 def make_custom_blacklist_header(path: Path):
     output_file_header = '#' * 64 + '''
 # dnsgate custom blacklist
 # User-defined blacklisted domains go here.
-# Rules defined here override conflicting rules in ''' + CUSTOM_WHITELIST + '''
+# Rules defined here override conflicting rules in ''' + CUSTOM_WHITELIST.as_posix() + '''
 #
 # Examples:
 # google.com    # blocks *.google.com
@@ -24,8 +25,8 @@ def make_custom_whitelist_header(path: Path):
     output_file_header = '#' * 64 + '''
 # dnsgate custom whitelist
 # User-defined whitelisted domains go here.
-# Usually this is only needed if block_at_psl is enabled in ''' + CONFIG_FILE + '''
-# Rules here ARE OVERRIDDEN by any conflicting rules in ''' + CUSTOM_BLACKLIST + '''
+# Usually this is only needed if block_at_psl is enabled in ''' + CONFIG_FILE.as_posix() + '''
+# Rules here ARE OVERRIDDEN by any conflicting rules in ''' + CUSTOM_BLACKLIST.as_posix() + '''
 #
 # Examples:
 # s3.amazonaws.com    # allows s3.amazonaws.com
@@ -37,14 +38,17 @@ def make_custom_whitelist_header(path: Path):
     return output_file_header
 
 
-def make_output_file_header(config_dict: dict):
+def make_output_file_header(config_dict: dict, fingerprint: Optional[str] = None):
     configuration_string = '\n'.join(['#    ' + str(key) + ': ' +
         str(config_dict[key]) for key in sorted(config_dict.keys())])
+    fingerprint_string = ''
+    if fingerprint:
+        fingerprint_string = '# fingerprint: ' + fingerprint + '\n#\n'
     output_file_header = '#' * 64 + '''\n#
 # AUTOMATICALLY GENERATED BY dnsgate\n#
 # CHANGES WILL BE LOST ON THE NEXT RUN.\n#
-# EDIT ''' + CUSTOM_BLACKLIST + ' or ' + \
-        CUSTOM_WHITELIST + ' instead.\n#\n' + \
+# EDIT ''' + CUSTOM_BLACKLIST.as_posix() + ' or ' + \
+        CUSTOM_WHITELIST.as_posix() + ' instead.\n#\n' + \
         '\n#' + '\n# Configuration:\n' + configuration_string + \
-        '\n#\n' + '#' * 64 + '\n\n'
+        '\n#\n' + fingerprint_string + '#' * 64 + '\n\n'
     return output_file_header.encode('utf8')
@@ -4,8 +4,6 @@
 
 from pathlib import Path
 
-from urltool import TLD_EXTRACT
-
 CACHE_DIRECTORY          = Path('/var/cache/dnsgate')
 OUTPUT_FILE_PATH_NAME    = Path('generated_blacklist')
 CONFIG_DIRECTORY         = Path('/etc/dnsgate')
@@ -13,10 +11,23 @@ CONFIG_FILE              = CONFIG_DIRECTORY / Path('config')
 CUSTOM_BLACKLIST         = CONFIG_DIRECTORY / Path('blacklist')
 CUSTOM_WHITELIST         = CONFIG_DIRECTORY / Path('whitelist')
 OUTPUT_FILE_PATH         = CONFIG_DIRECTORY / OUTPUT_FILE_PATH_NAME
+BUILD_STATE_DIRECTORY    = CACHE_DIRECTORY / Path('state')
+PSL_CACHE_FILE           = CACHE_DIRECTORY / Path('psl_cache')
+RULE_INDEX_FILE          = CACHE_DIRECTORY / Path('rule_index')
+CACHE_INDEX_FILE         = CACHE_DIRECTORY / Path('index.json')
+REENABLE_DEADLINE_FILE   = CACHE_DIRECTORY / Path('reenable_at')
+REENABLE_LOCK_FILE       = CACHE_DIRECTORY / Path('reenable.lock')
 
 DNSMASQ_CONFIG_INCLUDE_DIRECTORY = Path('/etc/dnsmasq.d')
 DNSMASQ_CONFIG_FILE              = Path('/etc/dnsmasq.conf')
 DNSMASQ_CONFIG_SYMLINK           = DNSMASQ_CONFIG_INCLUDE_DIRECTORY / OUTPUT_FILE_PATH_NAME
+DNSMASQ_RELOAD_INCLUDE           = DNSMASQ_CONFIG_INCLUDE_DIRECTORY / Path('dnsgate.conf')
+DNSMASQ_ACTIVE_SYMLINK           = CONFIG_DIRECTORY / Path('active_blacklist')
+DNSMASQ_EMPTY_FILE               = CONFIG_DIRECTORY / Path('empty_blacklist')
+DNSMASQ_PID_FILES                = [Path('/run/dnsmasq/dnsmasq.pid'),
+                                    Path('/var/run/dnsmasq.pid'),
+                                    Path('/run/dnsmasq.pid')]
+DNSMASQ_INIT_SCRIPT              = Path('/etc/init.d/dnsmasq')
 
 DEFAULT_REMOTE_BLACKLISTS = [
     'http://winhelp2002.mvps.org/hosts.txt',
@@ -33,3 +44,30 @@ ALL_REMOTE_BLACKLISTS = [
     # http://hosts-file.net/?s=Download
 
 CACHE_EXPIRE = 3600 * 24 * 2 # 48 hours
+CACHE_MAX_BYTES = 268435456  # 256 MiB of cached remote sources, 0 is no cap
+CACHE_STALE_TMP_AGE = 86400  # seconds before prune removes an unfinished download
+FETCH_JOBS = 4               # remote sources downloaded in parallel
+FETCH_TIMEOUT = 120          # seconds per remote source
+FETCH_CHUNK_SIZE = 65536     # bytes read and parsed at a time
+STALE_POLICIES = ['never', 'fallback', 'revalidate']
+STALE_POLICY = 'fallback'    # cached copy of a failing source is used
+STALE_DEADLINE = 0           # seconds revalidate tries an expired source
+PARSE_JOBS = 1               # processes parsing and validating sources
+PARSE_BATCH_SIZE = 4194304   # bytes of a source per parse job with --jobs
+PSL_CACHE_SIZE = 100000      # domains, ~20 MB in memory
+PSL_CACHE_EXPIRE = 3600 * 24 * 7 # 1 week
+OUTPUT_CHUNK_LINES = 65536   # output lines joined per write()
+OUTPUT_SHARD_SUFFIX = '.d'    # shards of <output> go to <output>.d/
+RPZ_TTL = 300                # seconds, TTL and negative TTL of the RPZ zone
+DNSMASQ_START_TIMEOUT = 10   # seconds for dnsmasq to come back after a restart
+DNSMASQ_RELOAD_SETTLE = 0.5  # seconds before checking dnsmasq survived SIGHUP
+REENABLE_CHECK_INTERVAL = 60 # seconds between re-reads of the disable deadline
+SERVE_LISTEN_ADDRESS = '127.0.0.1'
+SERVE_PORT = 53
+SERVE_UPSTREAM_PORT = 53
+SERVE_UPSTREAM_TIMEOUT = 5   # seconds per forwarded query
+SERVE_CACHE_SIZE = 100000    # cached upstream answers
+SERVE_RELOAD_INTERVAL = 2    # seconds between checks for a new rule index
+SERVE_CACHE_MAX_TTL = 3600   # seconds an upstream answer is cached at most
+SERVE_NEGATIVE_TTL = 60      # seconds for answers without records
+SERVE_BLOCKED_TTL = 60       # TTL of the dest_ip answer for blocked names
@@ -8,13 +8,25 @@ import time
 from pathlib import Path
 
 from .config import dnsmasq_config_file_line
+from .global_vars import CACHE_DIRECTORY
 from .global_vars import CACHE_EXPIRE
+from .global_vars import CACHE_MAX_BYTES
 from .global_vars import CONFIG_FILE
 from .global_vars import CUSTOM_BLACKLIST
 from .global_vars import CUSTOM_WHITELIST
 from .global_vars import DEFAULT_REMOTE_BLACKLISTS
 from .global_vars import DNSMASQ_CONFIG_FILE
+from .global_vars import FETCH_JOBS
+from .global_vars import FETCH_TIMEOUT
 from .global_vars import OUTPUT_FILE_PATH
+from .global_vars import PARSE_JOBS
+from .global_vars import REENABLE_DEADLINE_FILE
+from .global_vars import SERVE_CACHE_SIZE
+from .global_vars import SERVE_LISTEN_ADDRESS
+from .global_vars import SERVE_PORT
+from .global_vars import SERVE_UPSTREAM_PORT
+from .global_vars import STALE_DEADLINE
+from .global_vars import STALE_POLICY
 
 
 def dnsmasq_install_help(*,
@@ -37,7 +49,8 @@ DNSMASQ_CONFIG_HELP = 'dnsmasq config file (defaults to ' + DNSMASQ_CONFIG_FILE.
 BACKUP_HELP = 'backup output file before overwriting'
 INSTALL_HELP_HELP = 'Help configure dnsmasq or /etc/hosts'
 
-SOURCES_HELP = '''remote blacklist(s) to get rules from. Defaults to:
+SOURCES_HELP = '''blacklist(s) to get rules from, http(s):// urls, file:///path of a local list or
+of a directory of them (local lists are only parsed again after they change). Defaults to:
 \b
 
 ''' + ' '.join(DEFAULT_REMOTE_BLACKLISTS)
@@ -55,20 +68,92 @@ NO_CACHE_HELP = 'do not cache --source files as sha1(url) to ~/.dnsgate/cache/'
 CACHE_EXPIRE_HELP = 'seconds until cached remote sources are re-downloaded ' + \
     '(defaults to ' + str(CACHE_EXPIRE / 3600) + ' hours)'
 
+FETCH_JOBS_HELP = 'number of remote sources to download in parallel ' + \
+    '(defaults to ' + str(FETCH_JOBS) + ')'
+
+PARSE_JOBS_HELP = 'number of processes that parse and validate the remote sources, ' + \
+    'large sources are split across them (defaults to ' + str(PARSE_JOBS) + ', no extra processes)'
+
+CACHE_MAX_BYTES_HELP = 'bytes of cached remote sources to keep in ' + CACHE_DIRECTORY.as_posix() + \
+    ', the least recently used are removed first, 0 for no limit (defaults to ' + str(CACHE_MAX_BYTES) + ')'
+
+CACHE_HELP = 'Inspect and maintain the remote source cache in ' + CACHE_DIRECTORY.as_posix()
+
+CACHE_LIST_HELP = 'List the cached sources, most recently used first: bytes, last download, last use, state and url'
+
+CACHE_PRUNE_HELP = 'Remove the least recently used sources over cache_max_bytes and files no cached source owns'
+
+CACHE_PRUNE_ALL_HELP = 'remove every cached source'
+
+CACHE_WARM_HELP = 'Download and parse every configured source into the cache, ' + \
+    'so the next generate does not wait for them'
+
+CACHE_WARM_SOURCE_HELP = 'only this url instead of the configured sources, may be repeated'
+
+STALE_HELP = 'what to do with the cached copy of a slow or failing source. never: skip the source. ' + \
+    'fallback: use the copy if the fetch fails. revalidate: use an expired copy at once and download ' + \
+    'the source in the background for the next run (defaults to ' + STALE_POLICY + ', never with --no-cache, ' + \
+    'versions before --stale skipped a failing source like never does)'
+
+STALE_DEADLINE_HELP = 'with --stale revalidate, seconds to try an expired source before using its cached copy ' + \
+    '(defaults to ' + str(STALE_DEADLINE) + ', 0 uses the copy without trying)'
+
+FETCH_TIMEOUT_HELP = 'seconds to wait for each remote source before skipping it or using its cached copy ' + \
+    '(see --stale, defaults to ' + str(FETCH_TIMEOUT) + ')'
+
 DEST_IP_HELP = 'IP to redirect blocked connections to (defaults to ' + \
     '127.0.0.1 in hosts mode, specifying this in dnsmasq mode causes ' + \
     'lookups to resolve rather than return NXDOMAIN)'
 
+FULL_HELP = 'rebuild everything instead of applying the changes since the last generate'
+
+NO_PSL_CACHE_HELP = 'do not load or save the public suffix lookup cache in ' + CACHE_DIRECTORY.as_posix()
+
+LOCAL_ONLY_HELP = 'reuse the remote sources from the last generate instead of fetching them'
+
+DOMAINS_FILE_HELP = 'also read domains from FILE, one per line ("-" for stdin)'
+
+NO_GENERATE_HELP = 'only edit the list, run "dnsgate generate" later to apply it'
+
+COMPACT_HELP = 'keep the remote, rule and final domain sets packed into sorted byte buffers, ' + \
+    'several times less memory for large lists, always rebuilds everything and does not load or save the ' + \
+    'public suffix lookup cache (use with --fetch-jobs 1 on small machines)'
+
+FORCE_WRITE_HELP = 'rewrite the output file and reload dnsmasq even if the rules did not change'
+
+STATS_JSON_HELP = 'write per-stage timings, domain counts and per-source cache results to PATH as JSON'
+
+STATS_PROMETHEUS_HELP = 'write the same stats to PATH in the Prometheus textfile-collector format'
+
+DNSMASQ_RELOAD_HELP = 'restart: include the output as dnsmasq config and restart dnsmasq on changes. ' + \
+    'sighup: write it as a servers-file and reload it with SIGHUP, keeping the dnsmasq cache ' + \
+    '(NXDOMAIN only, not with --dest-ip)'
+
+OUTPUT_FORMAT_HELP = 'write the output as dnsmasq config, a dnsmasq servers-file, hosts, a BIND RPZ zone ' + \
+    'or an unbound local-zone include (defaults to what --mode implies, --mode dnsmasq only takes dnsmasq, ' + \
+    'or servers-file with --dnsmasq-reload sighup)'
+
+OUTPUT_SHARDS_HELP = 'split the output into this many files in <output>.d/ and only rewrite the ones ' + \
+    'that changed, <output> then only includes them (0, the default, writes one file)'
+
 NO_RESTART_DNSMASQ_HELP = 'do not restart the dnsmasq service'
 
 BLACKLIST_HELP = 'Add domain(s) to ' + CUSTOM_BLACKLIST.as_posix()
 
 WHITELIST_HELP = 'Add domain(s) to ' + CUSTOM_WHITELIST.as_posix()
 
-DISABLE_HELP = 'Disable ' + OUTPUT_FILE_PATH.as_posix()
+DISABLE_HELP = 'Disable ' + OUTPUT_FILE_PATH.as_posix() + \
+    ', with TIMEOUT re-enable after TIMEOUT seconds (returns at once, a background dnsgate reenable waits)'
 
 ENABLE_HELP = 'Enable ' + OUTPUT_FILE_PATH.as_posix()
 
+REENABLE_HELP = 'Enable ' + OUTPUT_FILE_PATH.as_posix() + \
+    ' if the TIMEOUT of the last "dnsgate disable TIMEOUT" ran out, ' + \
+    'for a timer unit or cron (the deadline is in ' + REENABLE_DEADLINE_FILE.as_posix() + ')'
+
+REENABLE_WAIT_HELP = 'sleep until the deadline instead of only checking it, ' + \
+    'at most one dnsgate reenable --wait runs at a time'
+
 CONFIGURE_HELP = '''Write ''' + CONFIG_FILE.as_posix() + '''
 \b
 
@@ -78,3 +163,15 @@ GENERATE_HELP = 'Create ' + OUTPUT_FILE_PATH.as_posix()
 
 BLOCKALL_HELP = 'return NXDOMAIN on _ALL_ domains'
 
+SERVE_HELP = 'Answer DNS queries with the rules of the last "dnsgate generate", forward the rest to --upstream'
+
+SERVE_LISTEN_HELP = 'address to listen on for udp and tcp queries (defaults to ' + SERVE_LISTEN_ADDRESS + ')'
+
+SERVE_PORT_HELP = 'port to listen on (defaults to ' + str(SERVE_PORT) + ')'
+
+SERVE_UPSTREAM_HELP = 'IP address of the resolver to forward queries that are not blocked to'
+
+SERVE_UPSTREAM_PORT_HELP = 'port of the upstream resolver (defaults to ' + str(SERVE_UPSTREAM_PORT) + ')'
+
+SERVE_CACHE_SIZE_HELP = 'number of upstream answers to cache (defaults to ' + str(SERVE_CACHE_SIZE) + ')'
+
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Streaming hosts-format parser.
+#
+# A remote list is parsed in the chunks it is read in (from the HTTP
+# response while it downloads, or from the cached copy) instead of as one
+# bytes object. The names of each chunk are validated and added to the
+# result right away, so parsing holds the domain set plus one chunk, never
+# the raw list next to the set.
+#
+# Every chunk is cut after its last '\n' and the whole lines go through
+# extract_domain_set_from_hosts_format_bytes(), the line that continues
+# goes in front of the next chunk. So a list parses exactly like it did in
+# one piece, comments, IDN names, CRLF line ends and the skipped loopback
+# names included.
+#
+# With generate --jobs N the parsing moves to a pool of N processes:
+# PooledHostsParser cuts what it is fed into PARSE_BATCH_SIZE batches of
+# whole lines, each batch is parsed and validated in a worker and the
+# returned sets are merged in the order they were submitted. Downloads and
+# cache reads of every source feed the same pool, so one large source
+# spreads over all cores as well as many small ones.
+#
+# A list that can not be parsed raises HostsParseError, a worker that dies
+# (killed by the OOM killer, say) breaks the pool and every source with
+# batches in it gets BrokenProcessPool. Either way only those sources
+# fail: the first parser to see the pool broken starts a new one for the
+# sources that come after.
+
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from urltool import extract_domain_set_from_hosts_format_bytes
+from logtool import LOG
+from logtool import leprint
+from urltool import validate_domain_list
+
+from .global_vars import FETCH_CHUNK_SIZE
+from .global_vars import PARSE_BATCH_SIZE
+from .validate import ValidatedDomains
+
+
+class HostsParseError(ValueError):
+    pass
+
+
+class HostsParser():
+    def __init__(self):
+        self.domains = ValidatedDomains()
+        self.partial = b''  # a line that continues in the next chunk
+
+    def feed(self, chunk: bytes) -> None:
+        data = self.partial + chunk
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        if end:
+            self.add_lines(data[:end])
+
+    def close(self) -> ValidatedDomains:
+        if self.partial:
+            self.add_lines(self.partial)
+            self.partial = b''
+        return self.domains
+
+    def add_lines(self, lines: bytes) -> None:
+        # lines are whole lines of the list. Whatever urltool raises on
+        # them fails this list, not the whole run
+        try:
+            self.domains |= validate_domain_list(extract_domain_set_from_hosts_format_bytes(lines))
+        except Exception as e:
+            raise HostsParseError('%s: %s' % (type(e).__name__, e)) from e
+
+
+def parse_hosts_batch(batch: bytes) -> ValidatedDomains:
+    # runs in a worker process, batch ends on a line boundary
+    parser = HostsParser()
+    parser.add_lines(batch)
+    return parser.domains
+
+
+class PooledHostsParser():
+    def __init__(self, pool, *,
+                 batch_size: int = PARSE_BATCH_SIZE,
+                 ):
+        self.pool = pool
+        self.executor = pool.executor   # all batches go to the pool this source started on
+        self.batch_size = batch_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.domains = ValidatedDomains()
+
+    def feed(self, chunk: bytes) -> None:
+        self.buffer += chunk
+        if len(self.buffer) >= self.batch_size:
+            end = self.buffer.rfind(b'\n') + 1
+            if end:
+                self.submit(bytes(self.buffer[:end]))
+                del self.buffer[:end]
+
+    def submit(self, batch: bytes) -> None:
+        # a download faster than the workers waits here instead of
+        # queueing the rest of the list in memory
+        while len(self.pending) >= 2 * self.pool.jobs:
+            self.collect()
+        try:
+            self.pending.append(self.executor.submit(parse_hosts_batch, batch))
+        except BrokenProcessPool:
+            self.pool.replace_broken(self.executor)
+            raise
+
+    def collect(self) -> None:
+        try:
+            self.domains |= self.pending.popleft().result()
+        except BrokenProcessPool:
+            self.pool.replace_broken(self.executor)
+            raise
+
+    def close(self) -> ValidatedDomains:
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.collect()
+        return self.domains
+
+
+class ParsePool():
+    # the workers of generate --jobs, shared by the parsers of all sources.
+    # forkserver, because the fetch threads are already running when the
+    # first batch starts a worker, and forking a threaded process can copy
+    # a held lock into the child
+    def __init__(self, jobs: int):
+        self.jobs = jobs
+        self.executor = None
+        self.lock = threading.Lock()
+        if jobs > 1:
+            self.executor = self.new_executor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+
+    def new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.jobs,
+                                   mp_context=multiprocessing.get_context('forkserver'),)
+
+    def replace_broken(self, executor: ProcessPoolExecutor) -> None:
+        # every parser that used executor calls this, only the first one
+        # replaces it
+        with self.lock:
+            if self.executor is not executor:
+                return
+            leprint("WARNING: a parse worker died, starting %d new ones.", self.jobs, level=LOG['WARNING'])
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.new_executor()
+
+    def parser(self):
+        if self.executor:
+            return PooledHostsParser(self)
+        return HostsParser()
+
+
+def parse_hosts_chunks(chunks, *,
+                       parser=None,
+                       ) -> ValidatedDomains:
+    if parser is None:
+        parser = HostsParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def read_file_chunks(path, *,
+                     chunk_size: int = FETCH_CHUNK_SIZE,
+                     ):
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Persisted build state for incremental "dnsgate generate".
+#
+# A full generate computes, in order:
+#
+#   remote        R  union of every validated remote source
+#   remote_rules  X  R after --block-at-psl stripping/re-adding and the whitelist
+#                    (without --block-at-psl X is simply R - whitelist)
+#   rules         S  X | validated local blacklist
+#   final         F  S without rules that a parent rule already covers
+#
+# These, plus the whitelist and blacklist they were built from, are
+# written to BUILD_STATE_DIRECTORY. S is only kept as a sorted list for
+# subdomain lookups, membership is answered from X (or R and the
+# whitelist) and the blacklist instead of a second set.
+#
+# The next generate diffs its inputs against them and only re-derives the
+# parts of X, S and F that sit at or under a changed domain, so PSL lookups
+# and redundant-rule checks are proportional to the change instead of to
+# the whole list.
+
+import bisect
+import json
+import os
+from itertools import chain
+from typing import Optional
+
+from logtool import LOG
+from logtool import leprint
+
+from .domain_file import DomainFileError
+from .domain_file import read_domain_file
+from .domain_file import read_domain_list
+from .domain_file import write_domain_file
+from .global_vars import BUILD_STATE_DIRECTORY
+from .packed import KEY_SEPARATOR
+from .packed import KEY_SUBTREE_END
+from .packed import PackedDomains
+from .packed import packed_final_rules
+from .packed import packed_remote_keys
+from .packed import packed_rules
+from .packed import reversed_labels
+from .packed import sorted_keys
+from .psl import psl_domain
+from .psl import remote_rules_at_psl
+from .validate import ValidatedDomains
+
+BUILD_STATE_VERSION = 2     # 2: sorted by label, see KEY_SEPARATOR
+
+
+def has_parent_rule(domain: bytes, rules) -> bool:
+    labels = domain.split(b'.')
+    for index in range(1, len(labels)):
+        if b'.'.join(labels[index:]) in rules:
+            return True
+    return False
+
+
+class SortedDomainList():
+    # domains sorted by their packed key (see packed.py), which puts every
+    # subdomain of a domain in one contiguous slice
+    def __init__(self, domains=(), *, presorted: bool = False):
+        if presorted:
+            self.domains = list(domains)
+        else:
+            self.domains = sorted(domains, key=reversed_labels)
+
+    def __len__(self):
+        return len(self.domains)
+
+    def __iter__(self):
+        return iter(self.domains)
+
+    def subdomains(self, domain: bytes) -> list:
+        # every key that starts with the key of domain and a separator
+        key = reversed_labels(domain)
+        low = bisect.bisect_left(self.domains, key + KEY_SEPARATOR, key=reversed_labels)
+        high = bisect.bisect_left(self.domains, key + KEY_SUBTREE_END, lo=low, key=reversed_labels)
+        return self.domains[low:high]
+
+    def update(self, *, added, removed) -> None:
+        # a few inserts are cheaper than a re-sort, lots of them are not
+        if len(added) + len(removed) > len(self.domains) // 16:
+            removed = set(removed)
+            self.domains = sorted(chain((domain for domain in self.domains if domain not in removed), added),
+                                  key=reversed_labels)
+            return
+        for domain in removed:
+            key = reversed_labels(domain)
+            index = bisect.bisect_left(self.domains, key, key=reversed_labels)
+            if index < len(self.domains) and self.domains[index] == domain:
+                del self.domains[index]
+        for domain in added:
+            bisect.insort(self.domains, domain, key=reversed_labels)
+
+
+class BuildState():
+    def __init__(self, *,
+                 mode: str,
+                 block_at_psl: bool,
+                 remote: SortedDomainList,
+                 whitelist: set,
+                 blacklist: set,
+                 remote_rules: Optional[set],
+                 rules: SortedDomainList,
+                 final: set,
+                 remote_set: Optional[set] = None,
+                 rule_index_tag: Optional[str] = None,
+                 ):
+        self.mode = mode
+        self.block_at_psl = block_at_psl
+        self.remote = remote
+        self.remote_set = ValidatedDomains(remote) if remote_set is None else remote_set
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self.remote_rules = remote_rules    # only kept with block_at_psl
+        self.rules = rules
+        self.final = final
+        self.unchanged = False                  # no input changed since the state was saved
+        self.rule_index_tag = rule_index_tag    # the stat of the rule index written with it
+
+    def __contains__(self, domain: bytes) -> bool:
+        # is domain in S
+        return domain in self.blacklist or self.in_remote_rules(domain)
+
+    def in_remote_rules(self, domain: bytes) -> bool:
+        # is domain in X
+        if self.block_at_psl:
+            return domain in self.remote_rules
+        return domain in self.remote_set and domain not in self.whitelist
+
+    def remote_rule_keys(self):
+        # X as sorted keys, picked out of S rather than sorted again
+        for domain in self.rules:
+            if self.in_remote_rules(domain):
+                yield reversed_labels(domain)
+
+
+class PreviousRules():
+    # S as it was before an update: current membership flipped for every
+    # domain whose membership changed
+    def __init__(self, state: BuildState, *, changed: set):
+        self.state = state
+        self.changed = changed
+
+    def __contains__(self, domain: bytes) -> bool:
+        return (domain in self.state) != (domain in self.changed)
+
+
+def build_state_path(name: str):
+    return BUILD_STATE_DIRECTORY / name
+
+
+def load_build_state(*,
+                     mode: str,
+                     block_at_psl: bool,
+                     ) -> Optional[BuildState]:
+    try:
+        with open(build_state_path('state.json'), 'r') as fh:
+            meta = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if meta.get('version') != BUILD_STATE_VERSION:
+        return None
+    if meta.get('mode') != mode or meta.get('block_at_psl') != block_at_psl:
+        leprint("Build state was made with different settings, ignoring it.", level=LOG['INFO'])
+        return None
+
+    try:
+        _, remote = read_domain_list(build_state_path('remote'))
+        _, rules = read_domain_list(build_state_path('rules'))
+        remote_rules = None
+        if block_at_psl:
+            _, remote_rules = read_domain_file(build_state_path('remote_rules'))
+        _, final = read_domain_file(build_state_path('final'))
+        _, whitelist = read_domain_file(build_state_path('whitelist'), set_type=ValidatedDomains)
+        _, blacklist = read_domain_file(build_state_path('blacklist'), set_type=ValidatedDomains)
+    except (FileNotFoundError, DomainFileError) as e:
+        leprint("Build state is incomplete (%s), ignoring it.", e, level=LOG['WARNING'])
+        return None
+
+    return BuildState(mode=mode,
+                      block_at_psl=block_at_psl,
+                      remote=SortedDomainList(remote, presorted=True),
+                      whitelist=whitelist,
+                      blacklist=blacklist,
+                      remote_rules=remote_rules,
+                      rules=SortedDomainList(rules, presorted=True),
+                      final=final,
+                      rule_index_tag=meta.get('rule_index_tag'),)
+
+
+def save_build_state(state: BuildState) -> None:
+    os.makedirs(BUILD_STATE_DIRECTORY, exist_ok=True)
+    # state.json goes last and first goes away, so a crash mid-save leaves
+    # no state rather than a mix of two runs
+    try:
+        os.remove(build_state_path('state.json'))
+    except FileNotFoundError:
+        pass
+    write_domain_file(path=build_state_path('remote'), domains=state.remote, presorted=True)
+    write_domain_file(path=build_state_path('rules'), domains=state.rules, presorted=True)
+    if state.block_at_psl:
+        write_domain_file(path=build_state_path('remote_rules'), domains=state.remote_rules)
+    # packed sets are already in a stable order, sorting would unpack them
+    write_domain_file(path=build_state_path('final'), domains=state.final,
+                      presorted=isinstance(state.final, PackedDomains))
+    write_domain_file(path=build_state_path('whitelist'), domains=state.whitelist)
+    write_domain_file(path=build_state_path('blacklist'), domains=state.blacklist)
+    meta = {'version': BUILD_STATE_VERSION,
+            'mode': state.mode,
+            'block_at_psl': state.block_at_psl,
+            'rule_index_tag': state.rule_index_tag,
+            }
+    tmp_path = build_state_path('state.json.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(tmp_path, build_state_path('state.json'))
+
+
+def make_build_state(*,
+                     mode: str,
+                     block_at_psl: bool,
+                     remote: set,
+                     whitelist: set,
+                     blacklist: set,
+                     remote_rules: Optional[set],
+                     final: set,
+                     ) -> BuildState:
+    # takes ownership of the sets it is given, nothing is copied
+    if block_at_psl:
+        remote_rules_iter = remote_rules
+        in_remote_rules = remote_rules.__contains__
+    else:
+        remote_rules = None
+        remote_rules_iter = (domain for domain in remote if domain not in whitelist)
+
+        def in_remote_rules(domain):
+            return domain in remote and domain not in whitelist
+    rules = chain(remote_rules_iter, (domain for domain in blacklist if not in_remote_rules(domain)))
+    return BuildState(mode=mode,
+                      block_at_psl=block_at_psl,
+                      remote=SortedDomainList(remote),
+                      remote_set=remote,
+                      whitelist=whitelist,
+                      blacklist=blacklist,
+                      remote_rules=remote_rules,
+                      rules=SortedDomainList(rules),
+                      final=final,)
+
+
+def build_packed_state(*,
+                       mode: str,
+                       block_at_psl: bool,
+                       remote: PackedDomains,
+                       whitelist: set,
+                       blacklist: set,
+                       ) -> BuildState:
+    # the full build for --compact: R, S and F stay packed, S and F come
+    # from merges and one pass over sorted keys instead of a DomainTrie
+    if block_at_psl:
+        remote_rules = remote_rules_at_psl(remote, whitelist)
+        remote_rules_keys = sorted_keys(remote_rules)
+    else:
+        remote_rules = None
+        remote_rules_keys = packed_remote_keys(remote, whitelist)
+    rules = packed_rules(remote_rules=remote_rules_keys, blacklist=blacklist)
+    final = packed_final_rules(rules)
+    leprint('%d rules, %d after removing redundant rules.', len(rules), len(final), level=LOG['INFO'])
+    return BuildState(mode=mode,
+                      block_at_psl=block_at_psl,
+                      remote=remote,
+                      remote_set=remote,
+                      whitelist=whitelist,
+                      blacklist=blacklist,
+                      remote_rules=remote_rules,
+                      rules=rules,
+                      final=final,)
+
+
+def update_build_state(state: BuildState, *,
+                       remote: set,
+                       whitelist: set,
+                       blacklist: set,
+                       ) -> set:
+    # returns the new final rule set, state is updated in place
+    remote_added = remote - state.remote_set
+    remote_removed = state.remote_set - remote
+    whitelist_changed = whitelist ^ state.whitelist
+    blacklist_changed = blacklist ^ state.blacklist
+    leprint("Changes since the last generate: +%d -%d remote, %d whitelist, %d blacklist.",
+            len(remote_added), len(remote_removed), len(whitelist_changed), len(blacklist_changed),
+            level=LOG['INFO'])
+
+    remote_changed = remote_added | remote_removed
+    state.unchanged = not (remote_changed or whitelist_changed or blacklist_changed)
+    state.remote.update(added=remote_added, removed=remote_removed)
+    state.remote_set = remote
+    state.whitelist = whitelist
+    state.blacklist = blacklist
+
+    if state.block_at_psl:
+        remote_rules_changed = update_remote_rules_at_psl(state,
+                                                          remote_added=remote_added,
+                                                          remote_removed=remote_removed,
+                                                          whitelist_changed=whitelist_changed,)
+        candidates = remote_rules_changed | blacklist_changed
+    else:
+        candidates = remote_changed | whitelist_changed | blacklist_changed
+
+    def was_rule(domain):
+        # S membership before this update, from the inputs and what changed in them
+        if (domain in blacklist) != (domain in blacklist_changed):
+            return True
+        if state.block_at_psl:
+            return (domain in state.remote_rules) != (domain in remote_rules_changed)
+        in_remote = (domain in remote) != (domain in remote_changed)
+        in_whitelist = (domain in whitelist) != (domain in whitelist_changed)
+        return in_remote and not in_whitelist
+
+    rules_added = set()
+    rules_removed = set()
+    for domain in candidates:
+        wanted = domain in state
+        if wanted != was_rule(domain):
+            if wanted:
+                rules_added.add(domain)
+            else:
+                rules_removed.add(domain)
+
+    update_final_rules(state, rules_added=rules_added, rules_removed=rules_removed)
+    leprint("%d rules added and %d removed, %d final rules.",
+            len(rules_added), len(rules_removed), len(state.final), level=LOG['INFO'])
+    return state.final
+
+
+def update_remote_rules_at_psl(state: BuildState, *,
+                               remote_added: set,
+                               remote_removed: set,
+                               whitelist_changed: set,
+                               ) -> set:
+    # X is a union of independent per-psl-domain groups, only groups that
+    # gained or lost a member or a whitelist entry are re-derived
+    whitelist_psls = {psl_domain(domain) for domain in state.whitelist}
+    removed_by_psl = {}
+    for domain in remote_removed:
+        removed_by_psl.setdefault(psl_domain(domain), []).append(domain)
+    affected_psls = set(removed_by_psl)
+    affected_psls.update(psl_domain(domain) for domain in chain(remote_added, whitelist_changed))
+
+    changed = set()
+    for group_psl in affected_psls:
+        candidates = state.remote.subdomains(group_psl)
+        if group_psl in state.remote_set:
+            candidates.append(group_psl)
+        members = [domain for domain in candidates if psl_domain(domain) == group_psl]
+
+        if members and group_psl not in state.whitelist and group_psl not in whitelist_psls:
+            contribution = {group_psl}
+        else:
+            contribution = {domain for domain in members if domain not in state.whitelist}
+
+        previous = state.remote_rules.intersection(chain([group_psl], members, removed_by_psl.get(group_psl, ())))
+        for domain in previous - contribution:
+            state.remote_rules.discard(domain)
+            changed.add(domain)
+        for domain in contribution - previous:
+            state.remote_rules.add(domain)
+            changed.add(domain)
+    return changed
+
+
+def update_final_rules(state: BuildState, *,
+                       rules_added: set,
+                       rules_removed: set,
+                       ) -> None:
+    # F only changes at or below a rule that was added or removed, and not
+    # at all below one that a parent rule covered before and after
+    changed = rules_added | rules_removed
+    previous_rules = PreviousRules(state, changed=changed)
+    regions = [domain for domain in changed
+               if not (has_parent_rule(domain, previous_rules) and has_parent_rule(domain, state))]
+
+    for domain in regions:
+        state.final.discard(domain)
+        state.final.difference_update(state.rules.subdomains(domain))
+
+    state.rules.update(added=rules_added, removed=rules_removed)
+
+    for domain in regions:
+        for candidate in chain([domain], state.rules.subdomains(domain)):
+            if candidate in state and not has_parent_rule(candidate, state):
+                state.final.add(candidate)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Output file writer and the output formats it can write.
+#
+# Every line of a format is <prefix><domain><suffix>, so the pair is
+# encoded once up front and a chunk of domains becomes one bytes join:
+#
+#   prefix + (suffix + prefix).join(chunk) + suffix
+#
+# Domains stay bytes the whole way and each chunk is a single write().
+# Formats that need more than one line per domain (an RPZ wildcard, an
+# Unbound local-data record) make one pass over the domains per line
+# template, the order of records does not matter to those resolvers.
+#
+#   dnsmasq       address=/.example.com/ip or server=/.example.com/ lines
+#   servers-file  server=/.example.com/ lines for dnsmasq --servers-file
+#   hosts         ip example.com lines
+#   rpz           a BIND/Knot/PowerDNS response policy zone
+#   unbound       local-zone: lines for an unbound include
+#
+# OUTPUT_FORMATS maps a name to a function of dest_ip returning an
+# OutputFormat, registering another function there adds a format.
+#
+# dnsgate blockall writes the root domain alone. The formats whose syntax
+# has no line for it (an RPZ or unbound name can not be '..') give the
+# records that match every name as root_records instead, hosts files have
+# no such record and can not be used for blockall.
+#
+# With output_shards = N the records go to N files in <output>.d/, a
+# domain lands in the crc32(domain) % N one, so a small change to the rule
+# set only rewrites the shards it touches. <output> itself then holds the
+# one include line the format has for a directory (conf-dir= for dnsmasq,
+# include: for unbound), which keeps enable/disable to the one symlink.
+#
+# The header carries a fingerprint of the configuration and the sorted
+# domains, so generate can tell an unchanged output from the first lines of
+# the existing file and skip both the write and the dnsmasq reload.
+
+import hashlib
+import json
+import os
+import time
+import zlib
+from itertools import islice
+from pathlib import Path
+from typing import Optional
+
+from .dnsmasq import dnsmasq_layout
+from .global_vars import OUTPUT_CHUNK_LINES
+from .global_vars import OUTPUT_SHARD_SUFFIX
+from .global_vars import RPZ_TTL
+
+OUTPUT_FINGERPRINT_LABEL = b' fingerprint: '
+ROOT_DOMAIN = b'.'
+SHARD_EXTENSION = b'.conf'
+
+
+class OutputFormatError(ValueError):
+    pass
+
+
+class OutputFormat():
+    def __init__(self, *,
+                 name: str,
+                 passes: list,
+                 comment: bytes = b'#',
+                 preamble=None,
+                 include_line=None,
+                 root_records: Optional[bytes] = None,
+                 reloads_dnsmasq: bool = False,
+                 ):
+        self.name = name
+        self.passes = passes                    # [(prefix, suffix)], one pass over the domains each
+        self.comment = comment                  # comment marker the header lines get
+        self.preamble = preamble                # called for bytes written between header and records
+        self.include_line = include_line        # called with a shard directory, None if it can not be sharded
+        self.root_records = root_records        # what blocks every name, None if the format can not
+        self.reloads_dnsmasq = reloads_dnsmasq  # dnsmasq reads this file, reload it on changes
+
+
+def dnsmasq_format(dest_ip) -> OutputFormat:
+    if dest_ip:
+        passes = [(b'address=/.', b'/' + dest_ip.encode('ascii') + b'\n')]
+    else:
+        passes = [(b'server=/.', b'/\n')]  # return NXDOMAIN
+    prefix, suffix = passes[0]
+    return OutputFormat(name='dnsmasq',
+                        passes=passes,
+                        root_records=prefix + ROOT_DOMAIN + suffix,
+                        include_line=lambda directory: b'conf-dir=%s,*%s\n' % (directory, SHARD_EXTENSION),
+                        reloads_dnsmasq=True,)
+
+
+def servers_file_format(dest_ip) -> OutputFormat:
+    if dest_ip:
+        raise OutputFormatError('a dnsmasq servers-file can only return NXDOMAIN, unset dest_ip')
+    return OutputFormat(name='servers-file',
+                        passes=[(b'server=/.', b'/\n')],
+                        root_records=b'server=/.' + ROOT_DOMAIN + b'/\n',
+                        reloads_dnsmasq=True,)
+
+
+def hosts_format(dest_ip) -> OutputFormat:
+    if not dest_ip:
+        dest_ip = '127.0.0.1'
+    return OutputFormat(name='hosts', passes=[(dest_ip.encode('ascii') + b' ', b'\n')])
+
+
+def rpz_format(dest_ip) -> OutputFormat:
+    if dest_ip:
+        record_type = b'AAAA' if ':' in dest_ip else b'A'
+        rdata = b' ' + record_type + b' ' + dest_ip.encode('ascii') + b'\n'
+    else:
+        rdata = b' CNAME .\n'   # NXDOMAIN
+    return OutputFormat(name='rpz',
+                        passes=[(b'', rdata), (b'*.', rdata)],
+                        root_records=b'*' + rdata,     # every name under the zone origin
+                        comment=b';',
+                        preamble=rpz_preamble,)
+
+
+def rpz_preamble() -> bytes:
+    # the serial only has to grow between writes for secondaries to transfer
+    return (b'$TTL %d\n'
+            b'@ IN SOA localhost. root.localhost. %d 3600 600 86400 %d\n'
+            b'@ IN NS localhost.\n\n') % (RPZ_TTL, int(time.time()), RPZ_TTL)
+
+
+def unbound_format(dest_ip) -> OutputFormat:
+    if dest_ip:
+        record_type = b'AAAA' if ':' in dest_ip else b'A'
+        passes = [(b'local-zone: "', b'." redirect\n'),
+                  (b'local-data: "', b'. ' + record_type + b' ' + dest_ip.encode('ascii') + b'"\n')]
+    else:
+        passes = [(b'local-zone: "', b'." always_nxdomain\n')]
+    # the suffixes start with the trailing dot of the name, the root is only that dot
+    root_records = b''.join(prefix + ROOT_DOMAIN + suffix[1:] for prefix, suffix in passes)
+    return OutputFormat(name='unbound',
+                        passes=passes,
+                        root_records=root_records,
+                        preamble=lambda: b'server:\n',
+                        include_line=lambda directory: b'include: "%s/*%s"\n' % (directory, SHARD_EXTENSION),)
+
+
+OUTPUT_FORMATS = {'dnsmasq': dnsmasq_format,
+                  'servers-file': servers_file_format,
+                  'hosts': hosts_format,
+                  'rpz': rpz_format,
+                  'unbound': unbound_format}
+
+
+def output_format(name: str, *, dest_ip) -> OutputFormat:
+    try:
+        make_format = OUTPUT_FORMATS[name]
+    except KeyError as e:
+        raise OutputFormatError('unknown output format: ' + name) from e
+    return make_format(dest_ip)
+
+
+def config_output_format(config) -> OutputFormat:
+    # output_format from the config file, or the one mode and the dnsmasq layout imply
+    name = config.output_format
+    if not name:
+        name = {'conf-dir': config.mode,
+                'servers-file': 'servers-file'}[dnsmasq_layout(config)]
+    return output_format(name, dest_ip=config.dest_ip)
+
+
+def shard_directory(output_path) -> Path:
+    return Path(str(output_path) + OUTPUT_SHARD_SUFFIX)
+
+
+def shard_path(directory: Path, index: int) -> Path:
+    return directory / ('shard-%03d%s' % (index, SHARD_EXTENSION.decode('ascii')))
+
+
+def split_shards(domains, shards: int) -> list:
+    # keeps the order of domains (group_by_tld) within every shard
+    buckets = [[] for _ in range(shards)]
+    appends = [bucket.append for bucket in buckets]
+    for domain in domains:
+        appends[zlib.crc32(domain) % shards](domain)
+    return buckets
+
+
+def write_output_shards(directory: Path, domains, *,
+                        output: OutputFormat,
+                        shards: int,
+                        config_dict: dict,
+                        make_header,
+                        ) -> tuple:
+    # returns (lines written, shards rewritten), a shard whose fingerprint
+    # matches its content is left alone
+    os.makedirs(directory, exist_ok=True)
+    count = 0
+    rewritten = 0
+    for index, shard_domains in enumerate(split_shards(domains, shards)):
+        path = shard_path(directory, index)
+        fingerprint = output_fingerprint(config_dict=config_dict, domains=shard_domains)
+        count += len(shard_domains) * len(output.passes)
+        if read_output_fingerprint(path, comment=output.comment) == fingerprint:
+            continue
+        tmp_path = path.with_name('.' + path.name + '.tmp')   # not matched by the include glob
+        with open(tmp_path, 'wb') as fh:
+            write_output(fh, shard_domains, output=output, header=make_header(fingerprint))
+        os.replace(tmp_path, path)
+        rewritten += 1
+    # from an earlier run with more shards
+    for path in directory.glob('shard-*' + SHARD_EXTENSION.decode('ascii')):
+        index = path.name[len('shard-'):-len(SHARD_EXTENSION)]
+        if index.isdigit() and int(index) >= shards:
+            os.remove(path)
+    return count, rewritten
+
+
+def comment_header(header: bytes, comment: bytes) -> bytes:
+    # headers are built with '#' comments, zone files want ';'
+    if comment == b'#':
+        return header
+    return b'\n'.join(comment + line[1:] if line.startswith(b'#') else line
+                      for line in header.split(b'\n'))
+
+
+def write_output(fh, domains, *,
+                 output: OutputFormat,
+                 header: bytes,
+                 ) -> int:
+    # domains is iterated once per pass, so it has to be a sequence
+    fh.write(comment_header(header, output.comment))
+    if output.preamble:
+        fh.write(output.preamble())
+    if output.root_records is not None and len(domains) == 1 and ROOT_DOMAIN in domains:
+        fh.write(output.root_records)   # dnsgate blockall
+        return 1
+    count = 0
+    for prefix, suffix in output.passes:
+        count += write_domain_lines(fh, domains, prefix=prefix, suffix=suffix)
+    return count
+
+
+def write_domain_lines(fh, domains, *,
+                       prefix: bytes,
+                       suffix: bytes,
+                       chunk_lines: int = OUTPUT_CHUNK_LINES,
+                       ) -> int:
+    separator = suffix + prefix
+    domains = iter(domains)
+    count = 0
+    while True:
+        chunk = list(islice(domains, chunk_lines))
+        if not chunk:
+            return count
+        fh.write(prefix + separator.join(chunk) + suffix)
+        count += len(chunk)
+
+
+def output_fingerprint(*,
+                       config_dict: dict,
+                       domains,
+                       chunk_lines: int = OUTPUT_CHUNK_LINES,
+                       ) -> str:
+    digest = hashlib.sha1(json.dumps(config_dict, sort_keys=True, default=str).encode('utf8'))
+    domains = iter(domains)
+    while True:
+        chunk = list(islice(domains, chunk_lines))
+        if not chunk:
+            return digest.hexdigest()
+        digest.update(b'\n'.join(chunk) + b'\n')
+
+
+def read_output_fingerprint(path, *,
+                            comment: bytes = b'#',
+                            ) -> Optional[str]:
+    # from the comment header, None if there is no file or no fingerprint
+    fingerprint_prefix = comment + OUTPUT_FINGERPRINT_LABEL
+    try:
+        with open(path, 'rb') as fh:
+            for line in fh:
+                if line == b'\n':
+                    continue
+                if not line.startswith(comment):
+                    return None
+                if line.startswith(fingerprint_prefix):
+                    return line[len(fingerprint_prefix):].strip().decode('ascii')
+    except FileNotFoundError:
+        pass
+    return None
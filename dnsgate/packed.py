@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Packed, sorted domain storage for "dnsgate generate --compact".
+#
+# A set of bytes costs ~80-100 bytes per domain in object headers and hash
+# slots on top of the name. PackedDomains keeps the names as label-reversed
+# keys (com\0example\0www) concatenated into one buffer, sorted, with a
+# uint32 offset array: the name plus 4 bytes per domain.
+#
+# The labels of a key are joined with KEY_SEPARATOR, a byte below any a
+# label holds, so bytewise key order is label by label order: com.example,
+# com.example.www, com.example-ads, the order group_by_tld() sorts into.
+# With '.' the '-' of example-ads would sort before the '.' of
+# example.www, and --compact output would differ from the regular one.
+#
+#   membership     binary search, O(log n)
+#   subdomains     one contiguous slice, like SortedDomainList
+#   |= / update    merge of two sorted runs into a new buffer, the old one
+#                  is dropped as soon as the merge is done
+#   iteration      in key order, the order of group_by_tld(), each name
+#                  is a fresh bytes object
+#
+# It is a drop-in for the remote set and the SortedDomainList of the build
+# state, not a general set: there is no add(), and set operators other than
+# |= are not provided.
+
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+
+
+KEY_SEPARATOR = b'\0'
+KEY_SUBTREE_END = b'\1'     # key + this sorts after every key under key
+
+
+def reversed_labels(domain: bytes) -> bytes:
+    # the key of a domain
+    return KEY_SEPARATOR.join(reversed(domain.split(b'.')))
+
+
+def key_domain(key: bytes) -> bytes:
+    return b'.'.join(reversed(key.split(KEY_SEPARATOR)))
+
+
+class PackedKeys():
+    # the sorted keys as a sequence, for bisect
+    def __init__(self, packed):
+        self.packed = packed
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, index: int) -> bytes:
+        return self.packed.key(index)
+
+
+class PackedDomains():
+    def __init__(self, domains=()):
+        self.set_keys(())
+        if domains:
+            self.merge(domains)
+
+    @classmethod
+    def from_sorted_keys(cls, keys):
+        # keys must be sorted and unique
+        packed = cls()
+        packed.set_keys(keys)
+        return packed
+
+    def set_keys(self, keys) -> None:
+        data = bytearray()
+        offsets = array('I', [0])
+        for key in keys:
+            data += key
+            offsets.append(len(data))
+        self.data = memoryview(data)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for key in self.iter_keys():
+            yield key_domain(key)
+
+    def __contains__(self, domain: bytes) -> bool:
+        return self.contains_key(reversed_labels(domain))
+
+    def __ior__(self, domains):
+        self.merge(domains)
+        return self
+
+    def key(self, index: int) -> bytes:
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def iter_keys(self):
+        data = self.data
+        offsets = self.offsets
+        for index in range(len(offsets) - 1):
+            yield data[offsets[index]:offsets[index + 1]].tobytes()
+
+    def contains_key(self, key: bytes) -> bool:
+        index = bisect_left(PackedKeys(self), key)
+        return index < len(self) and self.key(index) == key
+
+    def has_parent_key(self, key: bytes) -> bool:
+        # a parent domain is a prefix of the key ending at a separator
+        end = key.find(KEY_SEPARATOR)
+        while end != -1:
+            if self.contains_key(key[:end]):
+                return True
+            end = key.find(KEY_SEPARATOR, end + 1)
+        return False
+
+    def subdomains(self, domain: bytes) -> list:
+        # every key that starts with the key of domain and a separator
+        key = reversed_labels(domain)
+        keys = PackedKeys(self)
+        low = bisect_left(keys, key + KEY_SEPARATOR)
+        high = bisect_left(keys, key + KEY_SUBTREE_END, lo=low)
+        return [key_domain(self.key(index)) for index in range(low, high)]
+
+    def merge(self, added, removed=()) -> None:
+        if isinstance(added, PackedDomains):
+            added_keys = added.iter_keys()
+        else:
+            added_keys = sorted({reversed_labels(domain) for domain in added})
+        removed_keys = {reversed_labels(domain) for domain in removed}
+        merged = (key for key, _ in groupby(heapq.merge(self.iter_keys(), added_keys))
+                  if key not in removed_keys)
+        self.set_keys(merged)
+
+    def update(self, *, added, removed) -> None:
+        # the SortedDomainList interface
+        self.merge(added, removed)
+
+
+def sorted_keys(domains):
+    # the sorted, unique reversed keys of any domain collection
+    if isinstance(domains, PackedDomains):
+        return domains.iter_keys()
+    return iter(sorted({reversed_labels(domain) for domain in domains}))
+
+
+def packed_rules(*,
+                 remote_rules,
+                 blacklist,
+                 ) -> PackedDomains:
+    # S, remote_rules may be a filtered generator of an already packed set
+    return PackedDomains.from_sorted_keys(key for key, _ in
+                                          groupby(heapq.merge(remote_rules, sorted_keys(blacklist))))
+
+
+def packed_final_rules(rules: PackedDomains) -> PackedDomains:
+    # F, rules without a parent rule, in one pass over the sorted keys
+    return PackedDomains.from_sorted_keys(unparented_keys(rules.iter_keys()))
+
+
+def unparented_keys(keys):
+    # Every key between a parent p and a key under it starts with p, so a
+    # stack of the keys that are byte prefixes of the current one still
+    # holds all of its parents. Prefixes that are not parents (example vs
+    # example-ads) stay on it too and are skipped by the separator check.
+    stack = []
+    for key in keys:
+        while stack and not key.startswith(stack[-1]):
+            stack.pop()
+        if not any(key[len(prefix):len(prefix) + 1] == KEY_SEPARATOR for prefix in stack):
+            yield key
+        stack.append(key)
+
+
+def packed_remote_keys(remote: PackedDomains, whitelist):
+    # X without block_at_psl: R - whitelist, still sorted
+    whitelist_keys = {reversed_labels(domain) for domain in whitelist}
+    return (key for key in remote.iter_keys() if key not in whitelist_keys)
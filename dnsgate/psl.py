@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Shared, bounded memo of extract_psl_domain() results.
+#
+# generate looks up the psl domain of the same names in several stages, and
+# most names come back on every run, so the memo can be saved to
+# CACHE_DIRECTORY and loaded by the next run. Saved entries are dropped
+# after PSL_CACHE_EXPIRE so public suffix list updates are picked up.
+#
+# It is kept to PSL_CACHE_SIZE recently used names, not sized to hold a
+# whole remote list: the incremental build only looks up the names at or
+# under a change, those are what repeat from run to run.
+
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from logtool import LOG
+from logtool import leprint
+from urltool import extract_psl_domain
+
+from .domain_file import DomainFileError
+from .domain_file import read_domain_list
+from .domain_file import write_domain_file
+from .global_vars import PSL_CACHE_EXPIRE
+from .global_vars import PSL_CACHE_FILE
+from .global_vars import PSL_CACHE_SIZE
+
+
+class PslCache():
+    def __init__(self, maxsize: int = PSL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.created = int(time.time())
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __call__(self, domain: bytes) -> bytes:
+        try:
+            domain_psl = self.entries[domain]
+        except KeyError:
+            self.misses += 1
+            domain_psl = extract_psl_domain(domain)
+            self.entries[domain] = domain_psl
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return domain_psl
+        self.hits += 1
+        self.entries.move_to_end(domain)
+        return domain_psl
+
+    def load(self, path: Path = PSL_CACHE_FILE) -> None:
+        try:
+            tag, lines = read_domain_list(path)
+        except (FileNotFoundError, DomainFileError):
+            return
+        try:
+            created = int(tag)
+        except ValueError:
+            leprint("PSL cache %s has no valid timestamp, ignoring it.", path, level=LOG['DEBUG'])
+            return
+        if created + PSL_CACHE_EXPIRE <= time.time():
+            leprint("PSL cache %s expired, ignoring it.", path, level=LOG['DEBUG'])
+            return
+        self.created = created
+        for line in lines[-self.maxsize:]:
+            domain, _, domain_psl = line.partition(b' ')
+            if domain_psl:
+                self.entries[domain] = domain_psl
+        leprint("Loaded %d PSL cache entries from %s", len(self.entries), path, level=LOG['DEBUG'])
+
+    def save(self, path: Path = PSL_CACHE_FILE) -> None:
+        # least recently used first, so load() keeps the most recent ones
+        write_domain_file(path=path,
+                          domains=[domain + b' ' + domain_psl for domain, domain_psl in self.entries.items()],
+                          tag=str(self.created),
+                          presorted=True,)
+        leprint("Saved %d PSL cache entries (%d hits, %d misses) to %s",
+                len(self.entries), self.hits, self.misses, path, level=LOG['DEBUG'])
+
+
+PSL_CACHE = PslCache()
+
+
+def psl_domain(domain: bytes) -> bytes:
+    return PSL_CACHE(domain)
+
+
+def remote_rules_at_psl(remote, whitelist) -> set:
+    # X with block_at_psl: a psl domain is blocked unless it, or something
+    # under it, is whitelisted, then its non-whitelisted members are instead
+    whitelist_psls = {psl_domain(domain) for domain in whitelist}
+    remote_rules = set()
+    for domain in remote:
+        domain_psl = psl_domain(domain)
+        if domain_psl not in whitelist and domain_psl not in whitelist_psls:
+            remote_rules.add(domain_psl)
+        elif domain not in whitelist:
+            leprint("Re-adding: %s", domain, level=LOG['DEBUG'])
+            remote_rules.add(domain)
+    return remote_rules
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Timed "dnsgate disable TIMEOUT" without holding the caller.
+#
+# disable writes the time to re-enable to REENABLE_DEADLINE_FILE and
+# returns. A detached "dnsgate reenable --wait" sleeps until then and runs
+# enable. It holds a flock on REENABLE_LOCK_FILE while it waits, so there is
+# only ever one: a second timed disable moves the deadline (to the later of
+# the two) and finds the waiting helper already there.
+#
+# The deadline outlives the helper. If the helper is killed or the machine
+# reboots, the next "dnsgate generate" re-enables first once the deadline
+# passed, and "dnsgate reenable" from a timer unit or cron does the same
+# without running anything else. No other command catches up (see
+# REENABLE_CATCH_UP_COMMANDS). enable (also a manual one) removes the
+# deadline, and the helper exits when it finds the deadline gone.
+
+import fcntl
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from .global_vars import REENABLE_CHECK_INTERVAL
+from .global_vars import REENABLE_DEADLINE_FILE
+from .global_vars import REENABLE_LOCK_FILE
+
+
+def read_reenable_deadline() -> Optional[float]:
+    try:
+        with open(REENABLE_DEADLINE_FILE, 'r') as fh:
+            return float(fh.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_reenable_deadline(deadline: float) -> None:
+    tmp_path = REENABLE_DEADLINE_FILE.with_name(REENABLE_DEADLINE_FILE.name + '.tmp')
+    with open(tmp_path, 'w') as fh:
+        fh.write('%f\n' % deadline)
+    os.replace(tmp_path, REENABLE_DEADLINE_FILE)
+
+
+def cancel_reenable() -> None:
+    try:
+        os.remove(REENABLE_DEADLINE_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def reenable_is_due() -> bool:
+    deadline = read_reenable_deadline()
+    return deadline is not None and deadline <= time.time()
+
+
+@contextmanager
+def reenable_lock():
+    # yields False if another helper already holds it
+    os.makedirs(REENABLE_LOCK_FILE.parent, exist_ok=True)
+    with open(REENABLE_LOCK_FILE, 'a') as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def helper_is_waiting() -> bool:
+    with reenable_lock() as locked:
+        return not locked
+
+
+def schedule_reenable(timeout: int) -> float:
+    # returns the deadline, overlapping disables coalesce to the later one
+    os.makedirs(REENABLE_DEADLINE_FILE.parent, exist_ok=True)
+    deadline = time.time() + timeout
+    current = read_reenable_deadline()
+    if current is not None and current > deadline:
+        deadline = current
+    write_reenable_deadline(deadline)
+    if not helper_is_waiting():
+        subprocess.Popen([sys.executable, '-m', 'dnsgate', 'reenable', '--wait'],
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL,
+                         start_new_session=True,)
+    return deadline
+
+
+def wait_for_reenable_deadline() -> bool:
+    # True once the deadline passed, False if it was removed (enabled by
+    # hand). It is re-read every REENABLE_CHECK_INTERVAL seconds, it may
+    # have moved in the meantime
+    while True:
+        deadline = read_reenable_deadline()
+        if deadline is None:
+            return False
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return True
+        time.sleep(min(remaining, REENABLE_CHECK_INTERVAL))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Binary rule index for long-running readers (dnsgate serve).
+#
+# generate writes RULE_INDEX_FILE next to the build state, readers mmap it
+# and binary search it in place instead of parsing text into sets:
+#
+#   header   b'DNSGIDX\0', version, count                   '<8sII'
+#   offsets  count + 1 uint32, where each key starts in data '<I' * (count + 1)
+#   flags    count bytes, what the domain is
+#   data     the keys, label-reversed domains joined by KEY_SEPARATOR
+#            (com\0example\0www) sorted bytewise, without separators
+#
+# A domain carries INDEX_BLACKLIST, INDEX_WHITELIST and/or INDEX_REMOTE.
+# The remote domains are X of the build state (see incremental.py), so a
+# name is blocked exactly when the generated rules block it, except that a
+# whitelisted name itself is not:
+#
+#   blocked = any suffix is blacklisted
+#             or (the name is not whitelisted
+#                 and any suffix is remote and not whitelisted)
+#
+# A lookup is one binary search per label of the queried name. The probed
+# keys are memoryview slices of the mapping, compared against a bytearray
+# of the name (bytes and memoryview do not order against each other), so
+# no key is copied out of the file. The file is replaced with a rename, a
+# reader keeps the mapping it has until it reopens, so a swap never shows
+# it half a file.
+
+import heapq
+import mmap
+import os
+import struct
+import sys
+from array import array
+from itertools import groupby
+from pathlib import Path
+
+from logtool import LOG
+from logtool import leprint
+
+from .packed import KEY_SEPARATOR
+from .packed import sorted_keys
+from .sources import local_file_tag
+from .stats import STATS
+
+INDEX_MAGIC = b'DNSGIDX\0'
+INDEX_VERSION = 2   # 2: KEY_SEPARATOR keys
+INDEX_HEADER = struct.Struct('<8sII')
+INDEX_OFFSET = struct.Struct('<I')
+INDEX_BLACKLIST = 1
+INDEX_WHITELIST = 2
+INDEX_REMOTE = 4
+
+
+class RuleIndexError(ValueError):
+    pass
+
+
+def flagged_keys(keys, flag: int):
+    for key in keys:
+        yield key, flag
+
+
+def write_rule_index(path: Path, *,
+                     remote_keys,
+                     whitelist,
+                     blacklist,
+                     ) -> int:
+    # remote_keys are the sorted, unique keys of the domains that block
+    # their subtree, returns the number of keys written
+    #
+    # the three sorted key streams are merged, so the remote rules are
+    # never unpacked into a dict of every key
+    streams = [flagged_keys(remote_keys, INDEX_REMOTE),
+               flagged_keys(sorted_keys(whitelist), INDEX_WHITELIST),
+               flagged_keys(sorted_keys(blacklist), INDEX_BLACKLIST)]
+    data = bytearray()
+    offsets = array('I', [0])
+    flags = bytearray()
+    for key, entries in groupby(heapq.merge(*streams), key=lambda entry: entry[0]):
+        key_flags = 0
+        for _, flag in entries:
+            key_flags |= flag
+        data += key
+        try:
+            offsets.append(len(data))
+        except OverflowError as e:
+            raise RuleIndexError('rule index data does not fit uint32 offsets') from e
+        flags.append(key_flags)
+    if sys.byteorder != 'little':
+        offsets.byteswap()  # the file is little-endian
+
+    path = Path(path)
+    # per process, two generate runs may be writing the index at once
+    tmp_path = path.with_name(path.name + '.%d.tmp' % os.getpid())
+    with open(tmp_path, 'wb') as fh:
+        fh.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(flags)))
+        fh.write(offsets.tobytes())
+        fh.write(flags)
+        fh.write(data)
+    os.replace(tmp_path, path)
+    return len(flags)
+
+
+def write_build_state_index(path: Path, state) -> int:
+    # the index for the rules of a build state, X comes out of its sorted S
+    # in key order. When no input changed since the state was saved along
+    # with this very file, the file is kept. Returns the number of keys.
+    path = Path(path)
+    if state.unchanged and state.rule_index_tag is not None:
+        try:
+            current = local_file_tag(os.stat(path)) == state.rule_index_tag
+        except FileNotFoundError:
+            current = False
+        if current:
+            leprint("Rules unchanged, keeping the rule index %s", path, level=LOG['DEBUG'])
+            STATS.count('rule_index_unchanged', 1)
+            with open(path, 'rb') as fh:
+                _, _, count = INDEX_HEADER.unpack(fh.read(INDEX_HEADER.size))
+            return count
+    STATS.count('rule_index_unchanged', 0)
+    count = write_rule_index(path,
+                             remote_keys=state.remote_rule_keys(),
+                             whitelist=state.whitelist,
+                             blacklist=state.blacklist,)
+    state.rule_index_tag = local_file_tag(os.stat(path))
+    return count
+
+
+class RuleIndexFile():
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as fh:
+            self.stat = os.fstat(fh.fileno())
+            if self.stat.st_size < INDEX_HEADER.size:
+                raise RuleIndexError('%s is too short for a rule index' % self.path)
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = INDEX_HEADER.unpack_from(self.map)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.map.close()
+            raise RuleIndexError('%s is not a version %d rule index' % (self.path, INDEX_VERSION))
+        self.offsets_start = INDEX_HEADER.size
+        self.flags_start = self.offsets_start + INDEX_OFFSET.size * (self.count + 1)
+        self.data_start = self.flags_start + self.count
+        end, = INDEX_OFFSET.unpack_from(self.map, self.offsets_start + INDEX_OFFSET.size * self.count)
+        if self.data_start + end != len(self.map):
+            self.map.close()
+            raise RuleIndexError('%s is truncated' % self.path)
+        self.view = memoryview(self.map)
+
+    def __len__(self):
+        return self.count
+
+    def close(self) -> None:
+        self.view.release()     # the mapping can not be closed while it is exported
+        self.map.close()
+
+    def is_current(self) -> bool:
+        # False once generate has renamed a new index over the path
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True     # keep serving what is mapped
+        return (stat.st_ino, stat.st_mtime_ns) == (self.stat.st_ino, self.stat.st_mtime_ns)
+
+    def key(self, index: int) -> memoryview:
+        start, end = struct.unpack_from('<II', self.map, self.offsets_start + INDEX_OFFSET.size * index)
+        return self.view[self.data_start + start:self.data_start + end]
+
+    def flags(self, key: bytes) -> int:
+        key = bytearray(key)    # orders against the memoryview keys
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key(low) == key:
+            return self.map[self.flags_start + low]
+        return 0
+
+    def is_blocked(self, name: bytes) -> bool:
+        labels = name.split(b'.')
+        labels.reverse()
+        remote = False
+        flags = 0
+        for depth in range(1, len(labels) + 1):
+            flags = self.flags(KEY_SEPARATOR.join(labels[:depth]))
+            if flags & INDEX_BLACKLIST:
+                return True
+            if flags & INDEX_REMOTE and not flags & INDEX_WHITELIST:
+                remote = True   # generate drops whitelisted remote rules
+        # flags is the name's own now
+        return remote and not flags & INDEX_WHITELIST
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# "dnsgate serve": a filtering DNS forwarder over UDP and TCP.
+#
+# The rules come from the rule index the last generate wrote, not from
+# the output file, so the whitelist is applied exactly instead of the way
+# the generated rules approximate it:
+#
+#   1. a name at or under a local blacklist entry is blocked
+#   2. a whitelisted name is answered upstream
+#   3. a name at or under a remote domain (its psl domain with
+#      block_at_psl) is blocked
+#   4. everything else is answered upstream
+#
+# The index is mmapped and searched in place, one binary search per label
+# of the query. Blocked names get NXDOMAIN, or an A/AAAA record for
+# dest_ip. Upstream answers are cached by question, EDNS, DO and CD bit
+# until their smallest TTL runs out, the TTLs are counted down when a
+# cached answer is served.
+# A new index is picked up within SERVE_RELOAD_INTERVAL of generate
+# renaming it into place, or right away on SIGHUP.
+#
+# Only the header, the question and the fixed part of resource records are
+# parsed, everything else is passed through as bytes.
+
+import asyncio
+import random
+import signal
+import socket
+import struct
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from logtool import LOG
+from logtool import leprint
+
+from .global_vars import SERVE_BLOCKED_TTL
+from .global_vars import SERVE_CACHE_MAX_TTL
+from .global_vars import SERVE_CACHE_SIZE
+from .global_vars import RULE_INDEX_FILE
+from .global_vars import SERVE_NEGATIVE_TTL
+from .global_vars import SERVE_RELOAD_INTERVAL
+from .global_vars import SERVE_UPSTREAM_TIMEOUT
+from .rule_index import RuleIndexError
+from .rule_index import RuleIndexFile
+
+HEADER = struct.Struct('!HHHHHH')
+RR_FIXED = struct.Struct('!HHIH')   # type, class, ttl, rdlength
+TYPE_A = 1
+TYPE_AAAA = 28
+TYPE_OPT = 41
+CLASS_IN = 1
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+FLAG_CD = 0x0010
+EDNS_FLAG_DO = 0x8000               # in the OPT ttl field
+OPCODE_MASK = 0x7800
+UDP_MAX_PAYLOAD = 512               # without EDNS
+
+
+class DnsMessageError(ValueError):
+    pass
+
+
+def read_name(message: bytes, offset: int) -> tuple:
+    # returns (lowercased dotted name, offset after the name in place)
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        try:
+            length = message[offset]
+        except IndexError as e:
+            raise DnsMessageError('name runs past the end of the message') from e
+        if length & 0xC0 == 0xC0:
+            if offset + 1 >= len(message) or jumps > 32:
+                raise DnsMessageError('bad compression pointer')
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | message[offset + 1]
+            jumps += 1
+            continue
+        if length & 0xC0:
+            raise DnsMessageError('unknown label type')
+        offset += 1
+        if length == 0:
+            break
+        labels.append(message[offset:offset + length].lower())
+        offset += length
+    return b'.'.join(labels), offset if end is None else end
+
+
+def parse_query(message: bytes) -> tuple:
+    # returns (name, qtype, qclass, end of the question section)
+    if len(message) < HEADER.size:
+        raise DnsMessageError('short message')
+    _, flags, qdcount, _, _, _ = HEADER.unpack_from(message)
+    if flags & FLAG_QR or flags & OPCODE_MASK or qdcount != 1:
+        raise DnsMessageError('not a standard query with one question')
+    name, offset = read_name(message, HEADER.size)
+    if offset + 4 > len(message):
+        raise DnsMessageError('short question')
+    qtype, qclass = struct.unpack_from('!HH', message, offset)
+    return name, qtype, qclass, offset + 4
+
+
+def response_ttls(message: bytes, question_end: int) -> tuple:
+    # returns (offsets of the ttl fields, smallest answer/authority ttl or None)
+    _, _, _, ancount, nscount, arcount = HEADER.unpack_from(message)
+    offset = question_end
+    offsets = []
+    smallest = None
+    for index in range(ancount + nscount + arcount):
+        _, offset = read_name(message, offset)
+        if offset + RR_FIXED.size > len(message):
+            raise DnsMessageError('short resource record')
+        rrtype, _, ttl, rdlength = RR_FIXED.unpack_from(message, offset)
+        if rrtype != TYPE_OPT:    # the OPT ttl field holds EDNS flags
+            offsets.append(offset + 4)
+            if index < ancount + nscount and (smallest is None or ttl < smallest):
+                smallest = ttl
+        offset += RR_FIXED.size + rdlength
+    return offsets, smallest
+
+
+def query_opt(query: bytes, question_end: int) -> Optional[tuple]:
+    # (udp payload size, extended rcode/version/flags) of the OPT record
+    # the client sent, None without EDNS
+    _, _, _, ancount, nscount, arcount = HEADER.unpack_from(query)
+    offset = question_end
+    for _ in range(ancount + nscount + arcount):
+        _, offset = read_name(query, offset)
+        if offset + RR_FIXED.size > len(query):
+            break
+        rrtype, payload_size, edns_flags, rdlength = RR_FIXED.unpack_from(query, offset)
+        if rrtype == TYPE_OPT:
+            return payload_size, edns_flags
+        offset += RR_FIXED.size + rdlength
+    return None
+
+
+def udp_payload_size(query: bytes, question_end: int) -> int:
+    # what the client takes over udp, from its OPT record if it sent one
+    opt = query_opt(query, question_end)
+    if opt is None:
+        return UDP_MAX_PAYLOAD
+    return max(UDP_MAX_PAYLOAD, opt[0])
+
+
+def cache_key(query: bytes, question_end: int, *,
+              name: bytes,
+              qtype: int,
+              qclass: int,
+              transport: str,
+              ) -> tuple:
+    # besides the question, the upstream answer depends on whether the
+    # client sent EDNS (an OPT record comes back), its DO bit (DNSSEC
+    # records come back) and the CD bit (unvalidated answers come back)
+    _, flags, _, _, _, _ = HEADER.unpack_from(query)
+    opt = query_opt(query, question_end)
+    dnssec_ok = opt is not None and bool(opt[1] & EDNS_FLAG_DO)
+    return (name, qtype, qclass, transport, opt is not None, dnssec_ok, bool(flags & FLAG_CD))
+
+
+def make_response(query: bytes, question_end: int, *,
+                  rcode: int,
+                  answer: bytes = b'',
+                  flags: int = 0,
+                  ) -> bytes:
+    query_id, query_flags, _, _, _, _ = HEADER.unpack_from(query)
+    flags |= FLAG_QR | (query_flags & (OPCODE_MASK | FLAG_RD)) | FLAG_RA | rcode
+    header = HEADER.pack(query_id, flags, 1, 1 if answer else 0, 0, 0)
+    return header + query[HEADER.size:question_end] + answer
+
+
+def load_rule_index(path: Path = RULE_INDEX_FILE) -> Optional[RuleIndexFile]:
+    try:
+        return RuleIndexFile(path)
+    except FileNotFoundError:
+        return None
+    except RuleIndexError as e:
+        leprint("WARNING: %s", e, level=LOG['WARNING'])
+        return None
+
+
+class ResponseCache():
+    def __init__(self, maxsize: int = SERVE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, query_id: int) -> Optional[bytes]:
+        try:
+            response, ttl_offsets, stored, expires = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        if now >= expires:
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        elapsed = int(now - stored)
+        response = bytearray(response)
+        struct.pack_into('!H', response, 0, query_id)
+        for offset in ttl_offsets:
+            ttl, = struct.unpack_from('!I', response, offset)
+            struct.pack_into('!I', response, offset, max(0, ttl - elapsed))
+        return bytes(response)
+
+    def put(self, key, response: bytes, question_end: int) -> None:
+        _, flags, _, _, _, _ = HEADER.unpack_from(response)
+        if flags & FLAG_TC or (flags & 0xF) not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            return
+        try:
+            ttl_offsets, ttl = response_ttls(response, question_end)
+        except DnsMessageError:
+            return
+        if ttl is None:
+            ttl = SERVE_NEGATIVE_TTL
+        ttl = min(ttl, SERVE_CACHE_MAX_TTL)
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        self.entries[key] = (response, ttl_offsets, now, now + ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    # one socket for every UDP query to the upstream, told apart by a
+    # random id (rewritten on the way back) and the question
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER.size:
+            return
+        upstream_id, = struct.unpack_from('!H', data)
+        try:
+            future, question = self.pending[upstream_id]
+        except KeyError:
+            return
+        if data[HEADER.size:HEADER.size + len(question)] != question or future.done():
+            return
+        future.set_result(data)
+
+    def error_received(self, exc):
+        leprint("upstream error: %s", exc, level=LOG['WARNING'])
+
+    async def query(self, message: bytes, question_end: int, *,
+                    timeout: float,
+                    ) -> bytes:
+        upstream_id = random.randrange(0x10000)
+        while upstream_id in self.pending:
+            upstream_id = random.randrange(0x10000)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[upstream_id] = (future, message[HEADER.size:question_end])
+        try:
+            self.transport.sendto(struct.pack('!H', upstream_id) + message[2:])
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[upstream_id]
+        return message[:2] + response[2:]
+
+
+class DnsProxy():
+    def __init__(self, *,
+                 config,
+                 rules: RuleIndexFile,
+                 upstream: tuple,
+                 cache_size: int = SERVE_CACHE_SIZE,
+                 timeout: float = SERVE_UPSTREAM_TIMEOUT,
+                 ):
+        self.config = config
+        self.rules = rules
+        self.upstream = upstream
+        self.cache = ResponseCache(cache_size)
+        self.timeout = timeout
+        self.upstream_udp = None
+        self.blocked_answer = {}
+        if config.dest_ip:
+            family = socket.AF_INET6 if ':' in config.dest_ip else socket.AF_INET
+            rrtype = TYPE_AAAA if family == socket.AF_INET6 else TYPE_A
+            rdata = socket.inet_pton(family, config.dest_ip)
+            # a pointer to the question name, offset 12
+            answer = b'\xc0\x0c' + RR_FIXED.pack(rrtype, CLASS_IN, SERVE_BLOCKED_TTL, len(rdata))
+            self.blocked_answer[rrtype] = answer + rdata
+
+    def reload(self) -> None:
+        rules = load_rule_index(self.rules.path)
+        if rules is None:
+            leprint("No rule index to reload, keeping the current %d rules.", len(self.rules), level=LOG['WARNING'])
+            return
+        # lookups run on the loop thread, nothing else holds the old mapping
+        self.rules.close()
+        self.rules = rules
+        self.cache.entries.clear()
+        leprint("Reloaded %d rules.", len(rules), level=LOG['INFO'])
+
+    async def watch_rules(self) -> None:
+        while True:
+            await asyncio.sleep(SERVE_RELOAD_INTERVAL)
+            if not self.rules.is_current():
+                self.reload()
+
+    def blocked_response(self, query: bytes, question_end: int, qtype: int) -> bytes:
+        if not self.config.dest_ip:
+            return make_response(query, question_end, rcode=RCODE_NXDOMAIN)
+        # the name exists, other record types get an empty answer
+        return make_response(query, question_end, rcode=RCODE_NOERROR, answer=self.blocked_answer.get(qtype, b''))
+
+    async def resolve(self, query: bytes, *,
+                      transport: str,
+                      ) -> Optional[bytes]:
+        try:
+            name, qtype, qclass, question_end = parse_query(query)
+            key = cache_key(query, question_end, name=name, qtype=qtype, qclass=qclass, transport=transport)
+        except DnsMessageError as e:
+            leprint("dropping malformed query: %s", e, level=LOG['DEBUG'])
+            return None
+        if self.rules.is_blocked(name):
+            leprint("blocked: %s", name, level=LOG['DEBUG'])
+            return self.blocked_response(query, question_end, qtype)
+
+        query_id, = struct.unpack_from('!H', query)
+        response = self.cache.get(key, query_id)
+        if response is not None:
+            return response
+        try:
+            if transport == 'tcp':
+                response = await self.query_tcp(query)
+            else:
+                response = await self.upstream_udp.query(query, question_end, timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            leprint("upstream failed for %s: %r", name, e, level=LOG['WARNING'])
+            return make_response(query, question_end, rcode=RCODE_SERVFAIL)
+        self.cache.put(key, response, question_end)
+        return response
+
+    async def query_tcp(self, query: bytes) -> bytes:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.upstream), self.timeout)
+        try:
+            writer.write(struct.pack('!H', len(query)) + query)
+            length, = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), self.timeout))
+            return await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        finally:
+            writer.close()
+
+    async def handle_tcp(self, reader, writer) -> None:
+        try:
+            while True:
+                length, = struct.unpack('!H', await reader.readexactly(2))
+                response = await self.resolve(await reader.readexactly(length), transport='tcp')
+                if response is None:
+                    break
+                writer.write(struct.pack('!H', len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, *,
+                    listen: str,
+                    port: int,
+                    ) -> None:
+        loop = asyncio.get_running_loop()
+        upstream_transport, self.upstream_udp = await loop.create_datagram_endpoint(UpstreamProtocol,
+                                                                                   remote_addr=self.upstream)
+        client_transport, _ = await loop.create_datagram_endpoint(lambda: ClientProtocol(self),
+                                                                  local_addr=(listen, port))
+        server = await asyncio.start_server(self.handle_tcp, listen, port)
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+        watcher = asyncio.ensure_future(self.watch_rules())
+        leprint("Serving %d rules on %s port %d (udp, tcp), forwarding to %s port %d",
+                len(self.rules), listen, port, self.upstream[0], self.upstream[1], level=LOG['INFO'])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            client_transport.close()
+            upstream_transport.close()
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, proxy: DnsProxy):
+        self.proxy = proxy
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self.answer(data, addr))
+
+    async def answer(self, data: bytes, addr) -> None:
+        response = await self.proxy.resolve(data, transport='udp')
+        if response is None:
+            return
+        if len(response) > UDP_MAX_PAYLOAD:
+            # a cached answer may have come from a client with a bigger
+            # EDNS buffer, truncate it and the client retries over tcp
+            _, _, _, question_end = parse_query(data)
+            if len(response) > udp_payload_size(data, question_end):
+                response = make_response(data, question_end, rcode=response[3] & 0xF, flags=FLAG_TC)
+        self.transport.sendto(response, addr)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# What a configured source can be.
+#
+#   http://, https://   a remote list, downloaded into the url cache
+#   file:///path        a local list file, read in place
+#   file:///directory   every list file directly in it (not hidden, not in
+#                       subdirectories), each one a source of its own named
+#                       by its file:// url, expanded again on every run so
+#                       files dropped into it are picked up without a
+#                       dnsgate configure
+#
+# The path after file:// is taken as is, not percent-decoded (configparser
+# would read %20 as interpolation). Local files are never copied into the
+# cache, only their parsed copy is kept, see get_domains_from_local_file().
+
+import os
+from pathlib import Path
+
+REMOTE_SOURCE_PREFIXES = ('http://', 'https://')
+LOCAL_SOURCE_PREFIX = 'file://'
+
+
+def is_remote_source(source: str) -> bool:
+    return source.startswith(REMOTE_SOURCE_PREFIXES)
+
+
+def is_local_source(source: str) -> bool:
+    # only absolute paths on this host, file:///path
+    return source.startswith(LOCAL_SOURCE_PREFIX + '/')
+
+
+def is_source(source: str) -> bool:
+    return is_remote_source(source) or is_local_source(source)
+
+
+def local_source_path(url: str) -> Path:
+    return Path(url[len(LOCAL_SOURCE_PREFIX):])
+
+
+def local_source_url(path: Path) -> str:
+    return LOCAL_SOURCE_PREFIX + os.fsdecode(path)
+
+
+def local_file_tag(stat: os.stat_result) -> str:
+    # the parsed copy of a local file is current while these match
+    return 'stat-%d-%d-%d' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def expand_sources(sources) -> list:
+    # sources as urls, directories replaced by the files in them,
+    # anything is_source() rejects is dropped
+    urls = []
+    for source in sources:
+        if is_remote_source(source):
+            urls.append(source)
+        elif is_local_source(source):
+            path = local_source_path(source)
+            if path.is_dir():
+                urls.extend(local_source_url(child) for child in sorted(path.iterdir())
+                            if not child.name.startswith('.') and child.is_file())
+            else:
+                urls.append(source)     # a missing file fails like a download
+    return urls
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Structured counters for one "dnsgate generate" run.
+#
+# Stages record wall and CPU time plus domain counts in and out, sources
+# record how the cache served them and how many bytes came over the wire.
+# The result is written as JSON (--stats-json) and/or in the Prometheus
+# node_exporter textfile-collector format (--stats-prometheus), both
+# atomically so a collector never reads half a file.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+STATS_VERSION = 1
+PROMETHEUS_PREFIX = 'dnsgate_generate_'
+
+
+class GenerateStats():
+    def __init__(self):
+        self.lock = threading.Lock()   # sources are fetched from worker threads
+        self.reset()
+
+    def reset(self) -> None:
+        # at the start of every run, a process may run generate more than once
+        self.started = time.time()
+        self.finished = None
+        self.stages = {}
+        self.sources = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name: str, *,
+              domains_in: Optional[int] = None,
+              ):
+        # the caller fills in domains_out (and anything else) on the record
+        record = {'domains_in': domains_in, 'domains_out': None}
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+            record['cpu_seconds'] = round(time.process_time() - cpu_start, 6)
+            self.stages[name] = record
+
+    def source(self, url: str) -> dict:
+        with self.lock:
+            return self.sources.setdefault(url, {'cache': None,
+                                                 'parsed_cache': None,
+                                                 'bytes_downloaded': 0,
+                                                 'domains': None,
+                                                 'seconds': None,
+                                                 'stale_seconds': None})
+
+    def count(self, name: str, value) -> None:
+        self.counters[name] = value
+
+    def finish(self) -> None:
+        self.finished = time.time()
+
+    def as_dict(self) -> dict:
+        return {'version': STATS_VERSION,
+                'started': self.started,
+                'finished': self.finished,
+                'wall_seconds': round((self.finished or time.time()) - self.started, 6),
+                'stages': self.stages,
+                'sources': self.sources,
+                'counters': self.counters}
+
+    def write(self, *,
+              json_path: Optional[Path] = None,
+              prometheus_path: Optional[Path] = None,
+              ) -> None:
+        if json_path:
+            self.write_json(json_path)
+        if prometheus_path:
+            self.write_prometheus(prometheus_path)
+
+    def write_json(self, path: Path) -> None:
+        write_atomic(path, json.dumps(self.as_dict(), indent=2, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path: Path) -> None:
+        write_atomic(path, self.prometheus_text())
+
+    def prometheus_text(self) -> str:
+        stats = self.as_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            name = PROMETHEUS_PREFIX + name
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, prometheus_labels(labels), float(value)))
+
+        metric('success', '1 if the last generate ran to the end',
+               [({}, 1 if stats['finished'] else 0)])
+        metric('last_run_timestamp_seconds', 'when the last generate started',
+               [({}, stats['started'])])
+        metric('duration_seconds', 'wall time of the last generate',
+               [({}, stats['wall_seconds'])])
+        stages = stats['stages'].items()
+        metric('stage_wall_seconds', 'wall time per stage',
+               [({'stage': name}, record['wall_seconds']) for name, record in stages])
+        metric('stage_cpu_seconds', 'process CPU time per stage',
+               [({'stage': name}, record['cpu_seconds']) for name, record in stages])
+        metric('stage_domains_in', 'domains going into a stage',
+               [({'stage': name}, record['domains_in']) for name, record in stages])
+        metric('stage_domains_out', 'domains coming out of a stage',
+               [({'stage': name}, record['domains_out']) for name, record in stages])
+        sources = stats['sources'].items()
+        metric('source_cache', 'how the url cache served a source, by result',
+               [({'source': url, 'result': record['cache']}, 1) for url, record in sources if record['cache']])
+        metric('source_parsed_cache_hit', '1 if the parsed domain set of a source came from the cache',
+               [({'source': url}, record['parsed_cache'] == 'hit')
+                for url, record in sources if record['parsed_cache']])
+        metric('source_bytes_downloaded', 'bytes downloaded per source',
+               [({'source': url}, record['bytes_downloaded']) for url, record in sources])
+        metric('source_domains', 'validated domains per source',
+               [({'source': url}, record['domains']) for url, record in sources])
+        metric('source_seconds', 'fetch and parse time per source',
+               [({'source': url}, record['seconds']) for url, record in sources])
+        metric('source_stale_seconds', 'age of the cached copy used in place of a source that was not fetched',
+               [({'source': url}, record['stale_seconds']) for url, record in sources])
+        for name, value in sorted(stats['counters'].items()):
+            metric(name, name.replace('_', ' '), [({}, value)])
+        return '\n'.join(lines) + '\n'
+
+
+def prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (key, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+def write_atomic(path: Path, text: str) -> None:
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as fh:
+        fh.write(text)
+    os.replace(tmp_path, path)
+
+
+STATS = GenerateStats()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Label-reversed domain tree: com -> example -> www
+#
+# Every inner node is a dict of child label -> child. A subtree holding a
+# single rule is not expanded into a chain of dicts: the child is the rule
+# itself, the same bytes object the caller passed in, which may sit at that
+# node or any depth below it. Blocklists are mostly unrelated registrable
+# domains, so most rules never cost more than one dict entry, and walking
+# the tree hands back the caller's objects instead of rebuilt names.
+#
+# A rule covers everything below it, so adding a rule drops whatever
+# subtree was there and adding anything under an existing rule is a no-op:
+# the tree is always free of redundant rules and walking it yields the
+# pruned rule set.
+
+
+def label_count(domain: bytes) -> int:
+    return domain.count(b'.') + 1
+
+
+class DomainTrie():
+    def __init__(self, domains=()):
+        self.root = {}
+        self.count = 0
+        self.update(domains)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.iter_rules()
+
+    def __contains__(self, domain: bytes) -> bool:
+        return self.covering_rule(domain) is not None
+
+    def add(self, domain: bytes) -> bool:
+        # returns False if an existing rule already covers domain
+        labels = domain.split(b'.')
+        depth = len(labels)
+        node = self.root
+        level = 1
+        while True:
+            label = labels[depth - level]
+            child = node.get(label)
+            if child is None:
+                node[label] = domain
+                self.count += 1
+                return True
+            if isinstance(child, dict):
+                if level == depth:
+                    self.count -= count_rules(child) - 1
+                    node[label] = domain
+                    return True
+                node = child
+                level += 1
+                continue
+            # a single rule somewhere at or below this node
+            if child == domain:
+                return False
+            child_depth = label_count(child)
+            if child_depth == level:
+                return False
+            if level == depth:
+                node[label] = domain
+                return True
+            # both continue below, expand this node and keep walking
+            node[label] = node = {child.split(b'.')[child_depth - level - 1]: child}
+            level += 1
+
+    def update(self, domains) -> None:
+        for domain in domains:
+            self.add(domain)
+
+    def covering_rule(self, domain: bytes):
+        # the rule that blocks domain (itself or a parent), or None
+        labels = domain.split(b'.')
+        node = self.root
+        for index in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[index])
+            if node is None:
+                return None
+            if not isinstance(node, dict):
+                if node == domain or domain.endswith(b'.' + node):
+                    return node
+                return None
+        return None
+
+    def iter_rules(self):
+        stack = [self.root]
+        while stack:
+            for child in stack.pop().values():
+                if isinstance(child, dict):
+                    stack.append(child)
+                else:
+                    yield child
+
+
+def count_rules(node: dict) -> int:
+    count = 0
+    stack = [node]
+    while stack:
+        for child in stack.pop().values():
+            if isinstance(child, dict):
+                stack.append(child)
+            else:
+                count += 1
+    return count
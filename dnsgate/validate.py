@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Domains are validated once, where they enter generate (a source, the
+# whitelist, the blacklist). The result is tagged by its type so later
+# stages can tell it apart from raw input and never validate it again.
+
+
+class ValidatedDomains(set):
+    # a set whose members already passed validate_domain_list(), in-place
+    # updates (|=, add) keep the type, binary set operators return a plain set
+    pass
+
+
+def validated_domains(domains) -> ValidatedDomains:
+    if isinstance(domains, ValidatedDomains):
+        return domains
+    # urltool loads tldextract, the commands that never validate skip it
+    from urltool import validate_domain_list
+    return ValidatedDomains(validate_domain_list(domains))
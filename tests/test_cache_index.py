@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# Two CacheIndex objects on one index file, like generate and a
+# "dnsgate cache warm" running at the same time: each save keeps the
+# entries the other one wrote or removed.
+
+from dnsgate.cache_index import CacheIndex
+from dnsgate.cache_index import cache_key
+
+
+def record(index: CacheIndex, url: str) -> None:
+    index.record_download(url, etag='"%s"' % url, last_modified=None)
+
+
+def test_saves_merge_the_other_writers_entries(tmp_path):
+    path = tmp_path / 'index.json'
+    first = CacheIndex(path)
+    second = CacheIndex(path)
+    first.load()
+    second.load()
+    record(first, 'http://a.example/list')
+    record(second, 'http://b.example/list')
+    record(first, 'http://c.example/list')
+    urls = {entry['url'] for entry in CacheIndex(path).load().values()}
+    assert urls == {'http://a.example/list', 'http://b.example/list', 'http://c.example/list'}
+    assert sorted(child.name for child in tmp_path.iterdir()) == ['index.json', 'index.json.lock']
+
+
+def test_removed_entries_stay_removed(tmp_path):
+    path = tmp_path / 'index.json'
+    first = CacheIndex(path)
+    second = CacheIndex(path)
+    record(first, 'http://a.example/list')
+    record(first, 'http://b.example/list')
+    second.load()
+    with first.lock:
+        first.remove(cache_key('http://a.example/list'))
+        first.save()
+    second.touch('http://b.example/list')
+    assert [entry['url'] for entry in CacheIndex(path).load().values()] == ['http://b.example/list']
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# load_config() on a config file in tmp_path: the combinations of mode,
+# dnsmasq_reload, dest_ip and output_format it refuses, and what the
+# output of the ones it accepts blocks, read back the way dnsmasq reads it.
+
+import pytest
+
+from dnsgate import dnsgate
+from dnsgate.dnsgate import load_config
+from dnsgate.dnsgate import write_output_file
+
+CONFIG = '''[DEFAULT]
+mode = {mode}
+block_at_psl = {block_at_psl}
+dest_ip = {dest_ip}
+sources = ('file:///dev/null',)
+output = {output}
+dnsmasq_config_file = {dnsmasq_config_file}
+dnsmasq_reload = {dnsmasq_reload}
+'''
+
+
+@pytest.fixture(name='write_config')
+def fixture_write_config(tmp_path, monkeypatch):
+    config_file = tmp_path / 'config'
+    monkeypatch.setattr(dnsgate, 'CONFIG_FILE', config_file)
+
+    def write_config(*,
+                     mode: str = 'dnsmasq',
+                     block_at_psl: bool = False,
+                     dest_ip=None,
+                     dnsmasq_reload: str = 'restart',
+                     output_format=None,
+                     ):
+        text = CONFIG.format(mode=mode,
+                             block_at_psl=block_at_psl,
+                             dest_ip=dest_ip,
+                             output=tmp_path / 'generated_blacklist',
+                             dnsmasq_config_file=tmp_path / 'dnsmasq.conf',
+                             dnsmasq_reload=dnsmasq_reload,)
+        if output_format:
+            text += 'output_format = %s\n' % output_format
+        config_file.write_text(text)
+    return write_config
+
+
+def dnsmasq_blocks(output: bytes, name: bytes) -> bool:
+    # server=/.domain/ and address=/.domain/ lines match the domain and
+    # every name under it, a hosts (addn-hosts) line only its own name
+    labels = name.split(b'.')
+    names = {b'.'.join(labels[index:]) for index in range(len(labels))}
+    for line in output.split(b'\n'):
+        if line.startswith((b'server=/.', b'address=/.')):
+            if line.split(b'/')[1][1:] in names:
+                return True
+        elif line and not line.startswith(b'#'):
+            if line.split()[1] == name:
+                return True
+    return False
+
+
+@pytest.mark.parametrize('block_at_psl', [False, True])
+def test_sighup_output_blocks_subdomains(write_config, block_at_psl):
+    write_config(dnsmasq_reload='sighup', block_at_psl=block_at_psl)
+    config = load_config(no_restart_dnsmasq=True, backup=False)
+    write_output_file(config=config, domains_combined=[b'example0.com'], verbose=False, debug=False)
+    with open(config.output, 'rb') as fh:
+        output = fh.read()
+    assert dnsmasq_blocks(output, b'example0.com')
+    assert dnsmasq_blocks(output, b'ads.sub.example0.com')
+    assert not dnsmasq_blocks(output, b'example1.com')
+
+
+@pytest.mark.parametrize('kwargs', [{'dest_ip': '1.2.3.4'},
+                                    {'dest_ip': '1.2.3.4', 'block_at_psl': True},
+                                    {'output_format': 'hosts'}],
+                         ids=['dest_ip', 'dest_ip-block_at_psl', 'hosts'])
+def test_sighup_refuses_exact_name_output(write_config, kwargs):
+    # addn-hosts would only block the listed names, not their subdomains
+    write_config(dnsmasq_reload='sighup', **kwargs)
+    with pytest.raises(SystemExit):
+        load_config(no_restart_dnsmasq=True, backup=False)
+
+
+@pytest.mark.parametrize('dnsmasq_reload, output_format', [('restart', 'rpz'),
+                                                           ('restart', 'unbound'),
+                                                           ('restart', 'hosts'),
+                                                           ('restart', 'servers-file'),
+                                                           ('sighup', 'dnsmasq'),
+                                                           ('sighup', 'rpz'),
+                                                           ('sighup', 'unbound')])
+def test_dnsmasq_mode_refuses_formats_dnsmasq_can_not_read(write_config, dnsmasq_reload, output_format):
+    write_config(dnsmasq_reload=dnsmasq_reload, output_format=output_format)
+    with pytest.raises(SystemExit):
+        load_config(no_restart_dnsmasq=True, backup=False)
+
+
+@pytest.mark.parametrize('mode, dnsmasq_reload, output_format', [('dnsmasq', 'restart', None),
+                                                                 ('dnsmasq', 'restart', 'dnsmasq'),
+                                                                 ('dnsmasq', 'sighup', None),
+                                                                 ('dnsmasq', 'sighup', 'servers-file'),
+                                                                 ('hosts', 'restart', 'rpz'),
+                                                                 ('hosts', 'restart', 'unbound')])
+def test_matching_formats_are_accepted(write_config, mode, dnsmasq_reload, output_format):
+    write_config(mode=mode, dnsmasq_reload=dnsmasq_reload, output_format=output_format)
+    config = load_config(no_restart_dnsmasq=True, backup=False)
+    assert config.output_format == output_format
+
+
+def test_light_config_has_what_enable_and_disable_use(write_config, tmp_path):
+    write_config(dnsmasq_reload='sighup', output_format='rpz')     # the full load refuses rpz
+    config = load_config(no_restart_dnsmasq=True, backup=False, light=True)
+    assert config.dnsmasq_reload == 'sighup'
+    assert config.dnsmasq_config_file.name == (tmp_path / 'dnsmasq.conf').as_posix()
+    assert config.sources is None
+    assert not (tmp_path / 'dnsmasq.conf').exists()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# reload_dnsmasq_service() and restart_dnsmasq_service() against a dummy
+# process that renames itself to FAKE_NAME, so the /proc scan never finds
+# a real dnsmasq. It writes its pid file once it is ready and logs every
+# SIGHUP. With "exit" as argument it exits on SIGHUP instead, like a
+# dnsmasq that failed to re-read its files. The init script writes
+# "restart" to the log and starts a new dummy in the background.
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from dnsgate import dnsmasq
+
+FAKE_NAME = 'dnsgate-fake'
+
+DUMMY = '''
+import ctypes
+import os
+import signal
+import sys
+import time
+
+pid_file, log_file, on_hup = sys.argv[1:4]
+ctypes.CDLL(None).prctl(15, FAKE_NAME.encode(), 0, 0, 0)    # PR_SET_NAME
+
+
+def hangup(signum, frame):
+    with open(log_file, 'a') as fh:
+        fh.write('HUP %d\\n' % os.getpid())
+    if on_hup == 'exit':
+        sys.exit(0)
+
+
+signal.signal(signal.SIGHUP, hangup)
+with open(pid_file + '.tmp', 'w') as fh:
+    fh.write('%d\\n' % os.getpid())
+os.replace(pid_file + '.tmp', pid_file)
+while True:
+    time.sleep(0.05)
+'''.replace('FAKE_NAME', repr(FAKE_NAME))
+
+INIT_SCRIPT = '''#!/bin/sh
+[ "$1" = restart ] || exit 2
+echo restart >> {log_file}
+echo "Restarting the dummy dnsmasq"
+nohup {python} {dummy} {pid_file} {log_file} hup >/dev/null 2>&1 &
+'''
+
+
+class FakeDnsmasq():
+    def __init__(self, tmp_path):
+        self.dummy = tmp_path / 'dummy.py'
+        self.dummy.write_text(DUMMY)
+        self.pid_file = tmp_path / 'dnsmasq.pid'
+        self.log_file = tmp_path / 'log'
+        self.log_file.write_text('')
+        self.init_script = tmp_path / 'init'
+        self.processes = []
+
+    def start(self, on_hup: str = 'hup') -> int:
+        process = subprocess.Popen([sys.executable, self.dummy.as_posix(), self.pid_file.as_posix(),
+                                    self.log_file.as_posix(), on_hup])
+        self.processes.append(process)
+        deadline = time.monotonic() + 10
+        while not self.pid_file.exists():
+            assert time.monotonic() < deadline, 'the dummy dnsmasq did not start'
+            time.sleep(0.05)
+        return process.pid
+
+    def write_init_script(self, script: str = INIT_SCRIPT) -> None:
+        self.init_script.write_text(script.format(log_file=self.log_file,
+                                                  python=sys.executable,
+                                                  dummy=self.dummy,
+                                                  pid_file=self.pid_file,))
+        self.init_script.chmod(0o755)
+
+    def log(self) -> list:
+        return self.log_file.read_text().split('\n')[:-1]
+
+    def stop(self) -> None:
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        try:
+            pid = int(self.pid_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return
+        if dnsmasq.process_name(pid) == FAKE_NAME:    # started by the init script
+            os.kill(pid, signal.SIGKILL)
+
+
+@pytest.fixture(name='fake')
+def fixture_fake(tmp_path, monkeypatch):
+    fake = FakeDnsmasq(tmp_path)
+    monkeypatch.setattr(dnsmasq, 'DNSMASQ_PROCESS_NAME', FAKE_NAME)
+    monkeypatch.setattr(dnsmasq, 'DNSMASQ_PID_FILES', [fake.pid_file])
+    monkeypatch.setattr(dnsmasq, 'DNSMASQ_INIT_SCRIPT', fake.init_script)
+    monkeypatch.setattr(dnsmasq, 'DNSMASQ_RELOAD_SETTLE', 0.3)
+    yield fake
+    fake.stop()
+
+
+def test_reload_sends_sighup(fake):
+    pid = fake.start()
+    assert dnsmasq.reload_dnsmasq_service(timeout=5)
+    assert fake.log() == ['HUP %d' % pid]
+    assert dnsmasq.process_name(pid) == FAKE_NAME
+
+
+def test_reload_fails_when_the_pid_vanishes(fake):
+    pid = fake.start(on_hup='exit')
+    assert not dnsmasq.reload_dnsmasq_service(timeout=5)
+    assert fake.log() == ['HUP %d' % pid]
+    assert dnsmasq.process_name(pid) is None
+
+
+def test_stale_pid_file_falls_back_to_the_proc_scan(fake):
+    pid = fake.start()
+    fake.pid_file.write_text('%d\n' % os.getpid())  # alive, but not dnsmasq
+    assert dnsmasq.dnsmasq_pids() == [pid]
+
+
+def test_reload_restarts_when_dnsmasq_is_not_running(fake):
+    fake.write_init_script()
+    assert dnsmasq.dnsmasq_pids() == []
+    assert dnsmasq.reload_dnsmasq_service(timeout=5)
+    assert fake.log() == ['restart']
+    pids = dnsmasq.dnsmasq_pids()
+    assert pids == [int(fake.pid_file.read_text())]
+
+
+def test_restart_fails_when_the_init_script_fails(fake):
+    fake.write_init_script('#!/bin/sh\necho "dnsmasq: bad config" >&2\nexit 1\n')
+    assert not dnsmasq.restart_dnsmasq_service(timeout=5)
+
+
+def test_restart_fails_when_dnsmasq_does_not_come_back(fake):
+    fake.write_init_script('#!/bin/sh\nexit 0\n')
+    start = time.monotonic()
+    assert not dnsmasq.restart_dnsmasq_service(timeout=1)
+    assert time.monotonic() - start < 5
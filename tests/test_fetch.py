@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# iter_domains_from_urls() against a threaded local HTTP server:
+#
+#   /slow/<name>   answers after SLOW_SECONDS
+#   /hang/<name>   answers after HANG_SECONDS, longer than the fetch timeout
+#   /fail/<name>   500
+#   /ok/<name>     at once
+#
+# every list has the two domains <name>-1.example.com and <name>-2.example.com
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from dnsgate.cache import iter_domains_from_urls
+
+SLOW_SECONDS = 1.0
+HANG_SECONDS = 5.0
+
+
+def hosts_list(name: str) -> bytes:
+    return ('# %s\n0.0.0.0 %s-1.example.com\n0.0.0.0 %s-2.example.com\n' % (name, name, name)).encode('ascii')
+
+
+class ListHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        _, kind, name = self.path.split('/', 2)
+        if kind == 'fail':
+            self.send_error(500)
+            return
+        if kind == 'slow':
+            time.sleep(SLOW_SECONDS)
+        elif kind == 'hang':
+            time.sleep(HANG_SECONDS)
+        body = hosts_list(name)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # the client gave up on a hanging list
+
+    def log_message(self, format, *args):   # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture(name='server_url')
+def fixture_server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ListHandler)
+    server.daemon_threads = True    # hanging handlers do not hold up the shutdown
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(urls, **kwargs) -> dict:
+    kwargs.setdefault('no_cache', True)
+    return dict(iter_domains_from_urls(urls=urls, **kwargs))
+
+
+def test_fetches_run_concurrently(server_url):
+    urls = [server_url + '/slow/list%d' % index for index in range(4)]
+    start = time.monotonic()
+    results = fetch(urls, jobs=4, timeout=30)
+    elapsed = time.monotonic() - start
+    assert set(results) == set(urls)
+    for index, url in enumerate(urls):
+        assert results[url] == {b'list%d-1.example.com' % index, b'list%d-2.example.com' % index}
+    # one after the other would take 4 * SLOW_SECONDS
+    assert elapsed < 2.5 * SLOW_SECONDS
+
+
+def test_jobs_limits_concurrency(server_url):
+    urls = [server_url + '/slow/list%d' % index for index in range(4)]
+    start = time.monotonic()
+    results = fetch(urls, jobs=2, timeout=30)
+    elapsed = time.monotonic() - start
+    assert all(results[url] for url in urls)
+    assert elapsed >= 2 * SLOW_SECONDS
+
+
+def test_timeout_skips_a_hanging_source(server_url):
+    hanging = server_url + '/hang/hanging'
+    ok = server_url + '/ok/fine'
+    start = time.monotonic()
+    results = fetch([hanging, ok], jobs=2, timeout=1)
+    elapsed = time.monotonic() - start
+    assert results[hanging] is None
+    assert results[ok] == {b'fine-1.example.com', b'fine-2.example.com'}
+    assert elapsed < HANG_SECONDS - 1
+
+
+def test_failing_source_is_skipped(server_url):
+    failing = server_url + '/fail/broken'
+    ok = server_url + '/ok/fine'
+    results = fetch([failing, ok], jobs=1, timeout=30)
+    assert results[failing] is None
+    assert results[ok] == {b'fine-1.example.com', b'fine-2.example.com'}
+
+
+def test_unreachable_source_is_skipped(server_url):
+    # nothing listens on port 9 of localhost
+    unreachable = 'http://127.0.0.1:9/ok/gone'
+    ok = server_url + '/ok/fine'
+    results = fetch([unreachable, ok], jobs=2, timeout=5)
+    assert results[unreachable] is None
+    assert results[ok]
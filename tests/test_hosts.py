@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# The chunked parsers against urltool parsing the whole list at once, for
+# every chunk size up to a few lines, so every line is cut everywhere,
+# between a '\r' and its '\n' too. And a list that can not be parsed, or
+# a parse worker that dies, only failing its own source.
+
+import os
+import signal
+
+import pytest
+from urltool import extract_domain_set_from_hosts_format_bytes
+from urltool import validate_domain_list
+
+from dnsgate import hosts
+from dnsgate.cache import iter_domains_from_urls
+from dnsgate.hosts import ParsePool
+from dnsgate.hosts import PooledHostsParser
+from dnsgate.hosts import parse_hosts_chunks
+
+HOSTS_LIST = '\r\n'.join([
+    '# a hosts list with CRLF line ends',
+    '127.0.0.1 localhost',
+    '::1 localhost ip6-localhost ip6-loopback',
+    '0.0.0.0 ads.example.com',
+    '0.0.0.0 Tracker.Example.COM.    # inline comment',
+    '0.0.0.0\tpixel.example.net\tbeacon.example.net',
+    '#0.0.0.0 commented.example.org',
+    '   ',
+    '0.0.0.0 bücher.example.de',
+    '0.0.0.0 xn--bcher-kva.example.de',
+    '0.0.0.0 bad..example.org',
+    '0.0.0.0 last.example.org',
+]).encode('utf8')
+
+
+def whole_list(data: bytes) -> set:
+    return validate_domain_list(extract_domain_set_from_hosts_format_bytes(data))
+
+
+def chunks(data: bytes, size: int):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('data', [HOSTS_LIST,
+                                  HOSTS_LIST + b'\r\n',
+                                  HOSTS_LIST.replace(b'\r\n', b'\n')],
+                         ids=['crlf', 'crlf-final-newline', 'lf'])
+def test_chunked_parse_matches_whole_list(data):
+    expected = whole_list(data)
+    assert b'ads.example.com' in expected
+    assert b'last.example.org' in expected
+    for size in range(1, 120):
+        assert set(parse_hosts_chunks(chunks(data, size))) == expected, size
+
+
+def test_pooled_parse_matches_whole_list():
+    expected = whole_list(HOSTS_LIST)
+    with ParsePool(2) as pool:
+        for size in (1, 5, 64):
+            parser = PooledHostsParser(pool, batch_size=48)
+            assert set(parse_hosts_chunks(chunks(HOSTS_LIST, size), parser=parser)) == expected, size
+
+
+def write_lists(tmp_path, names) -> list:
+    urls = []
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(HOSTS_LIST.replace(b'last.example.org', name.encode('ascii') + b'.example.org'))
+        urls.append('file://' + path.as_posix())
+    return urls
+
+
+def test_unparsable_list_fails_only_its_source(tmp_path, monkeypatch):
+    extract = hosts.extract_domain_set_from_hosts_format_bytes
+
+    def fragile_extract(data):
+        if b'poison' in data:
+            raise UnicodeError('label too long')
+        return extract(data)
+
+    monkeypatch.setattr(hosts, 'extract_domain_set_from_hosts_format_bytes', fragile_extract)
+    poisoned, fine = write_lists(tmp_path, ['poison', 'fine'])
+    results = dict(iter_domains_from_urls(urls=[poisoned, fine], no_cache=True, jobs=2))
+    assert results[poisoned] is None
+    assert b'fine.example.org' in results[fine]
+
+
+def test_dead_worker_fails_only_its_source(tmp_path):
+    first, second = write_lists(tmp_path, ['first', 'second'])
+    with ParsePool(2) as pool:
+        broken = pool.executor
+        assert broken.submit(int).result() == 0     # starts the workers
+        for pid in list(broken._processes):         # pylint: disable=protected-access
+            os.kill(pid, signal.SIGKILL)
+        results = dict(iter_domains_from_urls(urls=[first, second], no_cache=True, jobs=1, parse_pool=pool))
+        assert pool.executor is not broken
+    assert results[first] is None
+    assert results[second] == whole_list(HOSTS_LIST.replace(b'last.example.org', b'second.example.org'))
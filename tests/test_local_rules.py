@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# dnsgate whitelist/blacklist --no-generate appending to the rule files
+# configure creates, whose headers end on a comment line without a newline.
+
+from urltool import extract_domain_set_from_dnsgate_format_file
+
+from dnsgate.dnsgate import append_to_local_rule_file
+from dnsgate.file_headers import make_custom_blacklist_header
+from dnsgate.file_headers import make_custom_whitelist_header
+
+
+def test_append_to_a_freshly_configured_file(tmp_path):
+    for make_header in (make_custom_blacklist_header, make_custom_whitelist_header):
+        path = tmp_path / make_header.__name__
+        path.write_text(make_header(path))
+        append_to_local_rule_file(path=path, idns=['foo.com', 'bar.com'], verbose=False, debug=False)
+        append_to_local_rule_file(path=path, idns=['bücher.example'], verbose=False, debug=False)
+        lines = path.read_text().split('\n')
+        assert lines[-4:] == ['foo.com', 'bar.com', 'xn--bcher-kva.example', '']
+        assert lines[-5] == make_header(path).split('\n')[-1]
+        domains = set(extract_domain_set_from_dnsgate_format_file(path))
+        assert {b'foo.com', b'bar.com', b'xn--bcher-kva.example'} <= domains
+
+
+def test_append_creates_a_missing_file(tmp_path):
+    path = tmp_path / 'blacklist'
+    append_to_local_rule_file(path=path, idns=['foo.com'], verbose=False, debug=False)
+    assert path.read_text() == 'foo.com\n'
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# The packed key order against group_by_tld(), which sorts the regular
+# output. Names with a '-' where another has a '.' are the ones a '.'
+# separated key would put in a different order.
+
+from urltool import group_by_tld
+
+from dnsgate.incremental import SortedDomainList
+from dnsgate.packed import PackedDomains
+from dnsgate.packed import packed_final_rules
+
+DOMAINS = {b'example.com', b'www.example.com', b'example-ads.com', b'a.example-ads.com',
+           b'example.com-ads.net', b'ads.example.com', b'x-y.ads.example.com', b'x.ads.example.com',
+           b'example.org', b'example-org.org', b'com', b'a-.b.example.net'}
+
+
+def test_packed_order_is_group_by_tld_order():
+    expected = list(group_by_tld(DOMAINS))
+    assert list(PackedDomains(DOMAINS)) == expected
+    assert list(SortedDomainList(DOMAINS)) == expected
+
+
+def test_subdomains_skip_lookalike_siblings():
+    packed = PackedDomains(DOMAINS)
+    expected = [b'ads.example.com', b'x.ads.example.com', b'x-y.ads.example.com', b'www.example.com']
+    assert packed.subdomains(b'example.com') == expected
+    assert SortedDomainList(DOMAINS).subdomains(b'example.com') == expected
+
+
+def test_final_rules_keep_lookalike_siblings():
+    final = packed_final_rules(PackedDomains(DOMAINS - {b'com'}))
+    assert list(final) == [b'example.com', b'example-ads.com', b'example.com-ads.net', b'a-.b.example.net',
+                           b'example.org', b'example-org.org']
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# tab-width:4
+# pylint: disable=missing-docstring
+
+# The rule index against the rules generate writes, and DnsProxy.serve()
+# in front of a stub upstream on a local UDP and TCP port.
+#
+# The stub answers every A query with one STUB_ADDRESS record, with a TTL
+# of 1 for names starting with "short." and STUB_TTL otherwise. It echoes
+# the client's OPT record, DO bit included, and counts what it was asked.
+
+import asyncio
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+from dnsgate import serve
+from dnsgate.dnsgate import build_rule_set
+from dnsgate.incremental import build_packed_state
+from dnsgate.incremental import make_build_state
+from dnsgate.incremental import update_build_state
+from dnsgate.packed import PackedDomains
+from dnsgate.rule_index import RuleIndexFile
+from dnsgate.rule_index import write_build_state_index
+from dnsgate.serve import DnsProxy
+
+STUB_ADDRESS = socket.inet_aton('192.0.2.1')
+STUB_TTL = 300
+SHORT_TTL = 1
+
+REMOTE = {b'ads.example.com', b'tracker.example.net', b'example.org', b'www.example.org',
+          b'cdn.example.org', b'shop.example.co.uk', b'pixel.shop.example.co.uk'}
+WHITELIST = {b'www.example.org', b'tracker.example.net', b'shop.example.co.uk'}
+BLACKLIST = {b'bad.example.org', b'tracker.example.net'}
+
+
+def probe_names() -> set:
+    # every listed name, its parents and a name under and beside it
+    names = set()
+    for domain in REMOTE | WHITELIST | BLACKLIST:
+        labels = domain.split(b'.')
+        names.update(b'.'.join(labels[index:]) for index in range(len(labels)))
+        names.add(b'sub.' + domain)
+        names.add(b'other.' + b'.'.join(labels[1:]))
+    return names
+
+
+def generated_blocks(name: bytes, rules: set) -> bool:
+    # a dnsmasq rule blocks the domain and everything under it
+    labels = name.split(b'.')
+    return any(b'.'.join(labels[index:]) in rules for index in range(len(labels)))
+
+
+@pytest.mark.parametrize('block_at_psl', [False, True])
+@pytest.mark.parametrize('compact', [False, True])
+def test_rule_index_matches_generate(tmp_path, block_at_psl, compact):
+    whitelist = set(WHITELIST)
+    blacklist = set(BLACKLIST)
+    if compact:
+        state = build_packed_state(mode='dnsmasq',
+                                   block_at_psl=block_at_psl,
+                                   remote=PackedDomains(REMOTE),
+                                   whitelist=whitelist,
+                                   blacklist=blacklist,)
+        final = set(state.final)
+    else:
+        config = SimpleNamespace(mode='dnsmasq', block_at_psl=block_at_psl)
+        remote_rules, final = build_rule_set(config=config,
+                                             domains_combined_orig=set(REMOTE),
+                                             domains_whitelist=whitelist,
+                                             domains_blacklist=blacklist,)
+        state = make_build_state(mode='dnsmasq',
+                                 block_at_psl=block_at_psl,
+                                 remote=set(REMOTE),
+                                 whitelist=whitelist,
+                                 blacklist=blacklist,
+                                 remote_rules=remote_rules,
+                                 final=set(final),)
+    write_build_state_index(tmp_path / 'rule_index', state)
+    rules = RuleIndexFile(tmp_path / 'rule_index')
+    try:
+        for name in sorted(probe_names()):
+            if name in WHITELIST:
+                # serve answers a whitelisted name itself unless the local blacklist covers it
+                expected = generated_blocks(name, BLACKLIST)
+            else:
+                expected = generated_blocks(name, final)
+            assert rules.is_blocked(name) == expected, name
+    finally:
+        rules.close()
+
+
+def test_index_is_kept_while_the_inputs_are_unchanged(tmp_path):
+    path = tmp_path / 'rule_index'
+    state = make_build_state(mode='dnsmasq',
+                             block_at_psl=False,
+                             remote=set(REMOTE),
+                             whitelist=set(WHITELIST),
+                             blacklist=set(BLACKLIST),
+                             remote_rules=None,
+                             final=set(),)
+    count = write_build_state_index(path, state)
+    written = path.stat()
+    update_build_state(state, remote=set(REMOTE), whitelist=set(WHITELIST), blacklist=set(BLACKLIST))
+    assert write_build_state_index(path, state) == count
+    assert path.stat().st_mtime_ns == written.st_mtime_ns
+
+    update_build_state(state, remote=REMOTE | {b'new.example.com'}, whitelist=set(WHITELIST), blacklist=set(BLACKLIST))
+    assert write_build_state_index(path, state) == count + 1
+    rules = RuleIndexFile(path)
+    try:
+        assert rules.is_blocked(b'sub.new.example.com')
+    finally:
+        rules.close()
+
+
+def encode_name(name: bytes) -> bytes:
+    return b''.join(bytes([len(label)]) + label for label in name.split(b'.')) + b'\0'
+
+
+def make_query(name: bytes, *,
+               query_id: int = 0x1234,
+               edns: bool = False,
+               dnssec_ok: bool = False,
+               ) -> bytes:
+    header = serve.HEADER.pack(query_id, serve.FLAG_RD, 1, 0, 0, 1 if edns else 0)
+    query = header + encode_name(name) + struct.pack('!HH', serve.TYPE_A, serve.CLASS_IN)
+    if edns:
+        edns_flags = serve.EDNS_FLAG_DO if dnssec_ok else 0
+        query += b'\0' + serve.RR_FIXED.pack(serve.TYPE_OPT, 1232, edns_flags, 0)
+    return query
+
+
+class StubUpstream():
+    def __init__(self):
+        self.queries = Counter()
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.address = self.udp.getsockname()
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(self.address)
+        self.tcp.listen()
+        self.threads = [threading.Thread(target=self.serve_udp, daemon=True),
+                        threading.Thread(target=self.serve_tcp, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def answer(self, query: bytes) -> bytes:
+        name, _, _, question_end = serve.parse_query(query)
+        opt = serve.query_opt(query, question_end)
+        self.queries[(name, opt)] += 1
+        query_id, flags, _, _, _, _ = serve.HEADER.unpack_from(query)
+        ttl = SHORT_TTL if name.startswith(b'short.') else STUB_TTL
+        answer = b'\xc0\x0c' + serve.RR_FIXED.pack(serve.TYPE_A, serve.CLASS_IN, ttl, 4) + STUB_ADDRESS
+        additional = b''
+        if opt is not None:
+            additional = b'\0' + serve.RR_FIXED.pack(serve.TYPE_OPT, 1232, opt[1], 0)
+        header = serve.HEADER.pack(query_id, flags | serve.FLAG_QR | serve.FLAG_RA, 1, 1, 0, 1 if additional else 0)
+        return header + query[serve.HEADER.size:question_end] + answer + additional
+
+    def serve_udp(self) -> None:
+        while True:
+            try:
+                query, addr = self.udp.recvfrom(4096)
+            except OSError:
+                return
+            self.udp.sendto(self.answer(query), addr)
+
+    def serve_tcp(self) -> None:
+        while True:
+            try:
+                connection, _ = self.tcp.accept()
+            except OSError:
+                return
+            with connection:
+                length, = struct.unpack('!H', connection.recv(2, socket.MSG_WAITALL))
+                response = self.answer(connection.recv(length, socket.MSG_WAITALL))
+                connection.sendall(struct.pack('!H', len(response)) + response)
+
+    def close(self) -> None:
+        self.udp.close()
+        self.tcp.close()
+
+
+@pytest.fixture(name='upstream')
+def fixture_upstream():
+    upstream = StubUpstream()
+    yield upstream
+    upstream.close()
+
+
+@pytest.fixture(name='rule_index')
+def fixture_rule_index(tmp_path):
+    config = SimpleNamespace(mode='dnsmasq', block_at_psl=False)
+    remote_rules, final = build_rule_set(config=config,
+                                         domains_combined_orig=set(REMOTE),
+                                         domains_whitelist=set(WHITELIST),
+                                         domains_blacklist=set(BLACKLIST),)
+    state = make_build_state(mode='dnsmasq',
+                             block_at_psl=False,
+                             remote=set(REMOTE),
+                             whitelist=set(WHITELIST),
+                             blacklist=set(BLACKLIST),
+                             remote_rules=remote_rules,
+                             final=final,)
+    write_build_state_index(tmp_path / 'rule_index', state)
+    return tmp_path / 'rule_index'
+
+
+def free_port() -> int:
+    # one port free for both udp and tcp
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+            tcp.bind(('127.0.0.1', 0))
+            port = tcp.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+                try:
+                    udp.bind(('127.0.0.1', port))
+                except OSError:
+                    continue
+        return port
+
+
+def query_udp(port: int, query: bytes) -> bytes:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(5)
+        sock.sendto(query, ('127.0.0.1', port))
+        return sock.recv(4096)
+
+
+def query_tcp(port: int, query: bytes) -> bytes:
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(struct.pack('!H', len(query)) + query)
+        length, = struct.unpack('!H', sock.recv(2, socket.MSG_WAITALL))
+        return sock.recv(length, socket.MSG_WAITALL)
+
+
+def run_proxy(rule_index, upstream, scenario, *,
+              dest_ip=None,
+              ) -> None:
+    # scenario(port) runs in a thread while the proxy serves on the loop
+    port = free_port()
+    proxy = DnsProxy(config=SimpleNamespace(dest_ip=dest_ip),
+                     rules=RuleIndexFile(rule_index),
+                     upstream=upstream.address,
+                     timeout=2,)
+
+    async def main():
+        task = asyncio.ensure_future(proxy.serve(listen='127.0.0.1', port=port))
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + 5
+        while proxy.upstream_udp is None or task.done():
+            assert not task.done(), task.exception()
+            assert time.monotonic() < deadline, 'serve did not start'
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.1)    # the tcp listener comes up right after
+        try:
+            await loop.run_in_executor(None, scenario, port)
+        finally:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    try:
+        asyncio.run(main())
+    finally:
+        proxy.rules.close()
+
+
+def rcode(response: bytes) -> int:
+    return response[3] & 0xF
+
+
+def answer_ttl(response: bytes, name: bytes) -> int:
+    question_end = serve.HEADER.size + len(encode_name(name)) + 4
+    _, ttl = serve.response_ttls(response, question_end)
+    return ttl
+
+
+def test_blocked_names_get_nxdomain(rule_index, upstream):
+    def scenario(port):
+        for query in (query_udp, query_tcp):
+            response = query(port, make_query(b'sub.ads.example.com', query_id=0x4242))
+            assert response[:2] == b'\x42\x42'
+            assert rcode(response) == serve.RCODE_NXDOMAIN
+            assert rcode(query(port, make_query(b'bad.example.org'))) == serve.RCODE_NXDOMAIN
+
+    run_proxy(rule_index, upstream, scenario)
+    assert not upstream.queries
+
+
+def test_blocked_names_get_dest_ip(rule_index, upstream):
+    def scenario(port):
+        response = query_udp(port, make_query(b'ads.example.com'))
+        assert rcode(response) == serve.RCODE_NOERROR
+        assert response.endswith(socket.inet_aton('10.0.0.1'))
+
+    run_proxy(rule_index, upstream, scenario, dest_ip='10.0.0.1')
+
+
+def test_other_names_are_forwarded(rule_index, upstream):
+    def scenario(port):
+        for name, query in ((b'www.example.org', query_udp),    # whitelisted
+                            (b'sub.shop.example.co.uk', query_udp),
+                            (b'example.com', query_tcp),):
+            response = query(port, make_query(name, query_id=0x5151))
+            assert response[:2] == b'\x51\x51'
+            assert rcode(response) == serve.RCODE_NOERROR
+            assert response.endswith(STUB_ADDRESS)
+
+    run_proxy(rule_index, upstream, scenario)
+    assert upstream.queries == {(b'www.example.org', None): 1,
+                                (b'sub.shop.example.co.uk', None): 1,
+                                (b'example.com', None): 1}
+
+
+def test_cached_answers_count_down_and_expire(rule_index, upstream):
+    def scenario(port):
+        assert answer_ttl(query_udp(port, make_query(b'cached.example.com')), b'cached.example.com') == STUB_TTL
+        query_udp(port, make_query(b'short.example.com'))
+        time.sleep(1.1)
+        # from the cache, a second older
+        assert answer_ttl(query_udp(port, make_query(b'cached.example.com')), b'cached.example.com') == STUB_TTL - 1
+        # expired, asked again
+        query_udp(port, make_query(b'short.example.com'))
+
+    run_proxy(rule_index, upstream, scenario)
+    assert upstream.queries[(b'cached.example.com', None)] == 1
+    assert upstream.queries[(b'short.example.com', None)] == 2
+
+
+def test_cache_key_has_the_edns_and_do_bits(rule_index, upstream):
+    def scenario(port):
+        plain = query_udp(port, make_query(b'example.com'))
+        edns = query_udp(port, make_query(b'example.com', edns=True))
+        dnssec = query_udp(port, make_query(b'example.com', edns=True, dnssec_ok=True))
+        # the arcount: an OPT record only goes back to clients that sent one
+        assert struct.unpack_from('!H', plain, 10) == (0,)
+        assert struct.unpack_from('!H', edns, 10) == (1,)
+        assert struct.unpack_from('!H', dnssec, 10) == (1,)
+        for _ in range(2):
+            query_udp(port, make_query(b'example.com', edns=True, dnssec_ok=True))
+
+    run_proxy(rule_index, upstream, scenario)
+    assert upstream.queries == {(b'example.com', None): 1,
+                                (b'example.com', (1232, 0)): 1,
+                                (b'example.com', (1232, serve.EDNS_FLAG_DO)): 1}